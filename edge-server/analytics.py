@@ -0,0 +1,267 @@
+"""Vectorised analytics over sensor history: hour-of-day profiles, rolling statistics,
+pairwise correlations and soil drying rates after watering.
+
+A range is streamed from the database as columnar NumPy chunks (see
+downsample.db_chunks) and resampled chunk by chunk onto a regular grid with hold
+semantics: rows are stored on change, so each value holds until the next row, but not for
+longer than `gap_ms` (then the device is considered offline and the grid is NaN). Rows
+from `gap_ms` before the range are read too, so the value in force at the start holds
+into it. Memory
+is bounded by the grid (MAX_GRID points) plus one chunk, whatever the number of rows.
+Every metric is computed on the grid with whole-array operations.
+
+Results are cached per (metric, device, range, parameters). A range that ends before
+the newest row is validated against its range revision (db.range_token), which only
+changes when rows inside it are written late or pruned. A range reaching the newest data
+changes with every reading, so it is served from the cache for LIVE_TTL_S seconds.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+try:
+    from . import db as db
+    from .downsample import db_chunks
+    from .hotwindow import COLUMNS
+except Exception:
+    import db
+    from downsample import db_chunks
+    from hotwindow import COLUMNS
+
+METRICS = ('profile', 'rolling', 'correlation', 'drying')
+# grid points per request; the step is widened for long ranges
+MAX_GRID = 500000
+# points returned by the rolling metric (the grid is strided down to this)
+MAX_SERIES_POINTS = 2000
+CACHE_SIZE = 64
+# how long a result over a range that reaches the newest data is reused
+LIVE_TTL_S = 30
+
+_cache: OrderedDict = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _json(a):
+    """Array -> list with NaN as None."""
+    return [None if v != v else round(v, 4) for v in np.asarray(a, dtype=np.float64).tolist()]
+
+
+def _hold(grid, ts, values, gap_ms: int):
+    """Value of each channel at the grid points: the last row at or before the point, NaN
+    when there is none within gap_ms."""
+    idx = np.searchsorted(ts, grid, 'right') - 1
+    held = np.clip(idx, 0, None)
+    out = values[:, held]
+    out[:, (idx < 0) | (grid - ts[held] > gap_ms)] = np.nan
+    return out
+
+
+def resample(chunks, start_ms: int, end_ms: int, step_ms: int, gap_ms: int):
+    """(grid, values[channel], rows): ascending (ts, values) chunks resampled onto start_ms,
+    start_ms + step_ms, ... end_ms. Grid points before a chunk's last row are final once the
+    chunk is seen, so only the last row is carried over to the next chunk. Chunks may start
+    before start_ms (carry-in rows); `rows` only counts those at or after it."""
+    grid = np.arange(start_ms, end_ms + 1, step_ms, dtype=np.int64)
+    out = np.full((len(COLUMNS), len(grid)), np.nan)
+    done = rows = 0
+    carry = None
+    for ts, values in chunks:
+        rows += len(ts) - int(np.searchsorted(ts, start_ms, 'left'))
+        if carry is not None:
+            ts, values = np.concatenate([carry[0], ts]), np.concatenate([carry[1], values], axis=1)
+        stop = int(np.searchsorted(grid, ts[-1], 'left'))
+        if stop > done:
+            out[:, done:stop] = _hold(grid[done:stop], ts, values, gap_ms)
+            done = stop
+        carry = ts[-1:], values[:, -1:]
+    if carry is not None and done < len(grid):
+        out[:, done:] = _hold(grid[done:], carry[0], carry[1], gap_ms)
+    return grid, out, rows
+
+
+def profile(grid, values, tz_offset_ms: int = 0) -> dict:
+    """Mean/min/max/std per hour of the (local) day; `n` is the number of grid points."""
+    hours = ((grid + tz_offset_ms) // 3600000) % 24
+    out = {'hours': list(range(24))}
+    for name, v in zip(COLUMNS, values):
+        ok = ~np.isnan(v)
+        h, x = hours[ok], v[ok]
+        n = np.bincount(h, minlength=24)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.bincount(h, weights=x, minlength=24) / n
+            std = np.sqrt(np.maximum(np.bincount(h, weights=x * x, minlength=24) / n - mean * mean, 0))
+        lo = np.full(24, np.inf)
+        hi = np.full(24, -np.inf)
+        np.minimum.at(lo, h, x)
+        np.maximum.at(hi, h, x)
+        empty = n == 0
+        lo[empty] = hi[empty] = np.nan
+        out[name] = {'mean': _json(mean), 'min': _json(lo), 'max': _json(hi), 'std': _json(std), 'n': n.tolist()}
+    return out
+
+
+def rolling(grid, values, window_ms: int, step_ms: int) -> dict:
+    """Trailing-window mean and std per channel (cumulative sums, O(n)). A window needs at
+    least half of its points present, otherwise it is NaN."""
+    w = max(1, int(window_ms // step_ms))
+    stride = max(1, -(-len(grid) // MAX_SERIES_POINTS))
+    out = {'ts': grid[::stride].tolist(), 'window_ms': int(window_ms)}
+    for name, v in zip(COLUMNS, values):
+        ok = ~np.isnan(v)
+        x = np.where(ok, v, 0.0)
+        c, s, q = (np.r_[0, np.cumsum(a)] for a in (ok, x, x * x))
+        hi = np.arange(1, len(v) + 1)
+        lo = np.maximum(hi - w, 0)
+        n = c[hi] - c[lo]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = (s[hi] - s[lo]) / n
+            std = np.sqrt(np.maximum((q[hi] - q[lo]) / n - mean * mean, 0))
+        sparse = n < max(1, w // 2)
+        mean[sparse] = std[sparse] = np.nan
+        out[name] = {'mean': _json(mean[::stride]), 'std': _json(std[::stride])}
+    return out
+
+
+def correlation(values) -> dict:
+    """Pearson correlation of every channel pair over the grid points where both are present."""
+    out = {'matrix': {}, 'n': {}}
+    for i, a in enumerate(COLUMNS):
+        out['matrix'][a], out['n'][a] = {}, {}
+        for j, b in enumerate(COLUMNS):
+            ok = ~np.isnan(values[i]) & ~np.isnan(values[j])
+            x, y = values[i][ok], values[j][ok]
+            r = None
+            if len(x) >= 3 and x.std() > 0 and y.std() > 0:
+                r = round(float(np.corrcoef(x, y)[0, 1]), 4)
+            out['matrix'][a][b], out['n'][a][b] = r, int(ok.sum())
+    return out
+
+
+def watering_events(device_id, start_ms, end_ms) -> list:
+    """[(on_ms, off_ms), ...] ascending from successful pump on/off control logs in range
+    (off_ms is None for a run that has not been switched off yet)."""
+    logs = db.query_control_logs_range(device_id=device_id, start=start_ms, end=end_ms, actuator='pump', limit=5000)
+    events = []
+    for log in sorted((r for r in logs if r['success'] and r['created_ms'] is not None), key=lambda r: r['created_ms']):
+        if log['action'] == 'on':
+            events.append([log['created_ms'], None])
+        elif log['action'] == 'off' and events and events[-1][1] is None:
+            events[-1][1] = log['created_ms']
+    return [tuple(e) for e in events]
+
+
+def drying(grid, values, events, settle_ms: int, horizon_ms: int) -> dict:
+    """Linear soil-moisture trend after each watering: from `settle_ms` after the pump stops
+    until the next watering or `horizon_ms`, whichever comes first. Least-squares sums for
+    all segments come from one cumulative pass (segments are disjoint and ascending)."""
+    soil = values[COLUMNS.index('soil')]
+    ok = ~np.isnan(soil)
+    ends = [off for _, off in events if off is not None]
+    starts = np.array([off + settle_ms for off in ends], dtype=np.int64)
+    nexts = np.array([min((on for on, _ in events if on > off), default=grid[-1] + 1 if len(grid) else off) for off in ends],
+                     dtype=np.int64)
+    stops = np.minimum(nexts, starts + horizon_ms)
+    lo = np.searchsorted(grid, starts, 'left')
+    hi = np.searchsorted(grid, stops, 'left')
+    # hours since the grid start keep the squared sums well within float64 precision
+    x = np.where(ok, (grid - (grid[0] if len(grid) else 0)) / 3600000.0, 0.0)
+    y = np.where(ok, soil, 0.0)
+    c, sx, sy, sxx, sxy, syy = (np.r_[0, np.cumsum(a)] for a in (ok, x, y, x * x, x * y, y * y))
+    n = c[hi] - c[lo]
+    mx = sx[hi] - sx[lo]
+    my = sy[hi] - sy[lo]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        vxx = (sxx[hi] - sxx[lo]) - mx * mx / n
+        vxy = (sxy[hi] - sxy[lo]) - mx * my / n
+        vyy = (syy[hi] - syy[lo]) - my * my / n
+        slope = vxy / vxx
+        r2 = np.where(vyy > 0, vxy * vxy / (vxx * vyy), np.nan)
+    segments = []
+    for k in range(len(ends)):
+        if n[k] < 3 or not vxx[k] > 0:
+            continue
+        seg = soil[lo[k]:hi[k]]
+        seg = seg[~np.isnan(seg)]
+        segments.append({'watered_ms': int(ends[k]), 'start_ms': int(starts[k]), 'end_ms': int(stops[k]), 'n': int(n[k]),
+                         'slope_per_h': round(float(slope[k]), 4), 'r2': _json([r2[k]])[0],
+                         'soil_start': float(seg[0]), 'soil_end': float(seg[-1])})
+    slopes = np.array([s['slope_per_h'] for s in segments])
+    return {'events': len(events), 'segments': segments, 'settle_ms': int(settle_ms), 'horizon_ms': int(horizon_ms),
+            'median_slope_per_h': round(float(np.median(slopes)), 4) if len(slopes) else None}
+
+
+def _edge_ms(device_id, start_ms, end_ms, newest: bool):
+    """Timestamp of the oldest / newest row in range (None if there is none)."""
+    if newest:
+        rows = db.query_sensor_history(device_id=device_id, start=start_ms, end=end_ms, limit=1)
+        return rows[0]['ts_ms'] if rows else None
+    return next((r[0] for r in db.iter_sensor_rows(device_id=device_id, start=start_ms, end=end_ms, chunk_size=1)), None)
+
+
+def _compute(metric, device_id, start_ms, end_ms, step_ms, gap_ms, params) -> dict:
+    if start_ms is None:
+        start_ms = _edge_ms(device_id, None, end_ms, newest=False)
+        start_ms = db.now_ms() if start_ms is None else start_ms
+    if end_ms is None:
+        # open-ended ranges stop at the newest row
+        end_ms = _edge_ms(device_id, start_ms, None, newest=True)
+        end_ms = start_ms if end_ms is None else max(start_ms, end_ms)
+    step_ms = max(int(step_ms), -(-(end_ms - start_ms + 1) // MAX_GRID))
+    grid, grid_values, rows = resample(db_chunks(device_id, start_ms - gap_ms, end_ms), start_ms, end_ms, step_ms, gap_ms)
+    out = {'metric': metric, 'device_id': device_id, 'start_ms': start_ms, 'end_ms': end_ms, 'step_ms': step_ms,
+           'rows': rows}
+    if metric == 'profile':
+        out.update(profile(grid, grid_values, params.get('tz_offset_ms', 0)))
+    elif metric == 'rolling':
+        out.update(rolling(grid, grid_values, params.get('window_ms', 3600000), step_ms))
+    elif metric == 'correlation':
+        out.update(correlation(grid_values))
+    elif metric == 'drying':
+        events = watering_events(device_id, start_ms, end_ms)
+        out.update(drying(grid, grid_values, events, params.get('settle_ms', 600000), params.get('horizon_ms', 172800000)))
+    else:
+        raise ValueError(f'unknown metric {metric!r}')
+    return out
+
+
+def _token(metric, device_id, start_ms, end_ms, gap_ms) -> str:
+    """Cache validator: the range revision of a closed range, else 'live' + the revision key
+    (which still changes on late writes and pruning) for a time-limited entry."""
+    kinds = ('sensor', 'control') if metric == 'drying' else ('sensor',)
+    # rows up to gap_ms before the range hold into it
+    lo = None if start_ms is None else start_ms - gap_ms
+    tokens = [db.range_token(kind, device_id, lo, end_ms) for kind in kinds]
+    if None in tokens:
+        return 'live/' + '/'.join(db.change_token(kind, device_id)[1] for kind in kinds)
+    return '/'.join(tokens)
+
+
+def analyze(metric: str, device_id: int, start_ms=None, end_ms=None, step_ms: int = 60000, gap_ms: int = 90000, **params) -> dict:
+    """Compute `metric` (one of METRICS) for a device over [start_ms, end_ms] (open ends: first /
+    newest row). Cached (see the module docstring); the result has 'cached': True on a hit."""
+    if metric not in METRICS:
+        raise ValueError(f'unknown metric {metric!r}')
+    key = (metric, device_id, start_ms, end_ms, step_ms, gap_ms, tuple(sorted(params.items())))
+    token = _token(metric, device_id, start_ms, end_ms, gap_ms)
+    now = time.monotonic()
+    with _cache_lock:
+        hit = _cache.get(key)
+        if hit is not None and hit[0] == token and (hit[1] is None or now < hit[1]):
+            _cache.move_to_end(key)
+            return {**hit[2], 'cached': True}
+    result = _compute(metric, device_id, start_ms, end_ms, step_ms, gap_ms, params)
+    expires = now + LIVE_TTL_S if token.startswith('live') else None
+    with _cache_lock:
+        _cache[key] = (token, expires, result)
+        _cache.move_to_end(key)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return {**result, 'cached': False}
+
+
+def cache_stats() -> dict:
+    with _cache_lock:
+        return {'entries': len(_cache), 'size': CACHE_SIZE}
@@ -4,41 +4,98 @@ import serial
 import json
 import threading
 import time
+STARTUP_T0 = time.perf_counter()
 import io, csv
+import gzip, zlib
+import atexit, signal, sys
 from datetime import datetime
-from flask import Flask, jsonify, render_template, request, Response, url_for
+from flask import Flask, jsonify, render_template, request, Response, url_for, stream_with_context
 from flask_cors import CORS
 import os
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
 from werkzeug.security import generate_password_hash, check_password_hash
 
-# --- 视觉处理库保持不变 ---
-import cv2
-import numpy as np
+# --- 启动计时: 每个阶段的耗时打印到日志, 便于排查 systemctl restart 慢的原因 ---
+startup_timings = {}
+_startup_mark = [STARTUP_T0]
+def startup_phase(name, since=None):
+    """记录一个启动阶段的耗时 (毫秒)。since 为空时从上一阶段结束算起; 后台阶段传入自己的起点。"""
+    now = time.perf_counter()
+    startup_timings[name] = round((now - (since if since is not None else _startup_mark[0])) * 1000, 1)
+    if since is None: _startup_mark[0] = now
+    print(f"⏱ 启动阶段 {name}: {startup_timings[name]} ms (进程启动后 {(now - STARTUP_T0) * 1000:.0f} ms)")
 
-# --- 摄像头相关代码 ---
+# --- 视觉处理库 (cv2/numpy) 与摄像头: 导入和初始化都很慢, 改为首次使用时或启动后在后台线程中进行 ---
+# FAST_START=0 时恢复为先初始化摄像头再启动各线程
+FAST_START = os.environ.get('FAST_START', '1') in ('1','true','TRUE')
 PI_CAMERA_AVAILABLE = False
 picam2 = None # 全局摄像头对象
-try:
-    from picamera2 import Picamera2
-    picam2 = Picamera2()
-    PI_CAMERA_AVAILABLE = True
-    print("✅ picamera2 库加载成功，摄像头对象已创建。")
-except Exception as e:
-    print(f"⚠️ 警告: picamera2 初始化失败: {e}。拍照/视觉功能将不可用。")
+camera_state = "pending"  # pending / initializing / ready / unavailable
+camera_lock = threading.Lock()
+def init_camera():
+    """导入 picamera2 并配置、启动摄像头; 失败时拍照/视觉接口返回 503。只执行一次。"""
+    global picam2, PI_CAMERA_AVAILABLE, camera_state
+    with camera_lock:
+        if camera_state != "pending": return
+        camera_state = "initializing"
+        t0 = time.perf_counter()
+        try:
+            from picamera2 import Picamera2
+            cam = Picamera2()
+            cam.configure(cam.create_still_configuration())
+            cam.start()
+            picam2, PI_CAMERA_AVAILABLE, camera_state = cam, True, "ready"
+            print("✅ 摄像头已成功启动并准备就绪。")
+        except Exception as e:
+            camera_state = "unavailable"
+            print(f"⚠️ 警告: picamera2 初始化失败: {e}。拍照/视觉功能将不可用。")
+        startup_phase('camera', since=t0)
+def init_vision():
+    """后台预热: 先初始化摄像头, 再导入 cv2, 使第一次视觉分析请求不必等待。"""
+    init_camera()
+    t0 = time.perf_counter()
+    try: import cv2  # noqa: F401
+    except Exception as e: print(f"⚠️ 警告: OpenCV 导入失败: {e}。视觉分析将不可用。")
+    startup_phase('vision import', since=t0)
+def camera_unavailable():
+    """摄像头不可用时返回 503 响应, 否则 None。未经 __main__ 启动 (没有后台预热) 时在首次使用时初始化。"""
+    if camera_state == "pending": init_camera()
+    if PI_CAMERA_AVAILABLE and picam2: return None
+    if camera_state == "initializing":
+        return jsonify({"status": "error", "message": "摄像头正在初始化, 请稍后重试。"}), 503
+    return jsonify({"status": "error", "message": "摄像头模块不可用或未初始化。"}), 503
 
 # 数据库集成
 try:
     from . import db as db
 except Exception:
     import db
+try:
+    from . import hotwindow
+    from . import downsample
+    from . import analytics
+    from . import streamstats
+    from . import rules
+except Exception:
+    import hotwindow
+    import downsample
+    import analytics
+    import streamstats
+    import rules
+
+startup_phase('imports')
 
 # --- 全局变量 ---
 data_lock = threading.Lock()
 # --- 修改点: 增加 gesture 字段 ---
 latest_data = { "temperature": None, "humidity": None, "lux": None, "soil": None, "gesture": None, "timestamp": None }
+# 固件上报的启动耗时 (ttff_ms: 复位到第一帧数据, ready_ms: 全部传感器预热完成)
+device_boot_info = {}
+# 固件最近一次确认的采样间隔 ({"config": {...}} 回复帧)
+device_sampling_reported = {}
 db.create_tables()
 DB_DEVICE_ID = db.ensure_default_device()
+startup_phase('database')
 serial_lock = threading.Lock()
 SECRET_KEY = os.environ.get('SECRET_KEY', 'saffron-secret')
 TOKEN_MAX_AGE = int(os.environ.get('TOKEN_MAX_AGE', str(7*24*3600)))
@@ -47,6 +104,63 @@ REQUIRE_ADMIN_FOR_CONTROL = os.environ.get('REQUIRE_ADMIN_FOR_CONTROL', '0') in
 ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', 'saffron-admin')
 ser = None
 auto_irrigation_state = { "watering": False, "last_start_ts": None, "last_end_ts": None }
+# 批量写入: 单次请求最大条数, 以及各字段的合法范围 (同时兼容固件的简写键名)
+BATCH_MAX_ROWS = int(os.environ.get('BATCH_MAX_ROWS', '20000'))
+BATCH_FIELDS = (('temperature', 'temp', -40, 85), ('humidity', 'humi', 0, 100), ('lux', 'lux', 0, 200000), ('soil', 'soil', 0, 100))
+# 各通道允许的采样间隔 (毫秒); DHT11 物理上限约 1Hz
+SAMPLING_LIMITS = {'dht_ms': (1000, 3600000), 'lux_ms': (120, 3600000), 'soil_ms': (100, 3600000)}
+# 变化上报 (report-on-change): 与上次入库值相差超过死区, 或距上次入库超过心跳时间才写一行
+DEADBAND_DEFAULTS = {'temp_db': 0.0, 'humi_db': 0.0, 'lux_db': 5.0, 'soil_db': 0.0}
+DEADBAND_LIMITS = {'temp_db': 10, 'humi_db': 20, 'lux_db': 10000, 'soil_db': 20}
+HEARTBEAT_DEFAULT_S = int(os.environ.get('HEARTBEAT_S', '60'))
+HEARTBEAT_LIMITS = (5, 3600)
+# 冷数据分层: 超过 SENSOR_HOT_HOURS 的整小时原始数据压缩成 sensor_blocks, 每 COMPACT_INTERVAL 秒检查一次
+SENSOR_HOT_HOURS = int(os.environ.get('SENSOR_HOT_HOURS', '24'))
+COMPACT_INTERVAL = int(os.environ.get('COMPACT_INTERVAL', '300'))
+# 数据保留天数 (0 表示永久保留): 原始行 / 压缩小时块 / 控制日志 / 异常标记; 每 PRUNE_INTERVAL 秒清理一次
+RETENTION_DAYS = {'sensor_data': int(os.environ.get('RETENTION_SENSOR_DAYS', '30')),
+                  'sensor_blocks': int(os.environ.get('RETENTION_BLOCK_DAYS', '365')),
+                  'control_logs': int(os.environ.get('RETENTION_CONTROL_DAYS', '365')),
+                  'anomalies': int(os.environ.get('RETENTION_ANOMALY_DAYS', '180'))}
+PRUNE_INTERVAL = int(os.environ.get('PRUNE_INTERVAL', '3600'))
+# 增量回收空闲页只在夜间低峰 (本地时间 VACUUM_HOURS, 如 "1-5") 进行, 每步页数有限并让出数据库锁
+VACUUM_HOURS = tuple(int(h) for h in os.environ.get('VACUUM_HOURS', '1-5').split('-'))
+VACUUM_MAX_PAGES = int(os.environ.get('VACUUM_MAX_PAGES', '256'))
+# 在线备份: 每 BACKUP_INTERVAL_HOURS 小时一个快照 (0 为关闭), 保留最新 BACKUP_KEEP 个;
+# 每步复制 BACKUP_PAGES 页后释放数据库锁休眠 BACKUP_SLEEP 秒, 采集与页面不受影响
+BACKUP_INTERVAL_HOURS = float(os.environ.get('BACKUP_INTERVAL_HOURS', '24'))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', '7'))
+BACKUP_COMPRESS = os.environ.get('BACKUP_COMPRESS', '1') in ('1','true','TRUE')
+BACKUP_PAGES = int(os.environ.get('BACKUP_PAGES', '256'))
+BACKUP_SLEEP = float(os.environ.get('BACKUP_SLEEP', '0.05'))
+# 设备 last_seen 在内存中随每帧更新, 每 LAST_SEEN_FLUSH_S 秒 (以及备份前、退出时) 才写回 devices 表
+LAST_SEEN_FLUSH_S = float(os.environ.get('LAST_SEEN_FLUSH_S', '60'))
+# 最近 HOT_WINDOW_HOURS 小时的读数常驻内存 (每设备一个预分配的 NumPy 环形缓冲, 最多 HOT_WINDOW_ROWS 行,
+# 最多 HOT_WINDOW_DEVICES 个设备, 每行 48 字节); 落在窗口内的历史查询不访问数据库
+HOT_WINDOW_HOURS = float(os.environ.get('HOT_WINDOW_HOURS', '6'))
+HOT_WINDOW_ROWS = int(os.environ.get('HOT_WINDOW_ROWS', '20000'))
+HOT_WINDOW_DEVICES = int(os.environ.get('HOT_WINDOW_DEVICES', '4'))
+hot_window = hotwindow.HotWindow(HOT_WINDOW_HOURS, HOT_WINDOW_ROWS, HOT_WINDOW_DEVICES)
+# 入库时按设备/通道增量维护的统计量 (EWMA 均值方差、滑动窗口极值、连续不变计数) 与异常标记:
+# z 分数超过 STATS_Z、数值连续 STATS_STUCK_S 秒不变 (DHT11 卡死)、土壤湿度相对慢基线漂移、DHT 切换到模拟驱动
+STATS_STUCK_S = {k: float(v) for k, v in (item.split('=') for item in os.environ.get('STATS_STUCK_S', 'temperature=1800,humidity=1800').split(',') if item)}
+STATS_SOIL_SETTLE_S = int(os.environ.get('STATS_SOIL_SETTLE_S', '900'))
+stream_stats = streamstats.StreamStats(
+    tau_s=float(os.environ.get('STATS_TAU_S', '600')), drift_tau_s=float(os.environ.get('STATS_DRIFT_TAU_S', '21600')),
+    window_s=float(os.environ.get('STATS_WINDOW_S', '3600')), z_threshold=float(os.environ.get('STATS_Z', '4')),
+    drift_z=float(os.environ.get('STATS_DRIFT_Z', '3')), cooldown_s=float(os.environ.get('STATS_COOLDOWN_S', '300')),
+    stuck_s=STATS_STUCK_S)
+# 执行器规则 (control_rules 表 + 灌溉策略) 在变更时编译一次; 每帧只重算读取了变化通道的规则,
+# 定时器 (浇水时长、冷却) 和时间窗口每 RULE_TICK_S 秒检查一次; 时间窗口按本机本地时间
+RULE_TICK_S = float(os.environ.get('RULE_TICK_S', '1'))
+rule_engine = rules.RuleEngine()
+# 分析接口未给开始时间时默认最近 ANALYTICS_DEFAULT_DAYS 天 (按整点取整, 便于结果缓存命中)
+ANALYTICS_DEFAULT_DAYS = float(os.environ.get('ANALYTICS_DEFAULT_DAYS', '7'))
+# JSON/CSV 响应超过 COMPRESS_MIN_BYTES 字节时按 Accept-Encoding 压缩 (gzip 优先, 其次 deflate)
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', '1024'))
+COMPRESS_LEVEL = int(os.environ.get('COMPRESS_LEVEL', '6'))
+COMPRESS_MIMETYPES = ('application/json', 'text/csv')
+report_filter = {"deadband": tuple(DEADBAND_DEFAULTS.values()), "heartbeat_s": HEARTBEAT_DEFAULT_S, "last": None, "last_time": 0.0}
 
 # 摄像头照片及分析结果保存目录
 CAPTURES_DIR = os.path.join(os.path.dirname(__file__), 'static', 'captures')
@@ -94,6 +208,181 @@ def admin_required(fn):
         return fn(*args, **kwargs)
     wrapper.__name__ = fn.__name__
     return wrapper
+def parse_reading_ts(value):
+    """把读数时间统一为 UTC epoch 毫秒; 支持 'YYYY-MM-DD HH:MM:SS'、ISO-8601 以及 epoch 秒/毫秒。"""
+    return db.to_epoch_ms(value)
+def parse_range_args(args):
+    """从查询参数解析 start/end 为 epoch 毫秒 (兼容 'YYYY-MM-DD'、'YYYY-MM-DD HH:MM:SS'、ISO-8601、epoch 秒/毫秒)。
+    end 按自身精度取闭区间 (日期到当天最后一毫秒), 与原来的字符串比较语义一致; 格式错误抛 ValueError。"""
+    start, end = args.get('start') or None, args.get('end') or None
+    start_ms = db.to_epoch_ms(start) if start else None
+    end_ms = db.to_epoch_ms(end, inclusive_end=True) if end else None
+    if (start and start_ms is None) or (end and end_ms is None): raise ValueError('invalid start/end')
+    return start_ms, end_ms
+def parse_since_args(args):
+    """增量轮询参数: since_ts (epoch 毫秒或任意 start 支持的格式) 与 since_id; 都没有时返回 (None, None)。"""
+    since_ts, since_id = args.get('since_ts') or None, args.get('since_id') or None
+    ts = db.to_epoch_ms(since_ts) if since_ts else None
+    if since_ts and ts is None: raise ValueError('invalid since_ts')
+    return ts, int(since_id) if since_id else None
+def delta_response(kind, device_id, since):
+    """条件请求: ETag 未变时返回 304; 客户端的 ETag 属于旧的 rev (补传/清理改写了已下发的历史) 时要求全量重载。
+    返回 (304 响应或 None, etag, reset)。"""
+    etag, rev_key = db.change_token(kind, device_id)
+    # 弱校验: 同一版本的数据不论 gzip/deflate/不压缩、行式/列式都用同一个 ETag
+    if request.if_none_match.contains_weak(etag):
+        resp = Response(status=304); resp.set_etag(etag, weak=True); return resp, etag, False
+    client = request.if_none_match.as_set(include_weak=True)
+    reset = since != (None, None) and bool(client) and not any(t.startswith(rev_key + '-') for t in client)
+    return None, etag, reset
+def newer_than(rows, since, ms_key):
+    since_ts, since_id = since
+    return [r for r in rows if r.get('id') is not None
+            and (since_ts is None or (r[ms_key], r['id']) > (since_ts, since_id or 0))
+            and (since_id is None or since_ts is not None or r['id'] > since_id)]
+def high_water(rows, since, ms_key):
+    real = [r for r in rows if r.get('id') is not None]
+    if not real: return {"ts_ms": since[0], "id": since[1]}
+    newest = max(real, key=lambda r: (r[ms_key] or 0, r['id']))
+    return {"ts_ms": newest[ms_key], "id": newest['id']}
+def columnar(rows, ms_key, text_key):
+    """format=columnar: 每个字段一个并行数组, 不再逐行重复键名; 时间只保留 epoch 毫秒并做差分
+    (第一个非空值为绝对值, 之后为与前一个非空值的差, 行按时间倒序时差为负), 文本时间由客户端自行格式化。"""
+    keys = []
+    for r in rows:
+        keys.extend(k for k in r if k not in keys and k not in (ms_key, text_key))
+    deltas, prev = [], None
+    for r in rows:
+        ts = r.get(ms_key)
+        deltas.append(None if ts is None else ts if prev is None else ts - prev)
+        if ts is not None: prev = ts
+    return {"fields": keys, "columns": {k: [r.get(k) for r in rows] for k in keys}, "ts_key": ms_key, "ts_delta": deltas}
+def row_items(rows, ms_key, text_key):
+    """按 format 参数组织列表型响应的 items 部分 (默认行式)。"""
+    if request.args.get('format') == 'columnar':
+        return {"format": "columnar", **columnar(rows, ms_key, text_key), "count": len(rows)}
+    return {"items": rows, "count": len(rows)}
+def record_stats(device_id, ts_ms, readings):
+    """把一帧读数计入流式统计, 产生的异常标记写入 anomalies 表。"""
+    flags = stream_stats.update(device_id, ts_ms, readings)
+    if flags:
+        db.insert_anomalies(flags)
+        for f in flags: print(f"异常: 设备 {f['device_id']} {f['channel']} {f['kind']} ({f['detail']})")
+def note_pump(action, success):
+    """浇水期间 (最长 1 小时) 以及停泵后 STATS_SOIL_SETTLE_S 秒内土壤湿度的阶跃是预期的, 不报异常。"""
+    if not success: return
+    if action == 'on': stream_stats.expect_step(DB_DEVICE_ID, 'soil', db.now_ms() + 3600000)
+    elif action == 'off': stream_stats.expect_step(DB_DEVICE_ID, 'soil', db.now_ms() + STATS_SOIL_SETTLE_S * 1000)
+def send_command(actuator, action):
+    """经串口下发执行器命令并写控制日志, 返回是否发送成功。"""
+    command = json.dumps({"actuator": actuator, "action": action})
+    success = False
+    with serial_lock:
+        if ser and ser.is_open:
+            try:
+                ser.write((command + "\n").encode('utf-8')); success = True
+            except Exception as e: print(f"串口写入错误: {e}")
+    try: db.insert_control_log(DB_DEVICE_ID, actuator, action, command, success)
+    except Exception: pass
+    if actuator == 'pump': note_pump(action, success)
+    return success
+def execute_rule_actions(actions):
+    """执行规则引擎返回的动作; 启动动作发送失败时 (串口未连接) 规则稍后重试。只有本机串口设备可以驱动。"""
+    for a in actions:
+        success = a['device_id'] == DB_DEVICE_ID and send_command(a['actuator'], a['action'])
+        print(f"规则 {a['rule']} {a['name']}: {a['actuator']} {a['action']} ({a['reason']}) {'成功' if success else '失败'}")
+        if a['start'] and not success: rule_engine.abort(a['rule'], db.now_ms())
+        if a['rule'].startswith('irrigation:'):
+            now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+            if a['start']:
+                if success: auto_irrigation_state["watering"] = True; auto_irrigation_state["last_start_ts"] = now
+            else:
+                if success: auto_irrigation_state["last_end_ts"] = now
+                auto_irrigation_state["watering"] = False
+def reload_rules():
+    """从数据库重新编译规则和灌溉策略 (启动时以及每次修改后调用); 被删除或修改的规则若正在执行会先恢复执行器。"""
+    try: execute_rule_actions(rule_engine.load(db.list_rules(), db.list_irrigation_policies(), db.now_ms()))
+    except Exception as e: print(f"规则加载失败: {e}")
+def validate_batch_readings(readings):
+    """批量校验读数, 返回 (rows, errors); rows 为 insert_sensor_data_batch 所需的元组列表。"""
+    rows, errors = [], []
+    latest_ok = db.now_ms() + 300 * 1000
+    for i, r in enumerate(readings):
+        if not isinstance(r, dict):
+            errors.append({"index": i, "error": "reading must be an object"}); continue
+        ts = parse_reading_ts(r.get('timestamp', r.get('ts')))
+        if ts is None:
+            errors.append({"index": i, "error": "invalid timestamp"}); continue
+        if ts > latest_ok:
+            errors.append({"index": i, "error": "timestamp in the future"}); continue
+        values, bad = [], None
+        for name, alias, lo, hi in BATCH_FIELDS:
+            v = r.get(name, r.get(alias))
+            if v is not None and (isinstance(v, bool) or not isinstance(v, (int, float)) or not lo <= v <= hi):
+                bad = name; break
+            values.append(v)
+        if bad:
+            errors.append({"index": i, "error": f"invalid {bad}"}); continue
+        if all(v is None for v in values):
+            errors.append({"index": i, "error": "no sensor values"}); continue
+        rows.append((*values, ts))
+    return rows, errors
+def request_backlog():
+    """请求固件补传离线期间缓存的样本。"""
+    with serial_lock:
+        if ser and ser.is_open:
+            try: ser.write((json.dumps({"sync": "backlog"}) + '\n').encode('utf-8'))
+            except Exception as e: print(f"串口写入错误: {e}")
+def sampling_settings(device_id=None):
+    """数据库中的采样配置与默认死区/心跳合并后的结果。"""
+    row = db.get_sampling_config(DB_DEVICE_ID if device_id is None else device_id) or {}
+    deadband = {k: (row.get(k) if row.get(k) is not None else v) for k, v in DEADBAND_DEFAULTS.items()}
+    heartbeat_s = row.get('heartbeat_s') or HEARTBEAT_DEFAULT_S
+    return row, deadband, heartbeat_s
+def load_report_filter():
+    """从数据库刷新入库端的死区与心跳配置。"""
+    _, deadband, heartbeat_s = sampling_settings()
+    with data_lock:
+        report_filter['deadband'] = tuple(deadband[k] for k in DEADBAND_DEFAULTS)
+        report_filter['heartbeat_s'] = heartbeat_s
+def should_store(row, now):
+    """变化超过死区或心跳到期时返回 True 并记为最近一次入库值; 调用方持有 data_lock。"""
+    last = report_filter['last']
+    store = last is None or now - report_filter['last_time'] >= report_filter['heartbeat_s']
+    if not store:
+        for v, prev, band in zip(row, last, report_filter['deadband']):
+            if (v is None) != (prev is None) or (v is not None and abs(v - prev) > band): store = True; break
+    if store: report_filter['last'] = row; report_filter['last_time'] = now
+    return store
+def send_sampling_config(device_id=None):
+    """把数据库里保存的采样间隔、死区与心跳下发给固件; 没有配置的间隔保持固件当前值。"""
+    row, deadband, heartbeat_s = sampling_settings(device_id)
+    cfg = {k: row[k] for k in db.SAMPLING_CHANNELS if row.get(k) is not None}
+    cfg['deadband'] = {k[:-3]: v for k, v in deadband.items()}
+    cfg['heartbeat_ms'] = heartbeat_s * 1000
+    with serial_lock:
+        if ser and ser.is_open:
+            try: ser.write((json.dumps({"config": cfg}) + '\n').encode('utf-8'))
+            except Exception as e: print(f"串口写入错误: {e}")
+def handle_backlog_frame(data):
+    """处理固件的离线补传帧: 按 age(秒) 还原原始采样时间后批量入库。"""
+    if 'backlog_pending' in data:
+        if data.get('backlog_pending'): request_backlog()
+        return
+    if 'backlog_done' in data:
+        print(f"后台线程: 离线数据补传完成, 共 {data.get('backlog_done')} 条, 缓冲区溢出丢弃 {data.get('dropped', 0)} 条")
+        return
+    now = time.time()
+    rows = []
+    for rec in data.get('backlog') or []:
+        try: age, temp, humi, lux, soil = rec
+        except (TypeError, ValueError): continue
+        ts = parse_reading_ts(now - age) if isinstance(age, (int, float)) else None
+        if ts is not None: rows.append((temp, humi, lux, soil, ts))
+    if rows:
+        try:
+            if db.insert_sensor_data_batch(DB_DEVICE_ID, rows)[0]: hot_window.invalidate(DB_DEVICE_ID)
+        except Exception as e: print(f"后台线程: 补传数据入库失败 - {e}")
 def serial_reader():
     """后台线程，负责读取串口数据并更新 latest_data。"""
     global latest_data, ser
@@ -104,92 +393,147 @@ def serial_reader():
             with serial_lock:
                 ser = serial.Serial(serial_port, baud_rate, timeout=2)
             print(f"后台线程: 成功连接到串口 {serial_port}")
+            request_backlog()
+            send_sampling_config()
             while True:
                 line = ser.readline()
                 if line:
                     try:
                         decoded_line = line.decode('utf-8').strip()
-                        if 'temp' in decoded_line:
+                        if decoded_line.startswith('{"backlog'):
+                            handle_backlog_frame(json.loads(decoded_line))
+                        elif decoded_line.startswith('{"health"'):
+                            health = json.loads(decoded_line).get('health') or {}
+                            try: db.upsert_device_health(DB_DEVICE_ID, json.dumps(health))
+                            except Exception as e: print(f"后台线程: 健康数据入库失败 - {e}")
+                            # DHT 连续读取失败后固件会切换到模拟驱动, 此时温湿度不是真实读数
+                            dht = (health.get('sensors') or {}).get('dht') or {}
+                            if 'driver_mode' in dht:
+                                try: db.insert_anomalies(stream_stats.note_driver(DB_DEVICE_ID, 'dht', dht['driver_mode'], db.now_ms()))
+                                except Exception as e: print(f"后台线程: 异常标记入库失败 - {e}")
+                        elif decoded_line.startswith('{"boot"'):
+                            boot = json.loads(decoded_line).get('boot') or {}
+                            if 'ttff_ms' in boot: device_boot_info.clear()
+                            device_boot_info.update(boot)
+                            device_boot_info['reported_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                            print(f"后台线程: MCU 启动耗时 {boot}")
+                        elif decoded_line.startswith('{"config"'):
+                            device_sampling_reported.clear()
+                            device_sampling_reported.update(json.loads(decoded_line).get('config') or {})
+                            device_sampling_reported['reported_at'] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                        elif '"cycle"' in decoded_line or 'temp' in decoded_line:
+                            # 各通道按自己的采样间隔上报, 一帧只带新采到的通道; 其余通道沿用最近值
                             data = json.loads(decoded_line)
-                            ts = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+                            ts_ms = db.now_ms(); ts = db.ms_to_text(ts_ms)
+                            fresh = any(k in data for k in ('temp', 'humi', 'lux', 'soil'))
                             with data_lock:
-                                latest_data['temperature'] = data.get('temp')
-                                latest_data['humidity'] = data.get('humi')
-                                latest_data['lux'] = data.get('lux')
-                                latest_data['soil'] = data.get('soil')
+                                for key, field in (('temp', 'temperature'), ('humi', 'humidity'), ('lux', 'lux'), ('soil', 'soil')):
+                                    if key in data: latest_data[field] = data[key]
                                 # --- 修改点: 增加手势数据更新 ---
                                 latest_data['gesture'] = data.get('gesture')
-                                latest_data['timestamp'] = ts
+                                if fresh: latest_data['timestamp'] = ts
+                                row = (latest_data['temperature'], latest_data['humidity'], latest_data['lux'], latest_data['soil'])
+                                store = fresh and should_store(row, time.time())
+                            readings = {field: data[key] for key, field in (('temp', 'temperature'), ('humi', 'humidity'), ('lux', 'lux'), ('soil', 'soil')) if key in data}
                             try:
                                 # 注意: sensor_data 表没有 gesture 字段, 这里不存入数据库
-                                db.insert_sensor_data(DB_DEVICE_ID, data.get('temp'), data.get('humi'), data.get('lux'), data.get('soil'), ts)
-                                db.update_device_last_seen(DB_DEVICE_ID)
+                                if store: hot_window.append(DB_DEVICE_ID, db.insert_sensor_data(DB_DEVICE_ID, *row, ts_ms), ts_ms, *row)
+                                db.touch_device(DB_DEVICE_ID, ts_ms)
+                                record_stats(DB_DEVICE_ID, ts_ms, readings)
                             except Exception: pass
+                            try: execute_rule_actions(rule_engine.on_sample(DB_DEVICE_ID, ts_ms, readings))
+                            except Exception as e: print(f"后台线程: 规则执行失败 - {e}")
                     except (UnicodeDecodeError, json.JSONDecodeError, KeyError): pass
         except serial.SerialException as e:
             print(f"后台线程: 串口错误 - {e}. 5秒后重试...")
             time.sleep(5)
-def irrigation_worker():
-    global ser
-    POLL_INTERVAL = 5
+def rule_ticker():
+    """后台线程: 处理规则定时器 (浇水结束、冷却到期) 和时间窗口; 取代原来每 5 秒查询一次数据库的灌溉线程。"""
+    while True:
+        time.sleep(RULE_TICK_S)
+        try: execute_rule_actions(rule_engine.tick(db.now_ms()))
+        except Exception as e: print(f"后台线程: 规则执行失败 - {e}")
+def data_migrations():
+    """后台线程: 先回填旧数据的 epoch 毫秒列, 再把分区化之前的旧数据搬进按月分区文件, 均为小批量事务。"""
+    try:
+        if db.epoch_backfill_pending(): db.backfill_epoch_ms()
+        if db.legacy_migration_pending(): print(f"后台线程: 已迁移 {db.migrate_legacy_to_partitions()} 条旧数据到月分区")
+    except Exception as e: print(f"后台线程: 数据迁移失败 - {e}")
+
+def sensor_compactor():
+    """后台线程: 把冷数据按小时压缩成块; 每个设备小时一个小事务, 不长时间占用数据库锁。"""
     while True:
         try:
-            policy = db.get_irrigation_policy(DB_DEVICE_ID)
-            if not policy or not policy.get('enabled'):
-                time.sleep(POLL_INTERVAL); continue
-            threshold = policy.get('soil_threshold_min')
-            duration = policy.get('watering_seconds')
-            cooldown = policy.get('cooldown_seconds') or 0
-            if threshold is None or duration is None or duration <= 0:
-                time.sleep(POLL_INTERVAL); continue
-            try: cd = int(cooldown)
-            except Exception: cd = 0
-            if cd > 0 and auto_irrigation_state.get("last_end_ts"):
-                try:
-                    last_end = datetime.strptime(auto_irrigation_state["last_end_ts"], '%Y-%m-%d %H:%M:%S')
-                    if (datetime.utcnow() - last_end).total_seconds() < cd:
-                        time.sleep(POLL_INTERVAL); continue
-                except Exception: pass
-            with data_lock: soil = latest_data.get('soil')
-            if soil is None:
-                time.sleep(POLL_INTERVAL); continue
-            if soil < threshold and not auto_irrigation_state["watering"]:
-                cmd_on = json.dumps({"actuator": "pump", "action": "on"})
-                success_on = False
-                with serial_lock:
-                    if ser and ser.is_open:
-                        try:
-                            ser.write((cmd_on + "\n").encode('utf-8')); success_on = True
-                        except Exception: success_on = False
-                try: db.insert_control_log(DB_DEVICE_ID, "pump", "on", cmd_on, success_on)
-                except Exception: pass
-                if success_on:
-                    auto_irrigation_state["watering"] = True
-                    auto_irrigation_state["last_start_ts"] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                    time.sleep(int(duration))
-                    cmd_off = json.dumps({"actuator": "pump", "action": "off"})
-                    success_off = False
-                    with serial_lock:
-                        if ser and ser.is_open:
-                            try:
-                                ser.write((cmd_off + "\n").encode('utf-8')); success_off = True
-                            except Exception: success_off = False
-                    try: db.insert_control_log(DB_DEVICE_ID, "pump", "off", cmd_off, success_off)
-                    except Exception: pass
-                    if success_off: auto_irrigation_state["last_end_ts"] = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
-                    auto_irrigation_state["watering"] = False
-            time.sleep(POLL_INTERVAL)
-        except Exception: time.sleep(POLL_INTERVAL)
+            while not db.epoch_backfill_pending() and not db.legacy_migration_pending():
+                if not db.compact_sensor_blocks(db.now_ms() - SENSOR_HOT_HOURS * db.HOUR_MS): break
+        except Exception as e: print(f"后台线程: 冷数据压缩失败 - {e}")
+        time.sleep(COMPACT_INTERVAL)
+
+def in_vacuum_window(hour=None):
+    if hour is None: hour = datetime.now().hour
+    lo, hi = VACUUM_HOURS
+    return lo <= hour <= hi if lo <= hi else (hour >= lo or hour <= hi)
+
+def data_pruner():
+    """后台线程: 按保留期小批量删除过期数据 (整月过期直接删分区文件), 低峰时段再增量回收空闲页。"""
+    while True:
+        try:
+            if not db.epoch_backfill_pending() and not db.legacy_migration_pending():
+                result = db.prune_expired(RETENTION_DAYS)
+                if result['partitions'] or any(result['rows'].values()): print(f"后台线程: 已清理过期数据 {result}")
+                db.prune_anomalies(RETENTION_DAYS['anomalies'])
+                if in_vacuum_window(): db.incremental_vacuum(max_pages=VACUUM_MAX_PAGES)
+        except Exception as e: print(f"后台线程: 过期数据清理失败 - {e}")
+        time.sleep(PRUNE_INTERVAL)
+
+def run_backup(compress=None):
+    try: return db.backup_database(pages=BACKUP_PAGES, pause=BACKUP_SLEEP, compress=BACKUP_COMPRESS if compress is None else compress, keep=BACKUP_KEEP)
+    except Exception as e: print(f"后台线程: 数据库备份失败 - {e}")
+
+def last_seen_flusher():
+    """后台线程: 定期把内存中的设备 last_seen 一次性写回数据库 (一个事务), 代替每帧一次 UPDATE+commit。"""
+    while True:
+        time.sleep(LAST_SEEN_FLUSH_S)
+        try: db.flush_last_seen()
+        except Exception as e: print(f"后台线程: last_seen 写回失败 - {e}")
+def flush_on_exit():
+    try: db.flush_last_seen()
+    except Exception as e: print(f"退出时 last_seen 写回失败: {e}")
+def backup_scheduler():
+    """后台线程: 距最新快照超过 BACKUP_INTERVAL_HOURS 时做一次在线备份 (按快照目录名判断, 重启不会重复备份)。"""
+    while True:
+        snapshots = db.list_backups()
+        try: age_h = (datetime.utcnow() - datetime.strptime(snapshots[0]['name'], '%Y%m%d-%H%M%S')).total_seconds() / 3600 if snapshots else None
+        except ValueError: age_h = None
+        if age_h is None or age_h >= BACKUP_INTERVAL_HOURS: run_backup()
+        time.sleep(600)
 
 
 app = Flask(__name__)
 CORS(app)
 
+@app.after_request
+def compress_response(resp):
+    """透明压缩: 大多数载荷是重复的键名和数字, gzip 后通常只剩 1/5~1/10, 弱 Wi-Fi 下打开页面明显更快。
+    流式响应 (parquet 导出) 和已编码的响应不处理。"""
+    if resp.status_code != 200 or resp.direct_passthrough or resp.is_streamed or resp.mimetype not in COMPRESS_MIMETYPES: return resp
+    if 'Content-Encoding' in resp.headers: return resp
+    resp.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(('gzip', 'deflate'))
+    data = resp.get_data()
+    if not encoding or len(data) < COMPRESS_MIN_BYTES: return resp
+    resp.set_data(gzip.compress(data, COMPRESS_LEVEL, mtime=0) if encoding == 'gzip' else zlib.compress(data, COMPRESS_LEVEL))
+    resp.headers['Content-Encoding'] = encoding
+    return resp
+
 def analyze_flower_color(image_path):
     """
     使用OpenCV分析图片中的主要花色, 并返回结果。
     """
     try:
+        # 首次调用时才导入 (启动时在后台预热)
+        import cv2
+        import numpy as np
         image = cv2.imread(image_path)
         # 转换到HSV颜色空间
         hsv_image = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
@@ -263,8 +607,8 @@ def login_page(): return render_template('login.html')
 @app.route('/api/v1/camera/capture', methods=['POST'])
 def capture_photo():
     """处理拍照请求，使用全局摄像头对象。"""
-    if not PI_CAMERA_AVAILABLE or not picam2:
-        return jsonify({"status": "error", "message": "摄像头模块不可用或未初始化。"}), 503
+    unavailable = camera_unavailable()
+    if unavailable: return unavailable
     try:
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         filename = f"saffron_{timestamp}.jpg"
@@ -284,8 +628,8 @@ def capture_photo():
 @app.route('/api/v1/vision/analyze', methods=['POST'])
 def analyze_vision():
     """拍照并进行AI视觉分析"""
-    if not PI_CAMERA_AVAILABLE or not picam2:
-        return jsonify({"status": "error", "message": "摄像头模块不可用或未初始化。"}), 503
+    unavailable = camera_unavailable()
+    if unavailable: return unavailable
 
     try:
         # 1. 拍照
@@ -330,8 +674,8 @@ def control_device():
             except Exception as e: print(f"串口写入错误: {e}")
     try:
         db.insert_control_log(DB_DEVICE_ID, actuator, action, command, success)
-        if success: db.update_device_last_seen(DB_DEVICE_ID)
     except Exception: pass
+    if actuator == 'pump': note_pump(action, success)
     if success: return jsonify({"status": "success", "message": f"Command '{command}' sent."})
     else: return jsonify({"status": "error", "message": "Device not connected or busy."}), 503
 @app.route('/api/v1/auth/register', methods=['POST'])
@@ -368,22 +712,155 @@ def get_latest_sensor_data():
     return jsonify(data_to_return)
 @app.route('/api/v1/sensors/history', methods=['GET'])
 def get_sensor_history():
-    def normalize_start_end(s: str | None, e: str | None):
-        def norm_one(x: str | None, is_start: bool):
-            if not x: return None
-            x = x.strip()
-            if len(x) == 10 and x[4] == '-' and x[7] == '-': return x + (' 00:00:00' if is_start else ' 23:59:59')
-            return x
-        return norm_one(s, True), norm_one(e, False)
-    start, end = normalize_start_end(request.args.get('start'), request.args.get('end'))
+    try: start, end = parse_range_args(request.args)
+    except ValueError: return jsonify({"error": "invalid start/end"}), 400
     try:
         limit = max(1, min(1000, int(request.args.get('limit', '100'))))
         offset = max(0, int(request.args.get('offset', '0')))
     except Exception: return jsonify({"error": "invalid limit/offset"}), 400
     try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
     except Exception: return jsonify({"error": "invalid device_id"}), 400
-    rows = db.query_sensor_history(device_id=device_id, start=start, end=end, limit=limit, offset=offset)
-    return jsonify({"items": rows, "count": len(rows)})
+    try: since = parse_since_args(request.args)
+    except ValueError: return jsonify({"error": "invalid since_ts/since_id"}), 400
+    heartbeat_s = sampling_settings(device_id)[2]
+    # points=N: 对整个时间范围按通道做 LTTB 降采样 (逐块流式读取), 返回 {通道: [[ts_ms, 值], ...]}
+    if request.args.get('points'):
+        try: n_points = int(request.args['points'])
+        except ValueError: n_points = 0
+        if not 10 <= n_points <= 5000: return jsonify({"error": "points must be 10..5000"}), 400
+        not_modified, etag, _ = delta_response('sensor', device_id, (None, None))
+        if not_modified: return not_modified
+        if start is None:
+            # 未给开始时间: 从该设备最早的一行开始
+            rows = db.iter_sensor_rows(device_id)
+            first = next(rows, None); rows.close()
+            start = first[0] if first else db.now_ms()
+        if end is None: end = db.now_ms()
+        hit = hot_window.arrays(device_id, start, end)
+        chunks, source = ([hit], 'memory') if hit is not None else (downsample.db_chunks(device_id, start, end), 'db')
+        result = downsample.lttb(chunks, start, end, n_points)
+        resp = jsonify({**result, "points": n_points, "start_ms": start, "end_ms": end, "heartbeat_s": heartbeat_s, "source": source})
+        resp.set_etag(etag, weak=True)
+        return resp
+    # bucket=秒: 按时间桶聚合 (各通道 平均/最小/最大 与行数), 未给 start 时取内存窗口的时长
+    if request.args.get('bucket'):
+        try: bucket_ms = int(float(request.args['bucket']) * 1000)
+        except ValueError: bucket_ms = 0
+        if not 1000 <= bucket_ms <= 86400000: return jsonify({"error": "bucket must be 1..86400 seconds"}), 400
+        if start is None: start = db.now_ms() - int(HOT_WINDOW_HOURS * 3600000)
+        items, source = hot_window.aggregate(device_id, start, end, bucket_ms), 'memory'
+        if items is None:
+            items, source = hotwindow.aggregate_chunks(downsample.db_chunks(device_id, start, end), bucket_ms, device_id), 'db'
+        items = items[offset:offset + limit]
+        return jsonify({**row_items(items, 'ts_ms', 'timestamp'), "bucket_s": bucket_ms / 1000, "heartbeat_s": heartbeat_s, "source": source})
+    not_modified, etag, reset = delta_response('sensor', device_id, since)
+    if not_modified: return not_modified
+    # since_ts/since_id: 只返回高水位之后的新行 (最多 limit 条, 超出时 truncated, 客户端应全量重载)
+    delta = since != (None, None) and not reset
+    if delta:
+        start, offset = max(start or 0, since[0] or 0) or None, 0
+    # fill=1: 数据按变化入库, 补上区间起点的延续值和终点的保持值, 前端按阶梯线绘制
+    fill = request.args.get('fill') in ('1', 'true') and not delta
+    hit = hot_window.history(device_id, start, end, limit, offset, need_carry=fill)
+    if hit is not None:
+        rows, carry = hit
+        if fill: rows = db.fill_history(rows, device_id, start, end, heartbeat_s * 1000, carry, hold=offset == 0)
+        source = "memory"
+    else:
+        rows = db.query_sensor_history(device_id=device_id, start=start, end=end, limit=limit, offset=offset,
+                                       fill_heartbeat_s=heartbeat_s if fill else None)
+        source = "db"
+    body = {"heartbeat_s": heartbeat_s, "source": source, "hwm": high_water(rows, since, 'ts_ms'), "reset": reset}
+    if delta:
+        body["truncated"] = len(rows) >= limit and len(newer_than(rows, since, 'ts_ms')) == len(rows)
+        rows = newer_than(rows, since, 'ts_ms')
+    resp = jsonify({**row_items(rows, 'ts_ms', 'timestamp'), **body})
+    resp.set_etag(etag, weak=True)
+    return resp
+@app.route('/api/v1/sensors/window', methods=['GET'])
+def get_hot_window_stats():
+    """内存窗口状态: 配置、预留内存与各设备已缓存的行数及覆盖起点。"""
+    return jsonify(hot_window.stats())
+@app.route('/api/v1/sensors/stats', methods=['GET'])
+def get_stream_stats():
+    """入库时增量维护的各通道统计量、驱动状态与最近 24 小时的异常标记 (不扫描 sensor_data)。"""
+    try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    recent = db.query_anomalies(device_id=device_id, start=db.now_ms() - 86400000, limit=20)
+    return jsonify({"device_id": device_id, "config": stream_stats.config(), **(stream_stats.snapshot(device_id).get(str(device_id)) or {"channels": {}, "drivers": {}}),
+                    "recent_anomalies": recent})
+@app.route('/api/v1/sensors/anomalies', methods=['GET'])
+def get_anomalies():
+    try:
+        limit = max(1, min(1000, int(request.args.get('limit', '100'))))
+        offset = max(0, int(request.args.get('offset', '0')))
+    except Exception: return jsonify({"error": "invalid limit/offset"}), 400
+    try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    try: start, end = parse_range_args(request.args)
+    except ValueError: return jsonify({"error": "invalid start/end"}), 400
+    items = db.query_anomalies(device_id=device_id, start=start, end=end, kind=request.args.get('kind'), limit=limit, offset=offset)
+    return jsonify({"items": items, "count": len(items)})
+@app.route('/api/v1/analytics', methods=['GET'])
+def list_analytics():
+    return jsonify({"metrics": list(analytics.METRICS), "cache": analytics.cache_stats()})
+@app.route('/api/v1/analytics/<metric>', methods=['GET'])
+def get_analytics(metric):
+    """区间数据按列载入 NumPy 并重采样到等间隔网格后计算: profile (按本地小时的日变化曲线)、rolling (滑动均值/标准差)、
+    correlation (各通道两两相关系数)、drying (每次浇水后土壤湿度的线性下降速率)。结果按数据版本缓存。"""
+    if metric not in analytics.METRICS: return jsonify({"error": f"unknown metric, expected one of {list(analytics.METRICS)}"}), 404
+    try: start, end = parse_range_args(request.args)
+    except ValueError: return jsonify({"error": "invalid start/end"}), 400
+    try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    try:
+        step_s = float(request.args.get('step', '60'))
+        params = {}
+        if metric == 'profile':
+            local = datetime.now().astimezone().utcoffset().total_seconds() / 60
+            params['tz_offset_ms'] = int(float(request.args.get('tz_offset', local)) * 60000)
+        elif metric == 'rolling':
+            params['window_ms'] = int(float(request.args.get('window', '3600')) * 1000)
+        elif metric == 'drying':
+            params['settle_ms'] = int(float(request.args.get('settle', '600')) * 1000)
+            params['horizon_ms'] = int(float(request.args.get('horizon', '172800')) * 1000)
+    except ValueError: return jsonify({"error": "invalid step/window/tz_offset/settle/horizon"}), 400
+    if not 1 <= step_s <= 86400: return jsonify({"error": "step must be 1..86400 seconds"}), 400
+    if any(v < 0 for k, v in params.items() if k != 'tz_offset_ms'): return jsonify({"error": "window/settle/horizon must not be negative"}), 400
+    if start is None:
+        start = (db.now_ms() - int(ANALYTICS_DEFAULT_DAYS * 86400000)) // 3600000 * 3600000
+    gap_ms = sampling_settings(device_id)[2] * 1500
+    return jsonify(analytics.analyze(metric, device_id, start, end, int(step_s * 1000), gap_ms, **params))
+@app.route('/api/v1/sensors/batch', methods=['POST'])
+def ingest_sensor_batch():
+    """批量写入网关/离线记录仪缓存的读数: JSON 数组、{"device_id", "readings"} 对象或 NDJSON。"""
+    body = request.get_data(cache=False, as_text=True) or ''
+    payload = None
+    if 'ndjson' not in (request.content_type or ''):
+        try: payload = json.loads(body)
+        except json.JSONDecodeError: payload = None
+    if payload is None:
+        try: payload = [json.loads(line) for line in body.splitlines() if line.strip()]
+        except json.JSONDecodeError as e: return jsonify({"error": f"invalid JSON/NDJSON: {e}"}), 400
+    device_arg = request.args.get('device_id')
+    if isinstance(payload, dict):
+        device_arg = payload.get('device_id', device_arg)
+        payload = payload.get('readings')
+    if not isinstance(payload, list): return jsonify({"error": "readings must be a list"}), 400
+    if len(payload) > BATCH_MAX_ROWS: return jsonify({"error": f"too many readings (max {BATCH_MAX_ROWS})"}), 413
+    try: device_id = int(device_arg) if device_arg is not None else DB_DEVICE_ID
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    if not db.device_exists(device_id): return jsonify({"error": "device not found"}), 404
+    rows, errors = validate_batch_readings(payload)
+    inserted, duplicates = db.insert_sensor_data_batch(device_id, rows) if rows else (0, 0)
+    if inserted: hot_window.invalidate(device_id)
+    # 按时间顺序计入流式统计 (比已计入的最新读数还旧的行会被忽略)
+    try:
+        for r in sorted(rows, key=lambda r: r[4]): record_stats(device_id, r[4], dict(zip(hotwindow.COLUMNS, r[:4])))
+    except Exception as e: print(f"批量写入: 流式统计失败 - {e}")
+    return jsonify({"device_id": device_id, "received": len(payload), "accepted": inserted,
+                    "rejected": len(errors) + duplicates, "invalid": len(errors), "duplicates": duplicates,
+                    "errors": errors[:20]})
 @app.route('/api/v1/policy/irrigation', methods=['GET'])
 def get_irrigation_policy_api():
     try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
@@ -411,20 +888,65 @@ def set_irrigation_policy_api():
     try: device_id = int(payload.get('device_id')) if payload.get('device_id') is not None else DB_DEVICE_ID
     except Exception: return jsonify({"error": "invalid device_id"}), 400
     db.upsert_irrigation_policy(device_id, enabled_int, soil_v, dur_v, cd_v)
+    reload_rules()
     row = db.get_irrigation_policy(device_id)
     return jsonify(row or {}), 200
 @app.route('/api/v1/policy/irrigation/status', methods=['GET'])
 def get_auto_irrigation_status(): return jsonify(auto_irrigation_state)
+def parse_rule_payload(payload):
+    """校验规则请求体, 返回 (rule, error)。条件格式见 rules.py。"""
+    try: device_id = int(payload.get('device_id')) if payload.get('device_id') is not None else DB_DEVICE_ID
+    except Exception: return None, "invalid device_id"
+    if not db.device_exists(device_id): return None, "device not found"
+    # 规则只由本机串口设备的实时读数驱动, 动作也只能下发给它; 其它设备的规则永远不会触发
+    if device_id != DB_DEVICE_ID: return None, f"rules can only target the local serial device (device_id {DB_DEVICE_ID})"
+    enabled = payload.get('enabled', True)
+    if enabled not in (True, False, 0, 1): return None, "enabled must be boolean"
+    if payload.get('name') is not None and not isinstance(payload.get('name'), str): return None, "name must be a string"
+    rule = {"device_id": device_id, "name": payload.get('name'), "enabled": bool(enabled), "conditions": payload.get('conditions'),
+            "actuator": payload.get('actuator'), "action": payload.get('action'),
+            "duration_s": payload.get('duration_s'), "cooldown_s": payload.get('cooldown_s')}
+    if not isinstance(rule['conditions'], list): return None, "conditions must be a list"
+    try: rules.compile_rule(rule)
+    except ValueError as e: return None, str(e)
+    return rule, None
+@app.route('/api/v1/rules', methods=['GET'])
+def list_rules_api():
+    try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else None
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    items = db.list_rules(device_id)
+    return jsonify({"items": items, "count": len(items), "engine": rule_engine.snapshot()})
+@app.route('/api/v1/rules', methods=['POST'])
+@admin_required
+def create_rule_api():
+    rule, error = parse_rule_payload(request.get_json(silent=True) or {})
+    if error: return jsonify({"error": error}), 400
+    rule_id = db.save_rule(rule)
+    reload_rules()
+    return jsonify(db.get_rule(rule_id)), 201
+@app.route('/api/v1/rules/<int:rule_id>', methods=['GET'])
+def get_rule_api(rule_id):
+    row = db.get_rule(rule_id)
+    if not row: return jsonify({"error": "rule not found"}), 404
+    return jsonify(row)
+@app.route('/api/v1/rules/<int:rule_id>', methods=['PUT'])
+@admin_required
+def update_rule_api(rule_id):
+    rule, error = parse_rule_payload(request.get_json(silent=True) or {})
+    if error: return jsonify({"error": error}), 400
+    if db.save_rule(rule, rule_id) is None: return jsonify({"error": "rule not found"}), 404
+    reload_rules()
+    return jsonify(db.get_rule(rule_id))
+@app.route('/api/v1/rules/<int:rule_id>', methods=['DELETE'])
+@admin_required
+def delete_rule_api(rule_id):
+    if not db.delete_rule(rule_id): return jsonify({"error": "rule not found"}), 404
+    reload_rules()
+    return jsonify({"deleted": rule_id})
 @app.route('/api/v1/sensors/history.csv', methods=['GET'])
 def get_sensor_history_csv():
-    def normalize_start_end(s: str | None, e: str | None):
-        def norm_one(x: str | None, is_start: bool):
-            if not x: return None
-            x = x.strip()
-            if len(x) == 10 and x[4] == '-' and x[7] == '-': return x + (' 00:00:00' if is_start else ' 23:59:59')
-            return x
-        return norm_one(s, True), norm_one(e, False)
-    start, end = normalize_start_end(request.args.get('start'), request.args.get('end'))
+    try: start, end = parse_range_args(request.args)
+    except ValueError: return jsonify({"error": "invalid start/end"}), 400
     try:
         limit = max(1, min(10000, int(request.args.get('limit', '1000'))))
         offset = max(0, int(request.args.get('offset', '0')))
@@ -434,10 +956,27 @@ def get_sensor_history_csv():
     rows = db.query_sensor_history(device_id=device_id, start=start, end=end, limit=limit, offset=offset)
     output = io.StringIO()
     writer = csv.writer(output)
-    writer.writerow(['id','device_id','timestamp','temperature','humidity','lux','soil'])
-    for r in rows: writer.writerow([r.get('id'), r.get('device_id'), r.get('timestamp'), r.get('temperature'), r.get('humidity'), r.get('lux'), r.get('soil')])
+    writer.writerow(['id','device_id','timestamp','temperature','humidity','lux','soil','ts_ms'])
+    for r in rows: writer.writerow([r.get('id'), r.get('device_id'), r.get('timestamp'), r.get('temperature'), r.get('humidity'), r.get('lux'), r.get('soil'), r.get('ts_ms')])
     csv_data = output.getvalue()
     return Response(csv_data, mimetype='text/csv', headers={'Content-Disposition': 'attachment; filename="history.csv"'})
+def load_parquet_export():
+    """列式导出模块 (pyarrow 为可选依赖, 缺失时 history.parquet 返回 501)。pyarrow 导入很慢且采集用不到, 首次导出时才加载。"""
+    try: from . import parquet_export
+    except Exception: import parquet_export
+    return parquet_export
+@app.route('/api/v1/sensors/history.parquet', methods=['GET'])
+def get_sensor_history_parquet():
+    """列式导出: 与 history 相同的 device_id/start/end 过滤, 不限行数, 按行组边查边流式输出 (时间升序)。"""
+    parquet_export = load_parquet_export()
+    if not parquet_export.PYARROW_AVAILABLE: return jsonify({"error": "pyarrow not installed"}), 501
+    try: start, end = parse_range_args(request.args)
+    except ValueError: return jsonify({"error": "invalid start/end"}), 400
+    try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    body = parquet_export.stream_parquet(device_id=device_id, start_ms=start, end_ms=end)
+    return Response(stream_with_context(body), mimetype='application/vnd.apache.parquet',
+                    headers={'Content-Disposition': 'attachment; filename="history.parquet"'})
 @app.route('/api/v1/control/logs', methods=['GET'])
 def get_control_logs():
     try:
@@ -447,40 +986,139 @@ def get_control_logs():
     try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
     except Exception: return jsonify({"error": "invalid device_id"}), 400
     actuator = request.args.get('actuator')
-    def norm(ts, is_start):
-        if not ts: return None
-        ts = ts.strip()
-        if len(ts) == 10 and ts[4] == '-' and ts[7] == '-': return ts + (' 00:00:00' if is_start else ' 23:59:59')
-        return ts
-    start = norm(request.args.get('start'), True)
-    end = norm(request.args.get('end'), False)
+    try: start, end = parse_range_args(request.args)
+    except ValueError: return jsonify({"error": "invalid start/end"}), 400
+    try: since = parse_since_args(request.args)
+    except ValueError: return jsonify({"error": "invalid since_ts/since_id"}), 400
+    not_modified, etag, reset = delta_response('control', device_id, since)
+    if not_modified: return not_modified
+    delta = since != (None, None) and not reset
+    if delta: start, offset = max(start or 0, since[0] or 0) or None, 0
     rows = db.query_control_logs_range(device_id=device_id, start=start, end=end, actuator=actuator, limit=limit, offset=offset)
-    return jsonify({"items": rows, "count": len(rows)})
+    body = {"hwm": high_water(rows, since, 'created_ms'), "reset": reset}
+    if delta:
+        body["truncated"] = len(rows) >= limit and len(newer_than(rows, since, 'created_ms')) == len(rows)
+        rows = newer_than(rows, since, 'created_ms')
+    resp = jsonify({**row_items(rows, 'created_ms', 'created_at'), **body})
+    resp.set_etag(etag, weak=True)
+    return resp
 @app.route('/api/v1/devices/status', methods=['GET'])
 def device_status():
     try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
     except Exception: return jsonify({"error": "invalid device_id"}), 400
     row = db.query_device_status(device_id)
     if not row: return jsonify({"error": "device not found"}), 404
+    if device_id == DB_DEVICE_ID: row['boot'] = dict(device_boot_info)
     return jsonify(row)
+@app.route('/api/v1/devices/health', methods=['GET'])
+def device_health():
+    """各设备最近一次健康帧: 主循环分阶段耗时 [次数, 平均us, 最大us] 与传感器统计。"""
+    try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else None
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    items = db.query_device_health(device_id)
+    return jsonify({"items": items, "count": len(items)})
+@app.route('/api/v1/devices/sampling', methods=['GET'])
+def get_sampling_config_api():
+    """采样间隔: configured 为保存的配置, reported 为固件最近一次确认的实际值。"""
+    try: device_id = int(request.args.get('device_id')) if request.args.get('device_id') is not None else DB_DEVICE_ID
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    reported = dict(device_sampling_reported) if device_id == DB_DEVICE_ID else {}
+    row, deadband, heartbeat_s = sampling_settings(device_id)
+    return jsonify({"device_id": device_id, "configured": row, "deadband": deadband, "heartbeat_s": heartbeat_s, "reported": reported,
+                    "limits": {**SAMPLING_LIMITS, **{k: (0, v) for k, v in DEADBAND_LIMITS.items()}, "heartbeat_s": HEARTBEAT_LIMITS}})
+@app.route('/api/v1/devices/sampling', methods=['POST'])
+@admin_required
+def set_sampling_config_api():
+    payload = request.get_json(silent=True) or {}
+    try: device_id = int(payload.get('device_id')) if payload.get('device_id') is not None else DB_DEVICE_ID
+    except Exception: return jsonify({"error": "invalid device_id"}), 400
+    if not db.device_exists(device_id): return jsonify({"error": "device not found"}), 404
+    intervals = {}
+    for key, (lo, hi) in SAMPLING_LIMITS.items():
+        v = payload.get(key)
+        if v is None: continue
+        if isinstance(v, bool) or not isinstance(v, int) or not lo <= v <= hi:
+            return jsonify({"error": f"{key} must be an integer in [{lo}, {hi}]"}), 400
+        intervals[key] = v
+    # 死区可以放在 deadband 对象里 ({"deadband": {"temp": 0.5}}), 也可以直接写 temp_db
+    deadband = payload.get('deadband') if isinstance(payload.get('deadband'), dict) else {}
+    for key, hi in DEADBAND_LIMITS.items():
+        v = deadband.get(key[:-3], payload.get(key))
+        if v is None: continue
+        if isinstance(v, bool) or not isinstance(v, (int, float)) or not 0 <= v <= hi:
+            return jsonify({"error": f"{key} must be a number in [0, {hi}]"}), 400
+        intervals[key] = float(v)
+    v = payload.get('heartbeat_s')
+    if v is not None:
+        if isinstance(v, bool) or not isinstance(v, int) or not HEARTBEAT_LIMITS[0] <= v <= HEARTBEAT_LIMITS[1]:
+            return jsonify({"error": f"heartbeat_s must be an integer in [{HEARTBEAT_LIMITS[0]}, {HEARTBEAT_LIMITS[1]}]"}), 400
+        intervals['heartbeat_s'] = v
+    if not intervals:
+        return jsonify({"error": "no sampling setting given", "accepted": [*SAMPLING_LIMITS, 'deadband', 'heartbeat_s']}), 400
+    db.upsert_sampling_config(device_id, intervals)
+    # 目前只有一条串口连接到默认设备; 其它设备的配置在其上线时下发
+    if device_id == DB_DEVICE_ID: load_report_filter(); send_sampling_config(device_id)
+    return jsonify({"device_id": device_id, "configured": db.get_sampling_config(device_id)}), 200
+@app.route('/api/v1/maintenance/retention', methods=['GET'])
+def get_retention_stats():
+    """保留策略与清理统计: 已删除行数、删除的分区数、回收的字节数及当前文件大小。"""
+    return jsonify({"retention_days": RETENTION_DAYS, "prune_interval_s": PRUNE_INTERVAL, "vacuum_hours": VACUUM_HOURS, **db.maintenance_stats()})
+@app.route('/api/v1/maintenance/prune', methods=['POST'])
+@admin_required
+def run_prune():
+    """立即执行一次过期数据清理; vacuum=1 时随后回收空闲页 (不受低峰时段限制)。"""
+    payload = request.get_json(silent=True) or {}
+    if db.epoch_backfill_pending() or db.legacy_migration_pending(): return jsonify({"error": "data migration in progress"}), 409
+    result = db.prune_expired(RETENTION_DAYS)
+    result['rows']['anomalies'] = db.prune_anomalies(RETENTION_DAYS['anomalies'])
+    if payload.get('vacuum'): result['vacuum_bytes'] = db.incremental_vacuum(max_pages=VACUUM_MAX_PAGES)
+    return jsonify(result)
+@app.route('/api/v1/maintenance/backup', methods=['GET'])
+def get_backup_status():
+    """备份进度 (pages_done / pages_total, 当前文件) 与已有快照列表。"""
+    return jsonify({"status": db.backup_status(), "snapshots": db.list_backups(), "interval_hours": BACKUP_INTERVAL_HOURS, "keep": BACKUP_KEEP})
+@app.route('/api/v1/maintenance/backup', methods=['POST'])
+@admin_required
+def trigger_backup():
+    """立即开始一次在线备份 (后台执行, 通过 GET 查看进度); compress 缺省取 BACKUP_COMPRESS。"""
+    payload = request.get_json(silent=True) or {}
+    if db.backup_status()['running']: return jsonify({"error": "backup already running", "status": db.backup_status()}), 409
+    compress = bool(payload['compress']) if 'compress' in payload else None
+    threading.Thread(target=run_backup, args=(compress,), daemon=True).start()
+    return jsonify({"started": True}), 202
 
 
 if __name__ == '__main__':
-    if PI_CAMERA_AVAILABLE and picam2:
-        try:
-            still_config = picam2.create_still_configuration()
-            picam2.configure(still_config)
-            picam2.start()
-            print("✅ 摄像头已成功启动并准备就绪。")
-        except Exception as e:
-            print(f"❌ 启动摄像头失败: {e}")
-            PI_CAMERA_AVAILABLE = False
-    
+    if not FAST_START: init_vision()
+
+    load_report_filter()
+    # 串口读取线程最先启动, 尽量缩短重启期间的数据空档
     reader_thread = threading.Thread(target=serial_reader, daemon=True)
     reader_thread.start()
+    startup_phase('serial reader')
+    # 摄像头与 cv2 在后台初始化, 不阻塞串口和 Web 服务
+    if FAST_START: threading.Thread(target=init_vision, daemon=True).start()
+    # 旧数据的 epoch 毫秒回填和按月分区迁移在后台分批进行, 不阻塞启动
+    if db.epoch_backfill_pending() or db.legacy_migration_pending(): threading.Thread(target=data_migrations, daemon=True).start()
+
+    # 规则 (含灌溉策略) 编译一次, 之后随每帧读数增量求值
+    reload_rules()
+    rule_thread = threading.Thread(target=rule_ticker, daemon=True)
+    rule_thread.start()
+
+    compactor_thread = threading.Thread(target=sensor_compactor, daemon=True)
+    compactor_thread.start()
+
+    pruner_thread = threading.Thread(target=data_pruner, daemon=True)
+    pruner_thread.start()
+
+    if BACKUP_INTERVAL_HOURS > 0: threading.Thread(target=backup_scheduler, daemon=True).start()
 
-    irrigation_thread = threading.Thread(target=irrigation_worker, daemon=True)
-    irrigation_thread.start()
+    threading.Thread(target=last_seen_flusher, daemon=True).start()
+    # 正常退出和 SIGTERM (systemd stop) 时写回 last_seen
+    atexit.register(flush_on_exit)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
+    startup_phase('background threads')
     print("启动统一服务器... 请在浏览器中访问 http://<你的树莓派IP>:5000")
     app.run(host='0.0.0.0', port=5000, debug=False)
@@ -1,11 +1,36 @@
+import gzip
+import heapq
+import json
+import operator
 import os
+import re
+import shutil
 import sqlite3
+import struct
 import threading
-from datetime import datetime
+from collections import OrderedDict, deque
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
 
 _DB_PATH = os.path.join(os.path.dirname(__file__), 'data.sqlite3')
 _db_lock = threading.Lock()
 _conn = None
+_TS_FMT = '%Y-%m-%d %H:%M:%S'
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# True while rows written before the epoch-ms columns existed still lack ts_ms / created_ms
+_epoch_backfill_pending = False
+# Monthly partition files for sensor_data / control_logs / sensor_blocks (see "Monthly partitions")
+_PARTITION_DIR = os.path.join(os.path.dirname(__file__), 'partitions')
+MAX_ATTACHED = 8
+_attached: 'OrderedDict[int, str]' = OrderedDict()
+_partition_months: list | None = None
+# months being copied by backup_database(); never detached or dropped meanwhile
+_pinned: set = set()
+# streaming reads in progress (iter_sensor_rows); compaction waits for them
+_streams_active = 0
+# True while the main file still holds rows written before partitioning
+_legacy_pending = False
 
 
 def _connect():
@@ -13,118 +38,920 @@ def _connect():
     if _conn is None:
         _conn = sqlite3.connect(_DB_PATH, check_same_thread=False)
         _conn.row_factory = sqlite3.Row
+        # only takes effect on a new file; existing files are converted by incremental_vacuum()
+        _conn.execute('PRAGMA auto_vacuum=INCREMENTAL;')
         _conn.execute('PRAGMA journal_mode=WAL;')
         _conn.execute('PRAGMA synchronous=NORMAL;')
     return _conn
 
 
+# Bumped whenever _create_schema() changes; stored in PRAGMA user_version so a restart
+# with an up-to-date file skips the DDL and the ALTER TABLE probes entirely.
+SCHEMA_VERSION = 3
+
+
+def _create_schema(conn):
+    """Create/migrate every table in the main database file (idempotent; caller holds _db_lock)."""
+    # users
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            password_hash TEXT NOT NULL,
+            created_at TEXT NOT NULL DEFAULT (datetime('now'))
+        );
+        """
+    )
+    # roles
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS roles (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL
+        );
+        """
+    )
+    # user_roles (many-to-many)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS user_roles (
+            user_id INTEGER NOT NULL,
+            role_id INTEGER NOT NULL,
+            PRIMARY KEY (user_id, role_id),
+            FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
+            FOREIGN KEY(role_id) REFERENCES roles(id) ON DELETE CASCADE
+        );
+        """
+    )
+    # devices
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS devices (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL,
+            description TEXT,
+            last_seen TEXT
+        );
+        """
+    )
+    # sensor_data
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sensor_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            temperature REAL,
+            humidity REAL,
+            lux REAL,
+            soil REAL,
+            timestamp TEXT NOT NULL,
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        );
+        """
+    )
+    # control_logs
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS control_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            actuator TEXT,
+            action TEXT,
+            raw_command TEXT,
+            success INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        );
+        """
+    )
+    # irrigation_policies (optional business table to reach >=6)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS irrigation_policies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            enabled INTEGER NOT NULL DEFAULT 0,
+            soil_threshold_min REAL,
+            watering_seconds INTEGER,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        );
+        """
+    )
+    # Migration: ensure cooldown_seconds column exists
+    try:
+        conn.execute("ALTER TABLE irrigation_policies ADD COLUMN cooldown_seconds INTEGER")
+    except Exception:
+        pass
+
+    # device_health: latest firmware health frame per device (loop phase timings, sensor counters)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS device_health (
+            device_id INTEGER PRIMARY KEY,
+            health_json TEXT NOT NULL,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        );
+        """
+    )
+
+    # sampling_configs: per-device sensor sampling intervals pushed to the firmware
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sampling_configs (
+            device_id INTEGER PRIMARY KEY,
+            dht_ms INTEGER,
+            lux_ms INTEGER,
+            soil_ms INTEGER,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        );
+        """
+    )
+    # Migration: report-on-change deadbands (channel units) and max-silence heartbeat
+    for col in ('temp_db REAL', 'humi_db REAL', 'lux_db REAL', 'soil_db REAL', 'heartbeat_s INTEGER'):
+        try:
+            conn.execute(f"ALTER TABLE sampling_configs ADD COLUMN {col}")
+        except Exception:
+            pass
+
+    # Migration: integer epoch-millisecond timestamps. The TEXT columns stay for display and
+    # compatibility; range filters, ordering and de-duplication use the integer columns.
+    for table, col in (('sensor_data', 'ts_ms'), ('control_logs', 'created_ms')):
+        try:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} INTEGER")
+        except Exception:
+            pass
+
+    # sensor_blocks: cold tier, one row per device per closed hour of sensor_data,
+    # each column a zlib-compressed delta / XOR encoded blob (see _encode_block)
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS sensor_blocks (
+            device_id INTEGER NOT NULL,
+            hour_ms INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            first_ms INTEGER NOT NULL,
+            last_ms INTEGER NOT NULL,
+            ts_blob BLOB NOT NULL,
+            temperature_blob BLOB NOT NULL,
+            humidity_blob BLOB NOT NULL,
+            lux_blob BLOB NOT NULL,
+            soil_blob BLOB NOT NULL,
+            PRIMARY KEY (device_id, hour_ms),
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        ) WITHOUT ROWID;
+        """
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sensor_blocks_hour ON sensor_blocks(hour_ms)')
+
+    # Index: range scans and (device_id, ts_ms) de-duplication for batch ingestion
+    conn.execute('DROP INDEX IF EXISTS idx_sensor_data_device_ts')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sensor_data_device_tsms ON sensor_data(device_id, ts_ms)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_control_logs_device_ms ON control_logs(device_id, created_ms)')
+    # Partial indexes over rows still waiting for the backfill; they empty out as it progresses
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_sensor_data_tsms_pending ON sensor_data(id) WHERE ts_ms IS NULL')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_control_logs_ms_pending ON control_logs(id) WHERE created_ms IS NULL')
+
+    # anomalies: flags raised by the streaming statistics at ingest (z-score, stuck value,
+    # drift, simulated driver); low volume, so kept in the main file rather than partitioned
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS anomalies (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            channel TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            value REAL,
+            score REAL,
+            detail TEXT,
+            ts_ms INTEGER NOT NULL,
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        );
+        """
+    )
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_anomalies_device_ts ON anomalies(device_id, ts_ms)')
+
+    # control_rules: actuator rules for the rule engine (see rules.py); conditions is a JSON
+    # list of sensor thresholds and time-of-day windows
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS control_rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            name TEXT,
+            enabled INTEGER NOT NULL DEFAULT 1,
+            conditions TEXT NOT NULL,
+            actuator TEXT NOT NULL,
+            action TEXT NOT NULL,
+            duration_s REAL,
+            cooldown_s REAL,
+            updated_at TEXT NOT NULL DEFAULT (datetime('now')),
+            FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
+        );
+        """
+    )
+
+    # last_seen is tracked in memory and flushed periodically (see touch_device); the old
+    # per-insert trigger would write it back on every control log
+    conn.execute('DROP TRIGGER IF EXISTS trg_control_log_update_last_seen')
+    conn.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
 def create_tables():
     conn = _connect()
     with _db_lock:
-        # users
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                created_at TEXT NOT NULL DEFAULT (datetime('now'))
-            );
-            """
+        if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+            _create_schema(conn)
+        conn.commit()
+        global _epoch_backfill_pending, _legacy_pending
+        _epoch_backfill_pending = (
+            conn.execute('SELECT 1 FROM sensor_data WHERE ts_ms IS NULL LIMIT 1').fetchone() is not None
+            or conn.execute('SELECT 1 FROM control_logs WHERE created_ms IS NULL LIMIT 1').fetchone() is not None
         )
-        # roles
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS roles (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL
-            );
-            """
+        _legacy_pending = any(
+            conn.execute(f'SELECT 1 FROM main.{t} LIMIT 1').fetchone() is not None
+            for t in ('sensor_data', 'control_logs', 'sensor_blocks')
         )
-        # user_roles (many-to-many)
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS user_roles (
-                user_id INTEGER NOT NULL,
-                role_id INTEGER NOT NULL,
-                PRIMARY KEY (user_id, role_id),
-                FOREIGN KEY(user_id) REFERENCES users(id) ON DELETE CASCADE,
-                FOREIGN KEY(role_id) REFERENCES roles(id) ON DELETE CASCADE
-            );
-            """
-        )
-        # devices
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS devices (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT UNIQUE NOT NULL,
-                description TEXT,
-                last_seen TEXT
-            );
-            """
-        )
-        # sensor_data
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS sensor_data (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id INTEGER NOT NULL,
-                temperature REAL,
-                humidity REAL,
-                lux REAL,
-                soil REAL,
-                timestamp TEXT NOT NULL,
-                FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
-            );
-            """
+
+
+# --- Epoch-millisecond timestamps ---
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def ms_to_text(ms: int) -> str:
+    """Format epoch milliseconds as the legacy UTC 'YYYY-MM-DD HH:MM:SS' string."""
+    return (_EPOCH + timedelta(milliseconds=int(ms))).strftime(_TS_FMT)
+
+
+def to_epoch_ms(value, inclusive_end: bool = False) -> int | None:
+    """Convert a timestamp to UTC epoch milliseconds, or None if it cannot be parsed.
+
+    Accepts epoch seconds or milliseconds (numbers or numeric strings), 'YYYY-MM-DD',
+    'YYYY-MM-DD HH:MM[:SS[.fff]]' and ISO-8601; naive values are UTC. With `inclusive_end`
+    a value is widened to the last millisecond of its own resolution, so an end bound of
+    '2024-05-01' or '2024-05-01 12:00:00' keeps matching rows the way the old string
+    comparison did.
+    """
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, str):
+        value = value.strip()
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    if isinstance(value, (int, float)):
+        if value != value or abs(value) > 1e16:
+            return None
+        return int(round(value if abs(value) > 1e11 else value * 1000))
+    if not isinstance(value, str) or not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    ms = (dt - _EPOCH) // timedelta(milliseconds=1)
+    if inclusive_end:
+        clock = re.split('[+Z-]', value[11:])[0]
+        if len(value) == 10:
+            ms += 86400000 - 1
+        elif '.' not in clock:
+            ms += (60000 if clock.count(':') == 1 else 1000) - 1
+    return ms
+
+
+def _bound_ms(value, inclusive_end: bool = False) -> int | None:
+    if value is None or value == '':
+        return None
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    ms = to_epoch_ms(value, inclusive_end)
+    if ms is None:
+        raise ValueError(f'invalid timestamp: {value!r}')
+    return ms
+
+
+def _append_range(sql: list, params: list, ms_col: str, text_col: str, start_ms, end_ms, legacy: bool = False):
+    """Append start/end filters (epoch ms) on an epoch-ms column. On the legacy main tables,
+    while the backfill is running, rows without the integer column fall back to comparing
+    the text column."""
+    for bound, op in ((start_ms, '>='), (end_ms, '<=')):
+        if bound is None:
+            continue
+        if legacy and _epoch_backfill_pending:
+            sql.append(f'AND ({ms_col} {op} ? OR ({ms_col} IS NULL AND {text_col} {op} ?))')
+            params.extend([bound, ms_to_text(bound)])
+        else:
+            sql.append(f'AND {ms_col} {op} ?')
+            params.append(bound)
+
+
+def epoch_backfill_pending() -> bool:
+    return _epoch_backfill_pending
+
+
+def backfill_epoch_ms(batch_size: int = 2000, pause: float = 0.05) -> int:
+    """Fill ts_ms / created_ms on rows written before those columns existed.
+
+    Runs in small transactions so ingestion and queries keep going in between;
+    safe to call repeatedly. Unparseable timestamps are set to 0. Returns rows updated.
+    """
+    global _epoch_backfill_pending
+    conn = _connect()
+    total = 0
+    for table, ms_col, text_col in (('sensor_data', 'ts_ms', 'timestamp'), ('control_logs', 'created_ms', 'created_at')):
+        while True:
+            with _db_lock:
+                cur = conn.execute(
+                    f"UPDATE {table} SET {ms_col} = COALESCE(CAST(ROUND((julianday({text_col}) - 2440587.5) * 86400000) AS INTEGER), 0) "
+                    f"WHERE id IN (SELECT id FROM {table} WHERE {ms_col} IS NULL LIMIT ?)",
+                    (int(batch_size),)
+                )
+                conn.commit()
+                n = cur.rowcount
+            total += n
+            if n < batch_size:
+                break
+            time.sleep(pause)
+    _epoch_backfill_pending = False
+    return total
+
+
+# --- Change tracking ---
+#
+# Per-device counters for cheap conditional requests: `version` grows with every write,
+# `rev` whenever already-served history may have changed (rows inserted before the newest
+# one, or pruned), which invalidates clients' incremental (since_*) state. Tokens include a
+# per-process id, so counters that restart with the server never match old ETags.
+#
+# The time span of each rewrite is also logged (the last REWRITE_LOG per device), so
+# range_token() can tell whether a closed range was touched without invalidating it on
+# every ordinary write.
+
+_BOOT_ID = format(int(time.time() * 1000), 'x')
+_versions: dict = {}
+_latest_ts: dict = {}
+_global_rev = 0
+REWRITE_LOG = 256
+_rewrites: dict = {}
+
+
+def _bump(kind: str, device_id, ts_ms=None, rewrite: bool = False, min_ts=None):
+    """Record a write of `kind` ('sensor' / 'control') for a device, covering rows from
+    `min_ts` (default `ts_ms`) to `ts_ms`. Caller holds _db_lock."""
+    v = _versions.setdefault((kind, device_id), [0, 0])
+    v[0] += 1
+    if ts_ms is not None:
+        latest = _latest_ts.get((kind, device_id))
+        if latest is not None and ts_ms < latest:
+            rewrite = True
+        if latest is None or ts_ms > latest:
+            _latest_ts[(kind, device_id)] = ts_ms
+    if rewrite:
+        v[1] += 1
+        log = _rewrites.setdefault((kind, device_id), [0, deque(maxlen=REWRITE_LOG)])
+        if len(log[1]) == REWRITE_LOG:
+            log[0] += 1
+        log[1].append((ts_ms if min_ts is None else min_ts, ts_ms))
+
+
+def change_token(kind: str, device_id) -> tuple[str, str]:
+    """(etag, rev_key) for a device's sensor or control-log data. The ETag changes on every
+    write; rev_key (a prefix of the ETag) only when incremental clients must reload."""
+    with _db_lock:
+        version, rev = _versions.get((kind, device_id), (0, 0))
+        rev_key = f'{_BOOT_ID}.{_global_rev}.{rev}'
+    return f'{rev_key}-{version}', rev_key
+
+
+def range_token(kind: str, device_id, start_ms, end_ms) -> str | None:
+    """Revision of a closed range [start_ms, end_ms] (open start allowed) of a device's data:
+    it changes only when rows in the range are written after the fact (back-dated batch or
+    backlog uploads) or data is pruned / migrated, not with ordinary new readings. None if
+    the range is not closed, i.e. reaches the newest row written since startup (or nothing
+    has been written yet), so new readings may still land in it."""
+    with _db_lock:
+        latest = _latest_ts.get((kind, device_id))
+        if end_ms is None or latest is None or end_ms >= latest:
+            return None
+        dropped, log = _rewrites.get((kind, device_id), (0, ()))
+        hits = sum(1 for lo, hi in log
+                   if (lo is None or lo <= end_ms) and (hi is None or start_ms is None or hi >= start_ms))
+        return f'{_BOOT_ID}.{_global_rev}.{dropped}.{hits}'
+
+
+# --- Monthly partitions ---
+#
+# sensor_data, control_logs and sensor_blocks live in one SQLite file per UTC month
+# (partitions/p_YYYYMM.sqlite3). A query ATTACHes only the months its time range touches;
+# at most MAX_ATTACHED files stay attached, least recently used first out. Expiring a month
+# is a file delete. Row ids stay globally unique: each partition's AUTOINCREMENT sequence
+# starts at YYYYMM * 10^9, far above the ids of the pre-partitioning main tables, whose
+# rows are moved into partitions in the background by migrate_legacy_to_partitions().
+
+_PARTITION_ID_BASE = 10 ** 9
+_PARTITION_FILE = re.compile(r'^p_(\d{6})\.sqlite3$')
+
+
+def month_of(ms: int) -> int:
+    dt = _EPOCH + timedelta(milliseconds=int(ms))
+    return dt.year * 100 + dt.month
+
+
+def month_start_ms(month: int) -> int:
+    return (datetime(month // 100, month % 100, 1, tzinfo=timezone.utc) - _EPOCH) // timedelta(milliseconds=1)
+
+
+def _next_month(month: int) -> int:
+    return month + 1 if month % 100 < 12 else (month // 100 + 1) * 100 + 1
+
+
+def _partition_path(month: int) -> str:
+    return os.path.join(_PARTITION_DIR, f'p_{month}.sqlite3')
+
+
+def _months() -> list:
+    """Sorted months that have a partition file."""
+    global _partition_months
+    if _partition_months is None:
+        found = []
+        if os.path.isdir(_PARTITION_DIR):
+            for name in os.listdir(_PARTITION_DIR):
+                m = _PARTITION_FILE.match(name)
+                if m:
+                    found.append(int(m.group(1)))
+        _partition_months = sorted(found)
+    return _partition_months
+
+
+def _months_in_range(start_ms, end_ms) -> list:
+    """Existing partition months overlapping [start_ms, end_ms], newest first."""
+    lo = month_of(start_ms) if start_ms is not None else None
+    hi = month_of(end_ms) if end_ms is not None else None
+    return [m for m in reversed(_months()) if (lo is None or m >= lo) and (hi is None or m <= hi)]
+
+
+def _create_partition_schema(conn, alias: str, month: int):
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {alias}.sensor_data (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            temperature REAL,
+            humidity REAL,
+            lux REAL,
+            soil REAL,
+            timestamp TEXT NOT NULL,
+            ts_ms INTEGER NOT NULL
         )
-        # control_logs
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS control_logs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id INTEGER NOT NULL,
-                actuator TEXT,
-                action TEXT,
-                raw_command TEXT,
-                success INTEGER NOT NULL DEFAULT 0,
-                created_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
-            );
-            """
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {alias}.control_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            device_id INTEGER NOT NULL,
+            actuator TEXT,
+            action TEXT,
+            raw_command TEXT,
+            success INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            created_ms INTEGER NOT NULL
         )
-        # irrigation_policies (optional business table to reach >=6)
-        conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS irrigation_policies (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                device_id INTEGER NOT NULL,
-                enabled INTEGER NOT NULL DEFAULT 0,
-                soil_threshold_min REAL,
-                watering_seconds INTEGER,
-                updated_at TEXT NOT NULL DEFAULT (datetime('now')),
-                FOREIGN KEY(device_id) REFERENCES devices(id) ON DELETE CASCADE
-            );
-            """
+        """
+    )
+    conn.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS {alias}.sensor_blocks (
+            device_id INTEGER NOT NULL,
+            hour_ms INTEGER NOT NULL,
+            n INTEGER NOT NULL,
+            first_ms INTEGER NOT NULL,
+            last_ms INTEGER NOT NULL,
+            ts_blob BLOB NOT NULL,
+            temperature_blob BLOB NOT NULL,
+            humidity_blob BLOB NOT NULL,
+            lux_blob BLOB NOT NULL,
+            soil_blob BLOB NOT NULL,
+            PRIMARY KEY (device_id, hour_ms)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_sensor_data_device_tsms ON sensor_data(device_id, ts_ms)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_control_logs_device_ms ON control_logs(device_id, created_ms)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {alias}.idx_sensor_blocks_hour ON sensor_blocks(hour_ms)')
+    for table in ('sensor_data', 'control_logs'):
+        if conn.execute(f'SELECT 1 FROM {alias}.sqlite_sequence WHERE name = ?', (table,)).fetchone() is None:
+            conn.execute(f'INSERT INTO {alias}.sqlite_sequence(name, seq) VALUES (?, ?)', (table, month * _PARTITION_ID_BASE))
+    conn.commit()
+
+
+def _attach(conn, month: int, create: bool = False) -> str | None:
+    """Return the schema alias of a month's partition, attaching (and with `create`, creating)
+    it on demand. Caller holds _db_lock and has no open transaction."""
+    alias = f'p{month}'
+    if alias in _attached.values():
+        _attached.move_to_end(month)
+        return alias
+    path = _partition_path(month)
+    exists = os.path.exists(path)
+    if not exists and not create:
+        return None
+    while len(_attached) >= MAX_ATTACHED:
+        victim = next((m for m in _attached if m not in _pinned), None)
+        if victim is None:
+            break
+        conn.execute(f'DETACH DATABASE {_attached.pop(victim)}')
+    os.makedirs(_PARTITION_DIR, exist_ok=True)
+    conn.execute(f'ATTACH DATABASE ? AS {alias}', (path,))
+    _attached[month] = alias
+    if not exists:
+        conn.execute(f'PRAGMA {alias}.auto_vacuum=INCREMENTAL')
+        conn.execute(f'PRAGMA {alias}.journal_mode=WAL')
+        _create_partition_schema(conn, alias, month)
+        months = _months()
+        if month not in months:
+            months.append(month)
+            months.sort()
+    return alias
+
+
+def list_partitions() -> list:
+    """Return [{month, path, bytes, attached}] for every partition file, oldest first."""
+    with _db_lock:
+        months = list(_months())
+        attached = set(_attached)
+    items = []
+    for month in months:
+        path = _partition_path(month)
+        items.append({'month': month, 'path': path, 'bytes': _file_bytes(path), 'attached': month in attached})
+    return items
+
+
+def drop_partition(month: int) -> bool:
+    """Expire one month: detach it and delete its files. Returns False if it did not exist
+    or is being backed up (retry later)."""
+    global _global_rev
+    conn = _connect()
+    with _db_lock:
+        if month in _pinned:
+            return False
+        if month in _attached:
+            conn.execute(f'DETACH DATABASE {_attached.pop(month)}')
+        months = _months()
+        if month not in months:
+            return False
+        months.remove(month)
+        _global_rev += 1
+        path = _partition_path(month)
+        for ext in ('', '-wal', '-shm'):
+            if os.path.exists(path + ext):
+                os.remove(path + ext)
+    return True
+
+
+def legacy_migration_pending() -> bool:
+    return _legacy_pending
+
+
+def migrate_legacy_to_partitions(batch_size: int = 2000, pause: float = 0.05) -> int:
+    """Move rows of the pre-partitioning main tables into their monthly partitions.
+
+    Each chunk is copied with its original id, committed, then deleted from main and
+    committed again, so an interruption leaves at most duplicate copies that the next run
+    (and every reader, which de-duplicates by id) tolerates. Requires the epoch-ms backfill
+    to have finished. Returns the number of rows moved.
+    """
+    global _legacy_pending
+    conn = _connect()
+    moved = 0
+    for table, ms_col in (('sensor_data', 'ts_ms'), ('control_logs', 'created_ms')):
+        while True:
+            with _db_lock:
+                rows = conn.execute(f'SELECT * FROM main.{table} WHERE {ms_col} IS NOT NULL ORDER BY id LIMIT ?',
+                                    (int(batch_size),)).fetchall()
+                if not rows:
+                    break
+                cols = [c for c in rows[0].keys()]
+                by_month: dict = {}
+                for r in rows:
+                    by_month.setdefault(month_of(r[ms_col]), []).append(tuple(r))
+                for month, chunk in by_month.items():
+                    alias = _attach(conn, month, create=True)
+                    conn.executemany(
+                        f"INSERT OR IGNORE INTO {alias}.{table}({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                        chunk
+                    )
+                    conn.commit()
+                conn.executemany(f'DELETE FROM main.{table} WHERE id = ?', [(r['id'],) for r in rows])
+                conn.commit()
+            moved += len(rows)
+            time.sleep(pause)
+    while True:
+        with _db_lock:
+            blocks = conn.execute('SELECT * FROM main.sensor_blocks ORDER BY hour_ms LIMIT 20').fetchall()
+            if not blocks:
+                break
+            for b in blocks:
+                alias = _attach(conn, month_of(b['hour_ms']), create=True)
+                _write_block(conn, alias, b['device_id'], b['hour_ms'], _decode_block(b))
+                conn.execute('DELETE FROM main.sensor_blocks WHERE device_id = ? AND hour_ms = ?', (b['device_id'], b['hour_ms']))
+                conn.commit()
+            moved += len(blocks)
+        time.sleep(pause)
+    with _db_lock:
+        _legacy_pending = any(
+            conn.execute(f'SELECT 1 FROM main.{t} LIMIT 1').fetchone() is not None
+            for t in ('sensor_data', 'control_logs', 'sensor_blocks')
         )
-        # Migration: ensure cooldown_seconds column exists
+    return moved
+
+
+def _sources(start_ms, end_ms) -> list:
+    """Months to read for a time range, newest first, then None for the main tables while
+    they still hold pre-partitioning rows. Attach each month with _attach() only when it is
+    read, after the previous one's rows are fetched, so ranges longer than MAX_ATTACHED work."""
+    months = _months_in_range(start_ms, end_ms)
+    return months + [None] if _legacy_pending else months
+
+
+# --- Retention & vacuum ---
+#
+# Expired rows are deleted in small batches (or, when a whole month has expired for every
+# table, its partition file is deleted). Freed pages are returned to the filesystem by
+# PRAGMA incremental_vacuum in rate-limited steps. Totals are kept for the API.
+
+# table -> (epoch-ms column compared against the cutoff, key used to delete a batch)
+_RETENTION_TABLES = {
+    'sensor_data': ('ts_ms', 'rowid'),
+    'sensor_blocks': ('last_ms', 'device_id, hour_ms'),
+    'control_logs': ('created_ms', 'rowid'),
+}
+# files above this size are not converted to auto_vacuum=INCREMENTAL (that needs a full VACUUM)
+VACUUM_CONVERT_MAX_BYTES = 64 * 1024 * 1024
+_maintenance = {
+    'rows_pruned': {t: 0 for t in _RETENTION_TABLES},
+    'partitions_dropped': 0,
+    'bytes_reclaimed': 0,
+    'last_prune_ms': None,
+    'last_vacuum_ms': None,
+}
+
+
+def _file_bytes(path: str) -> int:
+    return sum(os.path.getsize(path + ext) for ext in ('', '-wal') if os.path.exists(path + ext))
+
+
+def prune_expired(retention_days: dict, batch_size: int = 500, pause: float = 0.05) -> dict:
+    """Delete rows older than their table's retention.
+
+    retention_days: {table: days}; tables missing or set to 0/None are kept forever.
+    A partition whose month has expired for all three tables is dropped as a file;
+    otherwise rows are deleted in batches of `batch_size`, one short transaction each.
+    Skipped while pre-partitioning rows are still being migrated. Returns
+    {'rows': {table: n}, 'partitions': n, 'bytes': n} for this run.
+    """
+    now = now_ms()
+    cutoffs = {t: now - int(d) * 86400000 for t, d in (retention_days or {}).items() if t in _RETENTION_TABLES and d}
+    result = {'rows': {t: 0 for t in _RETENTION_TABLES}, 'partitions': 0, 'bytes': 0}
+    if not cutoffs or _legacy_pending:
+        return result
+    conn = _connect()
+    with _db_lock:
+        months = [m for m in _months() if month_start_ms(m) < max(cutoffs.values())]
+    for month in months:
+        month_end = month_start_ms(_next_month(month))
+        if len(cutoffs) == len(_RETENTION_TABLES) and all(c >= month_end for c in cutoffs.values()):
+            size = _file_bytes(_partition_path(month))
+            if drop_partition(month):
+                result['partitions'] += 1
+                result['bytes'] += size
+            continue
+        for table, cutoff in cutoffs.items():
+            col, key = _RETENTION_TABLES[table]
+            if cutoff <= month_start_ms(month):
+                continue
+            while True:
+                with _db_lock:
+                    alias = _attach(conn, month)
+                    if alias is None:
+                        break
+                    cur = conn.execute(
+                        f'DELETE FROM {alias}.{table} WHERE ({key}) IN (SELECT {key} FROM {alias}.{table} WHERE {col} < ? LIMIT ?)',
+                        (cutoff, int(batch_size))
+                    )
+                    conn.commit()
+                    n = cur.rowcount
+                result['rows'][table] += n
+                if n < batch_size:
+                    break
+                time.sleep(pause)
+    global _global_rev
+    with _db_lock:
+        if any(result['rows'].values()):
+            _global_rev += 1
+        for table, n in result['rows'].items():
+            _maintenance['rows_pruned'][table] += n
+        _maintenance['partitions_dropped'] += result['partitions']
+        _maintenance['bytes_reclaimed'] += result['bytes']
+        _maintenance['last_prune_ms'] = now
+    return result
+
+
+def incremental_vacuum(max_pages: int = 256, budget_s: float = 5.0, pause: float = 0.2) -> int:
+    """Return free pages of the main file and the partitions to the filesystem.
+
+    Each step frees at most `max_pages` pages under the database lock, then sleeps `pause`
+    seconds so ingestion gets the lock in between; stops after `budget_s` seconds. Files
+    still in auto_vacuum=NONE mode are converted first if they are small enough. Returns
+    bytes reclaimed.
+    """
+    conn = _connect()
+    deadline = time.monotonic() + budget_s
+    reclaimed = 0
+    with _db_lock:
+        targets = [None] + list(_months())
+    for month in targets:
+        vacuumed = False
+        while time.monotonic() < deadline:
+            with _db_lock:
+                schema = 'main' if month is None else _attach(conn, month)
+                if schema is None:
+                    break
+                path = _DB_PATH if month is None else _partition_path(month)
+                if conn.execute(f'PRAGMA {schema}.auto_vacuum').fetchone()[0] != 2:
+                    if _file_bytes(path) > VACUUM_CONVERT_MAX_BYTES:
+                        break
+                    before = _file_bytes(path)
+                    conn.execute(f'PRAGMA {schema}.auto_vacuum=INCREMENTAL')
+                    conn.execute(f'VACUUM {schema}')
+                    reclaimed += max(0, before - _file_bytes(path))
+                    continue
+                free = conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]
+                if not free:
+                    if vacuumed:
+                        # in WAL mode the file only shrinks once the log is checkpointed
+                        conn.execute(f'PRAGMA {schema}.wal_checkpoint(TRUNCATE)').fetchall()
+                    break
+                vacuumed = True
+                page_size = conn.execute(f'PRAGMA {schema}.page_size').fetchone()[0]
+                # executescript steps the pragma to completion (execute() frees a single page)
+                conn.executescript(f'PRAGMA {schema}.incremental_vacuum({min(free, int(max_pages))});')
+                reclaimed += (free - conn.execute(f'PRAGMA {schema}.freelist_count').fetchone()[0]) * page_size
+            time.sleep(pause)
+    with _db_lock:
+        _maintenance['bytes_reclaimed'] += reclaimed
+        _maintenance['last_vacuum_ms'] = now_ms()
+    return reclaimed
+
+
+def maintenance_stats() -> dict:
+    """Pruning / vacuum totals since start, plus current file sizes and free space."""
+    conn = _connect()
+    with _db_lock:
+        stats = {**_maintenance, 'rows_pruned': dict(_maintenance['rows_pruned'])}
+        free = conn.execute('PRAGMA main.freelist_count').fetchone()[0] * conn.execute('PRAGMA main.page_size').fetchone()[0]
+    partitions = list_partitions()
+    stats['main_bytes'] = _file_bytes(_DB_PATH)
+    stats['main_free_bytes'] = free
+    stats['partition_bytes'] = sum(p['bytes'] for p in partitions)
+    stats['partitions'] = len(partitions)
+    return stats
+
+
+# --- Online backup ---
+#
+# backup_database() copies the main file and every partition with the SQLite backup API while
+# the server keeps running. It uses the shared connection, so writes made between steps are
+# folded into the copy instead of restarting it, and holds the database lock only for one
+# step of `pages` pages at a time. Each file is consistent on its own; the snapshot as a
+# whole is not a single point in time (rows written mid-backup may appear in some files only).
+
+BACKUP_DIR = os.path.join(os.path.dirname(__file__), 'backups')
+_backup_state = {
+    'running': False,
+    'snapshot': None,
+    'file': None,
+    'files_done': 0,
+    'files_total': 0,
+    'pages_done': 0,
+    'pages_total': 0,
+    'bytes': 0,
+    'started_ms': None,
+    'finished_ms': None,
+    'error': None,
+}
+_backup_guard = threading.Lock()
+
+
+def backup_status() -> dict:
+    return dict(_backup_state)
+
+
+def list_backups() -> list:
+    """Snapshots in BACKUP_DIR, newest first: [{name, path, bytes, files}]."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    items = []
+    for name in sorted(os.listdir(BACKUP_DIR), reverse=True):
+        path = os.path.join(BACKUP_DIR, name)
+        if not os.path.isdir(path) or name.startswith('.'):
+            continue
+        files = [os.path.join(root, f) for root, _, fs in os.walk(path) for f in fs]
+        items.append({'name': name, 'path': path, 'bytes': sum(os.path.getsize(f) for f in files), 'files': len(files)})
+    return items
+
+
+def _backup_file(conn, schema: str, dest: str, pages: int, pause: float):
+    """Copy one schema of the shared connection to `dest`. Caller holds _db_lock;
+    it is released between steps."""
+    base_done, base_total = _backup_state['pages_done'], _backup_state['pages_total']
+
+    def progress(status, remaining, total):
+        _backup_state['pages_total'] = base_total + total
+        _backup_state['pages_done'] = base_done + total - remaining
+        _db_lock.release()
         try:
-            conn.execute("ALTER TABLE irrigation_policies ADD COLUMN cooldown_seconds INTEGER")
-        except Exception:
-            pass
+            time.sleep(pause)
+        finally:
+            _db_lock.acquire()
 
-        # Trigger: update devices.last_seen on any control_logs insert
-        conn.execute(
-            """
-            CREATE TRIGGER IF NOT EXISTS trg_control_log_update_last_seen
-            AFTER INSERT ON control_logs
-            BEGIN
-                UPDATE devices SET last_seen = datetime('now') WHERE id = NEW.device_id;
-            END;
-            """
-        )
-        conn.commit()
+    target = sqlite3.connect(dest + '.part')
+    try:
+        conn.backup(target, pages=pages, progress=progress, name=schema)
+        # the copy inherits WAL mode from the source; fold the log back into one self-contained file
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+
+
+def _finish_backup_file(dest: str, compress: bool) -> int:
+    """Move the finished copy into place, gzip-compressing it first with `compress`. Returns bytes written."""
+    if compress:
+        with open(dest + '.part', 'rb') as src, gzip.open(dest + '.gz.part', 'wb', compresslevel=6) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        os.remove(dest + '.part')
+        dest += '.gz'
+    os.replace(dest + '.part', dest)
+    return os.path.getsize(dest)
+
+
+def backup_database(pages: int = 256, pause: float = 0.05, compress: bool = False, keep: int = 7) -> dict:
+    """Write a snapshot to BACKUP_DIR/<UTC timestamp>/ (data.sqlite3 + partitions/p_YYYYMM.sqlite3,
+    each gzip-compressed with `compress`), then delete all but the newest `keep` snapshots.
+
+    Copies `pages` pages per step and sleeps `pause` seconds between steps with the database
+    lock released, so ingestion and queries keep running. Only one backup runs at a time;
+    raises RuntimeError if another is in progress. Returns backup_status().
+    """
+    if not _backup_guard.acquire(blocking=False):
+        raise RuntimeError('backup already running')
+    snapshot = None
+    try:
+        flush_last_seen()
+        snapshot = os.path.join(BACKUP_DIR, datetime.now(timezone.utc).strftime('%Y%m%d-%H%M%S'))
+        conn = _connect()
+        with _db_lock:
+            months = list(_months())
+        _backup_state.update(running=True, snapshot=snapshot, file=None, files_done=0, files_total=1 + len(months),
+                             pages_done=0, pages_total=0, bytes=0, started_ms=now_ms(), finished_ms=None, error=None)
+        os.makedirs(os.path.join(snapshot, 'partitions'), exist_ok=True)
+        for month in [None] + months:
+            dest = os.path.join(snapshot, os.path.basename(_DB_PATH)) if month is None else \
+                os.path.join(snapshot, 'partitions', os.path.basename(_partition_path(month)))
+            _backup_state['file'] = os.path.basename(dest)
+            with _db_lock:
+                schema = 'main' if month is None else _attach(conn, month)
+                if schema is None:
+                    # dropped by retention since the backup started
+                    _backup_state['files_total'] -= 1
+                    continue
+                if month is not None:
+                    _pinned.add(month)
+                try:
+                    _backup_file(conn, schema, dest, pages, pause)
+                finally:
+                    _pinned.discard(month)
+            _backup_state['bytes'] += _finish_backup_file(dest, compress)
+            _backup_state['files_done'] += 1
+        for old in list_backups()[max(1, int(keep)):]:
+            shutil.rmtree(old['path'], ignore_errors=True)
+    except Exception as e:
+        _backup_state['error'] = str(e)
+        if snapshot is not None:
+            shutil.rmtree(snapshot, ignore_errors=True)
+        raise
+    finally:
+        _backup_state.update(running=False, file=None, finished_ms=now_ms())
+        _backup_guard.release()
+    return backup_status()
 
 
 def ensure_default_device(name: str = 'stm32_device_1') -> int:
@@ -140,105 +967,737 @@ def ensure_default_device(name: str = 'stm32_device_1') -> int:
         return conn.execute('SELECT id FROM devices WHERE name=?', (name,)).fetchone()['id']
 
 
+# --- Device last_seen ---
+#
+# Every sensor frame and control marks its device as seen. Writing devices.last_seen each
+# time costs an UPDATE + commit per sample, so the value is kept here and written back by
+# flush_last_seen() (periodically, before backups and at shutdown). Readers go through
+# device_last_seen(), which prefers the in-memory value.
+
+_last_seen: dict = {}
+_last_seen_dirty: set = set()
+_last_seen_lock = threading.Lock()
+
+
+def touch_device(device_id: int, ms: int | None = None):
+    """Record that a device was seen now (or at epoch-ms `ms`). Memory only."""
+    ms = now_ms() if ms is None else int(ms)
+    with _last_seen_lock:
+        if ms > _last_seen.get(device_id, 0):
+            _last_seen[device_id] = ms
+            _last_seen_dirty.add(device_id)
+
+
 def update_device_last_seen(device_id: int):
+    touch_device(device_id)
+
+
+def device_last_seen(device_id: int, stored: str | None = None) -> str | None:
+    """The newer of the in-memory value and `stored` (devices.last_seen)."""
+    with _last_seen_lock:
+        ms = _last_seen.get(device_id)
+    return max(filter(None, (ms_to_text(ms) if ms else None, stored)), default=None)
+
+
+def flush_last_seen() -> int:
+    """Write pending last_seen values to the devices table in one transaction. Returns
+    the number of devices updated."""
+    with _last_seen_lock:
+        pending = [(ms_to_text(_last_seen[d]), d) for d in _last_seen_dirty]
+        _last_seen_dirty.clear()
+    if not pending:
+        return 0
     conn = _connect()
-    with _db_lock:
-        conn.execute('UPDATE devices SET last_seen=? WHERE id=?',
-                     (datetime.utcnow().isoformat(sep=' ', timespec='seconds'), device_id))
-        conn.commit()
+    try:
+        with _db_lock:
+            # never move a stored value backwards (the text format sorts chronologically)
+            conn.executemany('UPDATE devices SET last_seen = ? WHERE id = ? AND (last_seen IS NULL OR last_seen < ?)',
+                             [(text, d, text) for text, d in pending])
+            conn.commit()
+    except sqlite3.Error:
+        with _last_seen_lock:
+            _last_seen_dirty.update(d for _, d in pending)
+        raise
+    return len(pending)
 
 
-def insert_sensor_data(device_id: int, temperature, humidity, lux, soil, ts: str):
+def insert_sensor_data(device_id: int, temperature, humidity, lux, soil, ts=None):
+    """ts: epoch ms, or any format accepted by to_epoch_ms(); defaults to now. Returns the new row id."""
+    ts_ms = now_ms() if ts is None else _bound_ms(ts)
     conn = _connect()
     with _db_lock:
-        conn.execute(
-            'INSERT INTO sensor_data(device_id, temperature, humidity, lux, soil, timestamp) VALUES (?, ?, ?, ?, ?, ?)',
-            (device_id, temperature, humidity, lux, soil, ts)
+        alias = _attach(conn, month_of(ts_ms), create=True)
+        cur = conn.execute(
+            f'INSERT INTO {alias}.sensor_data(device_id, temperature, humidity, lux, soil, timestamp, ts_ms) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (device_id, temperature, humidity, lux, soil, ms_to_text(ts_ms), ts_ms)
         )
         conn.commit()
+        _bump('sensor', device_id, ts_ms)
+    return cur.lastrowid
+
+
+def insert_sensor_data_batch(device_id: int, rows) -> tuple[int, int]:
+    """Insert many readings, one transaction per monthly partition.
+    rows: iterable of (temperature, humidity, lux, soil, ts) tuples, ts as for insert_sensor_data().
+    Rows whose (device_id, ts_ms) already exists, in the table or earlier in
+    the batch, are skipped. Returns (inserted, duplicates).
+    """
+    seen = set()
+    by_month: dict = {}
+    total = 0
+    for temperature, humidity, lux, soil, ts in rows:
+        total += 1
+        ts_ms = _bound_ms(ts)
+        if ts_ms in seen:
+            continue
+        seen.add(ts_ms)
+        by_month.setdefault(month_of(ts_ms), []).append(
+            (device_id, temperature, humidity, lux, soil, ms_to_text(ts_ms), ts_ms, device_id, ts_ms))
+    conn = _connect()
+    inserted = 0
+    with _db_lock:
+        for month, params in sorted(by_month.items()):
+            alias = _attach(conn, month, create=True)
+            # readings that fall in already-compacted hours are checked against the blocks
+            existing = _block_stamps(conn, alias, device_id, {p[6] - p[6] % HOUR_MS for p in params})
+            if _legacy_pending:
+                existing |= _block_stamps(conn, 'main', device_id, {p[6] - p[6] % HOUR_MS for p in params})
+            if existing:
+                params = [p for p in params if p[6] not in existing]
+            legacy_check = ' AND NOT EXISTS (SELECT 1 FROM main.sensor_data WHERE device_id = ? AND ts_ms = ?)' if _legacy_pending else ''
+            if legacy_check:
+                params = [p + (device_id, p[6]) for p in params]
+            before = conn.total_changes
+            try:
+                conn.executemany(
+                    f'INSERT INTO {alias}.sensor_data(device_id, temperature, humidity, lux, soil, timestamp, ts_ms) '
+                    f'SELECT ?, ?, ?, ?, ?, ?, ? WHERE NOT EXISTS '
+                    f'(SELECT 1 FROM {alias}.sensor_data WHERE device_id = ? AND ts_ms = ?){legacy_check}',
+                    params
+                )
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            inserted += conn.total_changes - before
+        if inserted:
+            # uploads that reach back before the newest row fill in history clients may already have
+            stamps = [p[6] for ps in by_month.values() for p in ps]
+            latest = _latest_ts.get(('sensor', device_id))
+            _bump('sensor', device_id, max(stamps), rewrite=latest is None or min(stamps) <= latest, min_ts=min(stamps))
+    return inserted, total - inserted
+
+
+def _block_stamps(conn, schema: str, device_id: int, hours) -> set:
+    hours = sorted(hours)
+    stamps = set()
+    for i in range(0, len(hours), 500):
+        chunk = hours[i:i + 500]
+        for block in conn.execute(
+            f"SELECT * FROM {schema}.sensor_blocks WHERE device_id = ? AND hour_ms IN ({', '.join('?' * len(chunk))})",
+            (device_id, *chunk)
+        ).fetchall():
+            stamps.update(r['ts_ms'] for r in _decode_block(block))
+    return stamps
+
+
+def device_exists(device_id: int) -> bool:
+    conn = _connect()
+    with _db_lock:
+        return conn.execute('SELECT 1 FROM devices WHERE id=?', (int(device_id),)).fetchone() is not None
 
 
 def insert_control_log(device_id: int, actuator: str | None, action: str | None, raw_command: str, success: bool):
+    ms = now_ms()
     conn = _connect()
     with _db_lock:
+        alias = _attach(conn, month_of(ms), create=True)
         conn.execute(
-            'INSERT INTO control_logs(device_id, actuator, action, raw_command, success) VALUES (?, ?, ?, ?, ?)',
-            (device_id, actuator, action, raw_command, 1 if success else 0)
+            f'INSERT INTO {alias}.control_logs(device_id, actuator, action, raw_command, success, created_at, created_ms) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (device_id, actuator, action, raw_command, 1 if success else 0, ms_to_text(ms), ms)
         )
         conn.commit()
+        _bump('control', device_id, ms)
+    touch_device(device_id, ms)
+
+
+# --- Cold storage: compressed hourly blocks ---
+#
+# Closed hours of sensor_data are packed into one sensor_blocks row per device per hour.
+# ts_blob holds the row ids and ts_ms as delta-of-delta zigzag varints (regular sampling
+# encodes to runs of zeros). Each value channel is a presence bitmap plus either
+# zigzag varint deltas of the value in tenths, when every value is an exact tenth (the
+# firmware only produces those), or the XOR of consecutive IEEE-754 bit patterns.
+# Every blob is zlib-compressed. Decoding is lossless, ids included, so cold rows read back
+# exactly as the hot rows they replaced.
+
+HOUR_MS = 3600 * 1000
+_CHANNELS = ('temperature', 'humidity', 'lux', 'soil')
+_MODE_TENTHS, _MODE_XOR = 1, 2
+
+
+def _put_varint(out: bytearray, n: int):
+    n = (n << 1) if n >= 0 else ((-n) << 1) - 1  # zigzag
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
 
+def _get_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            break
+        shift += 7
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
 
-def query_sensor_history(device_id: int | None = None, start: str | None = None, end: str | None = None,
-                         limit: int = 100, offset: int = 0):
-    """Return a list of rows dicts from sensor_data ordered by id desc.
-    Timestamps use 'YYYY-MM-DD HH:MM:SS' string comparison.
+
+def _encode_ints(values) -> bytes:
+    out = bytearray()
+    prev = prev_delta = 0
+    for v in values:
+        delta = v - prev
+        _put_varint(out, delta - prev_delta)
+        prev, prev_delta = v, delta
+    return bytes(out)
+
+
+def _decode_ints(buf: bytes, count: int, pos: int = 0) -> tuple[list, int]:
+    values = []
+    prev = prev_delta = 0
+    for _ in range(count):
+        dod, pos = _get_varint(buf, pos)
+        prev_delta += dod
+        prev += prev_delta
+        values.append(prev)
+    return values, pos
+
+
+def _encode_channel(values) -> bytes:
+    bitmap = bytearray((len(values) + 7) // 8)
+    present = []
+    for i, v in enumerate(values):
+        if v is not None:
+            bitmap[i >> 3] |= 1 << (i & 7)
+            present.append(float(v))
+    if all(round(v * 10) / 10 == v for v in present):
+        out = bytearray([_MODE_TENTHS]) + bitmap
+        prev = 0
+        for v in present:
+            t = round(v * 10)
+            _put_varint(out, t - prev)
+            prev = t
+    else:
+        out = bytearray([_MODE_XOR]) + bitmap
+        prev = 0
+        for v in present:
+            bits = struct.unpack('>Q', struct.pack('>d', v))[0]
+            out += struct.pack('>Q', bits ^ prev)
+            prev = bits
+    return zlib.compress(bytes(out), 6)
+
+
+def _decode_channel(blob: bytes, count: int) -> list:
+    buf = zlib.decompress(blob)
+    mode = buf[0]
+    nbytes = (count + 7) // 8
+    bitmap, pos = buf[1:1 + nbytes], 1 + nbytes
+    values = [None] * count
+    prev = 0
+    for i in range(count):
+        if not bitmap[i >> 3] & (1 << (i & 7)):
+            continue
+        if mode == _MODE_TENTHS:
+            d, pos = _get_varint(buf, pos)
+            prev += d
+            values[i] = prev / 10
+        else:
+            prev ^= struct.unpack_from('>Q', buf, pos)[0]
+            pos += 8
+            values[i] = struct.unpack('>d', struct.pack('>Q', prev))[0]
+    return values
+
+
+def _encode_block(rows) -> dict:
+    """rows: dicts with id, ts_ms and the channel columns, ascending by (ts_ms, id)."""
+    ids = _encode_ints(r['id'] for r in rows)
+    ts = _encode_ints(r['ts_ms'] for r in rows)
+    block = {'n': len(rows), 'first_ms': rows[0]['ts_ms'], 'last_ms': rows[-1]['ts_ms'],
+             'ts_blob': zlib.compress(ids + ts, 6)}
+    for ch in _CHANNELS:
+        block[ch + '_blob'] = _encode_channel([r[ch] for r in rows])
+    return block
+
+
+def _decode_block(block) -> list:
+    """Decode a sensor_blocks row into sensor_data-shaped dicts, ascending by (ts_ms, id)."""
+    n = block['n']
+    buf = zlib.decompress(block['ts_blob'])
+    ids, pos = _decode_ints(buf, n)
+    stamps, _ = _decode_ints(buf, n, pos)
+    channels = [_decode_channel(block[ch + '_blob'], n) for ch in _CHANNELS]
+    device_id = block['device_id']
+    return [
+        {'id': ids[i], 'device_id': device_id, 'temperature': channels[0][i], 'humidity': channels[1][i],
+         'lux': channels[2][i], 'soil': channels[3][i], 'timestamp': ms_to_text(stamps[i]), 'ts_ms': stamps[i]}
+        for i in range(n)
+    ]
+
+
+def _write_block(conn, schema: str, device_id: int, hour: int, rows):
+    """Store rows as the block for (device_id, hour), merging with an existing block by id."""
+    existing = conn.execute(f'SELECT * FROM {schema}.sensor_blocks WHERE device_id = ? AND hour_ms = ?',
+                            (device_id, hour)).fetchone()
+    merged = {r['id']: r for r in (_decode_block(existing) if existing else [])}
+    merged.update((r['id'], r) for r in rows)
+    block = _encode_block(sorted(merged.values(), key=lambda r: (r['ts_ms'], r['id'])))
+    conn.execute(
+        f'INSERT OR REPLACE INTO {schema}.sensor_blocks(device_id, hour_ms, n, first_ms, last_ms, ts_blob, '
+        'temperature_blob, humidity_blob, lux_blob, soil_blob) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (device_id, hour, block['n'], block['first_ms'], block['last_ms'], block['ts_blob'],
+         *(block[ch + '_blob'] for ch in _CHANNELS))
+    )
+
+
+def compact_sensor_blocks(older_than_ms: int, max_blocks: int = 50, pause: float = 0.05) -> int:
+    """Move hot sensor_data rows of closed hours before `older_than_ms` into sensor_blocks.
+
+    Works through the monthly partitions oldest first. Each device-hour is one short
+    transaction: rows arriving late for an hour that is already compacted are merged
+    into its block. Returns the number of blocks written; call again until it returns 0.
+    Does nothing while iter_sensor_rows() is streaming, since moving rows between the
+    hot and cold tables would make the stream skip or repeat them.
     """
     conn = _connect()
+    cutoff = older_than_ms - older_than_ms % HOUR_MS
+    written = 0
+    with _db_lock:
+        device_ids = [r['id'] for r in conn.execute('SELECT id FROM devices')]
+        months = [m for m in _months() if month_start_ms(m) < cutoff]
+    for month in months:
+        for device_id in device_ids:
+            while written < max_blocks:
+                with _db_lock:
+                    if _streams_active:
+                        return written
+                    alias = _attach(conn, month)
+                    if alias is None:
+                        break
+                    # MIN over the (device_id, ts_ms) index is a single seek
+                    first = conn.execute(f'SELECT MIN(ts_ms) FROM {alias}.sensor_data WHERE device_id = ? AND ts_ms < ?',
+                                         (device_id, cutoff)).fetchone()[0]
+                    if first is None:
+                        break
+                    hour = first - first % HOUR_MS
+                    try:
+                        rows = [dict(r) for r in conn.execute(
+                            f'SELECT id, device_id, temperature, humidity, lux, soil, ts_ms FROM {alias}.sensor_data '
+                            'WHERE device_id = ? AND ts_ms >= ? AND ts_ms < ?',
+                            (device_id, hour, hour + HOUR_MS)
+                        ).fetchall()]
+                        _write_block(conn, alias, device_id, hour, rows)
+                        conn.executemany(f'DELETE FROM {alias}.sensor_data WHERE id = ?', [(r['id'],) for r in rows])
+                        conn.commit()
+                    except Exception:
+                        conn.rollback()
+                        raise
+                written += 1
+                time.sleep(pause)
+    return written
+
+
+def _cold_history(conn, schema: str, device_id, start_ms, end_ms, need: int) -> list:
+    """Decode blocks overlapping [start_ms, end_ms], newest hour first, until at least `need`
+    rows are collected and the current hour is complete. Returns rows newest first."""
+    sql = [f'SELECT * FROM {schema}.sensor_blocks WHERE 1=1']
+    params: list = []
+    if device_id is not None:
+        sql.append('AND device_id = ?')
+        params.append(device_id)
+    if start_ms is not None:
+        sql.append('AND last_ms >= ?')
+        params.append(start_ms)
+    if end_ms is not None:
+        sql.append('AND first_ms <= ?')
+        params.append(end_ms)
+    sql.append('ORDER BY hour_ms DESC')
+    out: list = []
+    hour = None
+    for block in conn.execute(' '.join(sql), tuple(params)).fetchall():
+        if len(out) >= need and block['hour_ms'] != hour:
+            break
+        hour = block['hour_ms']
+        for r in reversed(_decode_block(block)):
+            if (start_ms is None or r['ts_ms'] >= start_ms) and (end_ms is None or r['ts_ms'] <= end_ms):
+                out.append(r)
+    return out
+
+
+def _source_history(conn, schema: str, legacy: bool, device_id, start_ms, end_ms, need: int) -> list:
+    """Newest `need` (or more) rows of one source, hot and cold merged, newest first."""
     sql = [
-        'SELECT id, device_id, temperature, humidity, lux, soil, timestamp',
-        'FROM sensor_data WHERE 1=1'
+        'SELECT id, device_id, temperature, humidity, lux, soil, timestamp, ts_ms',
+        f'FROM {schema}.sensor_data WHERE 1=1'
     ]
     params: list = []
     if device_id is not None:
         sql.append('AND device_id = ?')
         params.append(device_id)
-    if start:
-        sql.append('AND timestamp >= ?')
-        params.append(start)
-    if end:
-        sql.append('AND timestamp <= ?')
-        params.append(end)
-    sql.append('ORDER BY id DESC')
-    sql.append('LIMIT ? OFFSET ?')
-    params.extend([int(limit), int(offset)])
-    q = ' '.join(sql)
+    _append_range(sql, params, 'ts_ms', 'timestamp', start_ms, end_ms, legacy)
+    sql.append('ORDER BY ts_ms DESC, id DESC LIMIT ?')
+    params.append(need)
+    rows = [dict(r) for r in conn.execute(' '.join(sql), tuple(params)).fetchall()]
+    return rows + _cold_history(conn, schema, device_id, start_ms, end_ms, need)
+
+
+def _merge_newest(rows, key) -> list:
+    """De-duplicate by id (a row may briefly exist in two places while it is being moved) and sort newest first."""
+    merged = {r['id']: r for r in rows}
+    return sorted(merged.values(), key=lambda r: (r[key] or 0, r['id']), reverse=True)
+
+
+def query_sensor_history(device_id: int | None = None, start=None, end=None,
+                         limit: int = 100, offset: int = 0, fill_heartbeat_s: int | None = None):
+    """Return a list of rows dicts from sensor_data, newest first (ts_ms desc, id desc).
+    start/end are epoch ms or any format accepted by to_epoch_ms(); string end bounds are
+    inclusive of their whole second/minute/day. Raises ValueError on unparseable bounds.
+    Hot rows and compacted blocks are merged transparently, across the monthly partitions
+    the range touches.
+
+    Rows are stored on change (deadband + heartbeat), so a value holds until the next row.
+    With `fill_heartbeat_s` set, the result is padded for step rendering: the last row before
+    `start` is carried in at `start`, and the newest value is held up to `end` (or now).
+    Padding never extends a value past one heartbeat, so device outages stay visible as gaps.
+    Synthetic rows have id None and a `filled` marker ('carry' / 'hold').
+    """
+    start_ms, end_ms = _bound_ms(start), _bound_ms(end, inclusive_end=True)
+    need = int(limit) + int(offset)
+    conn = _connect()
+    with _db_lock:
+        rows: list = []
+        partition_rows = 0
+        for month in _sources(start_ms, end_ms):
+            if month is None:
+                rows.extend(_source_history(conn, 'main', True, device_id, start_ms, end_ms, need))
+                continue
+            # partitions cover disjoint months, newest first: stop once a page's worth is collected
+            alias = _attach(conn, month) if partition_rows < need else None
+            if alias:
+                found = _source_history(conn, alias, False, device_id, start_ms, end_ms, need)
+                partition_rows += len(found)
+                rows.extend(found)
+        rows = _merge_newest(rows, 'ts_ms')[int(offset):need]
+        carry = None
+        if fill_heartbeat_s and start_ms is not None and len(rows) < int(limit):
+            # the page reaches the start of the range: look up the value in force at `start`
+            for month in _sources(None, start_ms - 1):
+                schema = 'main' if month is None else _attach(conn, month)
+                found = _source_history(conn, schema, month is None, device_id, None, start_ms - 1, 1) if schema else []
+                if found:
+                    best = _merge_newest(found, 'ts_ms')[0]
+                    if carry is None or (best['ts_ms'] or 0) > (carry['ts_ms'] or 0):
+                        carry = best
+                    if month is not None:
+                        break
+    if fill_heartbeat_s:
+        rows = fill_history(rows, device_id, start_ms, end_ms, int(fill_heartbeat_s) * 1000, carry, hold=int(offset) == 0)
+    return rows
+
+
+# Field order of the tuples yielded by iter_sensor_rows()
+SENSOR_ROW_FIELDS = ('ts_ms', 'id', 'device_id', 'temperature', 'humidity', 'lux', 'soil')
+_ROW_KEY = operator.itemgetter(0, 1)
+
+
+def iter_sensor_rows(device_id: int | None = None, start=None, end=None, chunk_size: int = 5000):
+    """Yield every sensor row in range oldest first ((ts_ms, id) ascending), hot and cold,
+    across partitions, without materialising the range, as plain tuples in SENSOR_ROW_FIELDS
+    order (the cheap form for numeric consumers). Rows are fetched in keyset-paginated
+    chunks of `chunk_size`, each under its own short hold of the database lock. Rows still
+    waiting for the epoch-ms backfill are not included."""
+    global _streams_active
+    start_ms, end_ms = _bound_ms(start), _bound_ms(end, inclusive_end=True)
     with _db_lock:
-        cur = conn.execute(q, tuple(params))
-        rows = [dict(r) for r in cur.fetchall()]
+        sources = _sources(start_ms, end_ms)
+        _streams_active += 1
+    try:
+        yield from _iter_sources(sources, device_id, start_ms, end_ms, chunk_size)
+    finally:
+        with _db_lock:
+            _streams_active -= 1
+
+
+def iter_sensor_history(device_id: int | None = None, start=None, end=None, chunk_size: int = 5000):
+    """iter_sensor_rows() as sensor_data-shaped dicts (with the legacy `timestamp` text)."""
+    for ts_ms, row_id, dev, temperature, humidity, lux, soil in iter_sensor_rows(device_id, start, end, chunk_size):
+        yield {'id': row_id, 'device_id': dev, 'temperature': temperature, 'humidity': humidity,
+               'lux': lux, 'soil': soil, 'timestamp': ms_to_text(ts_ms), 'ts_ms': ts_ms}
+
+
+def _iter_sources(sources, device_id, start_ms, end_ms, chunk_size: int):
+    months = sorted(m for m in sources if m is not None)
+    partitions = (r for month in months
+                  for r in heapq.merge(_iter_hot(month, device_id, start_ms, end_ms, chunk_size),
+                                       _iter_cold(month, device_id, start_ms, end_ms), key=_ROW_KEY))
+    if None in sources:
+        yield from heapq.merge(heapq.merge(_iter_hot(None, device_id, start_ms, end_ms, chunk_size),
+                                           _iter_cold(None, device_id, start_ms, end_ms), key=_ROW_KEY),
+                               partitions, key=_ROW_KEY)
+    else:
+        yield from partitions
+
+
+def _iter_hot(month, device_id, start_ms, end_ms, chunk_size: int):
+    conn = _connect()
+    last = None
+    while True:
+        sql = ['SELECT ts_ms, id, device_id, temperature, humidity, lux, soil']
+        params: list = []
+        with _db_lock:
+            schema = 'main' if month is None else _attach(conn, month)
+            if schema is None:
+                return
+            sql.append(f'FROM {schema}.sensor_data WHERE ts_ms IS NOT NULL')
+            if device_id is not None:
+                sql.append('AND device_id = ?')
+                params.append(device_id)
+            _append_range(sql, params, 'ts_ms', 'timestamp', start_ms, end_ms)
+            if last is not None:
+                sql.append('AND (ts_ms, id) > (?, ?)')
+                params.extend(last)
+            sql.append('ORDER BY ts_ms, id LIMIT ?')
+            params.append(int(chunk_size))
+            cur = conn.cursor()
+            # plain tuples: building sqlite3.Row objects dominates the cost of a long scan
+            cur.row_factory = None
+            rows = cur.execute(' '.join(sql), tuple(params)).fetchall()
+        yield from rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1][:2]
+
+
+def _iter_cold(month, device_id, start_ms, end_ms, chunk_size: int = 20):
+    conn = _connect()
+    last = None
+    while True:
+        sql = []
+        params: list = []
+        with _db_lock:
+            schema = 'main' if month is None else _attach(conn, month)
+            if schema is None:
+                return
+            sql.append(f'SELECT * FROM {schema}.sensor_blocks WHERE 1=1')
+            if device_id is not None:
+                sql.append('AND device_id = ?')
+                params.append(device_id)
+            if start_ms is not None:
+                sql.append('AND last_ms >= ?')
+                params.append(start_ms)
+            if end_ms is not None:
+                sql.append('AND first_ms <= ?')
+                params.append(end_ms)
+            if last is not None:
+                sql.append('AND (hour_ms, device_id) > (?, ?)')
+                params.extend(last)
+            sql.append('ORDER BY hour_ms, device_id LIMIT ?')
+            params.append(int(chunk_size))
+            blocks = conn.execute(' '.join(sql), tuple(params)).fetchall()
+        # blocks of different devices for the same hour interleave in time
+        rows = heapq.merge(*([(r['ts_ms'], r['id'], r['device_id'], r['temperature'], r['humidity'], r['lux'], r['soil'])
+                              for r in _decode_block(b)] for b in blocks), key=_ROW_KEY)
+        yield from (r for r in rows if (start_ms is None or r[0] >= start_ms) and (end_ms is None or r[0] <= end_ms))
+        if len(blocks) < chunk_size:
+            return
+        last = (blocks[-1]['hour_ms'], blocks[-1]['device_id'])
+
+
+def fill_history(rows, device_id, start_ms, end_ms, window_ms, carry, hold):
+    """Pad newest-first history rows for step rendering (see query_sensor_history()): `carry`
+    is the last row before start_ms, `hold` extends the newest value towards end/now."""
+    def synthetic(src, ms, kind):
+        return {'id': None, 'device_id': device_id, 'temperature': src['temperature'], 'humidity': src['humidity'],
+                'lux': src['lux'], 'soil': src['soil'], 'timestamp': ms_to_text(ms), 'ts_ms': ms, 'filled': kind}
+
+    if hold and rows and rows[0]['ts_ms'] is not None:
+        newest = rows[0]['ts_ms']
+        hold_ms = min(t for t in (newest + window_ms, end_ms, now_ms()) if t is not None)
+        if hold_ms > newest:
+            rows.insert(0, synthetic(rows[0], hold_ms, 'hold'))
+    if carry is not None and start_ms - carry['ts_ms'] <= window_ms:
+        rows.append(synthetic(dict(carry), start_ms, 'carry'))
     return rows
 
 
 def query_control_logs(device_id: int | None = None, limit: int = 100, offset: int = 0):
+    return query_control_logs_range(device_id=device_id, limit=limit, offset=offset)
+
+
+def query_device_status(device_id: int):
+    """Return device info with basic aggregates."""
+    conn = _connect()
+    with _db_lock:
+        row = conn.execute('SELECT id, name, description, last_seen FROM devices WHERE id = ?', (device_id,)).fetchone()
+        if not row:
+            return None
+        item = dict(row)
+        item['last_seen'] = device_last_seen(device_id, item['last_seen'])
+        item['count_24h'] = 0
+        item['latest_data_ms'] = None
+        since = now_ms() - 86400000
+        for month in _sources(since, None):
+            schema = 'main' if month is None else _attach(conn, month)
+            if schema is None:
+                continue
+            item['count_24h'] += conn.execute(
+                f'SELECT COUNT(*) FROM {schema}.sensor_data WHERE device_id = ? AND ts_ms >= ?', (device_id, since)
+            ).fetchone()[0]
+            for b in conn.execute(f'SELECT * FROM {schema}.sensor_blocks WHERE device_id = ? AND last_ms >= ?',
+                                  (device_id, since)).fetchall():
+                item['count_24h'] += b['n'] if b['first_ms'] >= since else sum(1 for r in _decode_block(b) if r['ts_ms'] >= since)
+        for month in _sources(None, None):
+            schema = 'main' if month is None else _attach(conn, month)
+            if schema is None:
+                continue
+            latest = conn.execute(
+                f'SELECT MAX(m) FROM (SELECT MAX(ts_ms) AS m FROM {schema}.sensor_data WHERE device_id = ? '
+                f'UNION ALL SELECT MAX(last_ms) FROM {schema}.sensor_blocks WHERE device_id = ?)',
+                (device_id, device_id)
+            ).fetchone()[0]
+            if latest is not None and (item['latest_data_ms'] is None or latest > item['latest_data_ms']):
+                item['latest_data_ms'] = latest
+            if latest is not None and month is not None:
+                break
+    item['latest_data_ts'] = ms_to_text(item['latest_data_ms']) if item['latest_data_ms'] is not None else None
+    return item
+
+
+# --- Device health helpers ---
+
+def upsert_device_health(device_id: int, health_json: str):
+    conn = _connect()
+    with _db_lock:
+        conn.execute(
+            "INSERT INTO device_health(device_id, health_json, updated_at) VALUES (?, ?, datetime('now')) "
+            "ON CONFLICT(device_id) DO UPDATE SET health_json=excluded.health_json, updated_at=excluded.updated_at",
+            (int(device_id), health_json)
+        )
+        conn.commit()
+
+
+def query_device_health(device_id: int | None = None):
+    """Return the latest health frame per device, decoded from JSON."""
     conn = _connect()
     sql = [
-        'SELECT id, device_id, actuator, action, raw_command, success, created_at',
-        'FROM control_logs WHERE 1=1'
+        'SELECT h.device_id, d.name, h.health_json, h.updated_at',
+        'FROM device_health h JOIN devices d ON d.id = h.device_id WHERE 1=1'
     ]
     params: list = []
+    if device_id is not None:
+        sql.append('AND h.device_id = ?')
+        params.append(device_id)
+    sql.append('ORDER BY h.device_id')
+    with _db_lock:
+        rows = conn.execute(' '.join(sql), tuple(params)).fetchall()
+    items = []
+    for r in rows:
+        item = dict(r)
+        item['health'] = json.loads(item.pop('health_json'))
+        items.append(item)
+    return items
+
+
+# --- Anomalies ---
+
+def insert_anomalies(flags: list) -> int:
+    """Store anomaly flags ({'device_id', 'channel', 'kind', 'ts_ms', 'value', 'score', 'detail'})."""
+    if not flags:
+        return 0
+    conn = _connect()
+    with _db_lock:
+        conn.executemany(
+            'INSERT INTO anomalies(device_id, channel, kind, value, score, detail, ts_ms) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            [(f['device_id'], f['channel'], f['kind'], f.get('value'), f.get('score'), f.get('detail'), int(f['ts_ms']))
+             for f in flags]
+        )
+        conn.commit()
+    return len(flags)
+
+
+def query_anomalies(device_id: int | None = None, start=None, end=None, kind: str | None = None, limit: int = 100, offset: int = 0):
+    """Anomaly flags newest first, with the UTC text time added as `timestamp`."""
+    start_ms, end_ms = _bound_ms(start), _bound_ms(end, inclusive_end=True)
+    sql = ['SELECT * FROM anomalies WHERE 1=1']
+    params: list = []
     if device_id is not None:
         sql.append('AND device_id = ?')
         params.append(device_id)
-    sql.append('ORDER BY id DESC')
-    sql.append('LIMIT ? OFFSET ?')
+    if kind:
+        sql.append('AND kind = ?')
+        params.append(kind)
+    if start_ms is not None:
+        sql.append('AND ts_ms >= ?')
+        params.append(start_ms)
+    if end_ms is not None:
+        sql.append('AND ts_ms <= ?')
+        params.append(end_ms)
+    sql.append('ORDER BY ts_ms DESC, id DESC LIMIT ? OFFSET ?')
     params.extend([int(limit), int(offset)])
-    q = ' '.join(sql)
+    conn = _connect()
     with _db_lock:
-        cur = conn.execute(q, tuple(params))
-        rows = [dict(r) for r in cur.fetchall()]
+        rows = [dict(r) for r in conn.execute(' '.join(sql), tuple(params)).fetchall()]
+    for r in rows:
+        r['timestamp'] = ms_to_text(r['ts_ms'])
     return rows
 
 
+def prune_anomalies(retention_days) -> int:
+    """Delete anomaly flags older than `retention_days` (0/None keeps them forever)."""
+    if not retention_days:
+        return 0
+    conn = _connect()
+    with _db_lock:
+        cur = conn.execute('DELETE FROM anomalies WHERE ts_ms < ?', (now_ms() - int(retention_days) * 86400000,))
+        conn.commit()
+    return cur.rowcount
 
 
-def query_device_status(device_id: int):
-    """Return device info with basic aggregates."""
+# --- Sampling config helpers ---
+
+SAMPLING_CHANNELS = ('dht_ms', 'lux_ms', 'soil_ms')
+DEADBAND_COLUMNS = ('temp_db', 'humi_db', 'lux_db', 'soil_db')
+_SAMPLING_COLUMNS = SAMPLING_CHANNELS + DEADBAND_COLUMNS + ('heartbeat_s',)
+
+
+def get_sampling_config(device_id: int):
     conn = _connect()
     with _db_lock:
         row = conn.execute(
-            """
-            SELECT d.id, d.name, d.description, d.last_seen,
-                   (SELECT COUNT(*) FROM sensor_data s
-                      WHERE s.device_id = d.id
-                        AND s.timestamp >= datetime('now','-1 day')) AS count_24h,
-                   (SELECT MAX(timestamp) FROM sensor_data s
-                      WHERE s.device_id = d.id) AS latest_data_ts
-            FROM devices d WHERE d.id = ?
-            """,
+            f"SELECT device_id, {', '.join(_SAMPLING_COLUMNS)}, updated_at FROM sampling_configs WHERE device_id = ?",
             (device_id,)
         ).fetchone()
         return dict(row) if row else None
 
 
+def upsert_sampling_config(device_id: int, settings: dict):
+    """Set sampling intervals (ms), deadbands and heartbeat (s); keys not in `settings` keep their value."""
+    values = [settings.get(k) for k in _SAMPLING_COLUMNS]
+    updates = ', '.join(f'{c}=COALESCE(excluded.{c}, {c})' for c in _SAMPLING_COLUMNS)
+    conn = _connect()
+    with _db_lock:
+        conn.execute(
+            f"INSERT INTO sampling_configs(device_id, {', '.join(_SAMPLING_COLUMNS)}, updated_at) "
+            f"VALUES (?, {', '.join('?' for _ in _SAMPLING_COLUMNS)}, datetime('now')) "
+            f"ON CONFLICT(device_id) DO UPDATE SET {updates}, updated_at=excluded.updated_at",
+            (int(device_id), *values)
+        )
+        conn.commit()
+
+
 # --- Irrigation policy helpers ---
 
 def get_irrigation_policy(device_id: int):
@@ -278,42 +1737,121 @@ def upsert_irrigation_policy(device_id: int, enabled: int,
         conn.commit()
 
 
+def list_irrigation_policies():
+    """The current (newest) irrigation policy of every device."""
+    conn = _connect()
+    with _db_lock:
+        rows = conn.execute(
+            """
+            SELECT id, device_id, enabled, soil_threshold_min, watering_seconds, cooldown_seconds, updated_at
+            FROM irrigation_policies
+            WHERE id IN (SELECT MAX(id) FROM irrigation_policies GROUP BY device_id)
+            ORDER BY device_id
+            """
+        ).fetchall()
+        return [dict(r) for r in rows]
+
+
+# --- Control rule helpers ---
+
+_RULE_COLUMNS = ('device_id', 'name', 'enabled', 'conditions', 'actuator', 'action', 'duration_s', 'cooldown_s')
+
+
+def _rule_row(row) -> dict:
+    item = dict(row)
+    item['conditions'] = json.loads(item['conditions'])
+    return item
+
+
+def list_rules(device_id: int | None = None) -> list:
+    """Control rules with `conditions` decoded from JSON, by id."""
+    conn = _connect()
+    sql, params = 'SELECT * FROM control_rules', ()
+    if device_id is not None:
+        sql, params = sql + ' WHERE device_id = ?', (device_id,)
+    with _db_lock:
+        rows = conn.execute(sql + ' ORDER BY id', params).fetchall()
+    return [_rule_row(r) for r in rows]
+
+
+def get_rule(rule_id: int):
+    conn = _connect()
+    with _db_lock:
+        row = conn.execute('SELECT * FROM control_rules WHERE id = ?', (rule_id,)).fetchone()
+    return _rule_row(row) if row else None
+
+
+def save_rule(rule: dict, rule_id: int | None = None) -> int | None:
+    """Insert a rule, or replace rule `rule_id`; returns its id (None if `rule_id` does not exist)."""
+    values = [rule.get(c) for c in _RULE_COLUMNS]
+    values[_RULE_COLUMNS.index('conditions')] = json.dumps(rule.get('conditions') or [])
+    values[_RULE_COLUMNS.index('enabled')] = 1 if rule.get('enabled', True) else 0
+    conn = _connect()
+    with _db_lock:
+        if rule_id is None:
+            cur = conn.execute(
+                f"INSERT INTO control_rules({', '.join(_RULE_COLUMNS)}) VALUES ({', '.join('?' for _ in _RULE_COLUMNS)})",
+                values
+            )
+            rule_id = cur.lastrowid
+        else:
+            cur = conn.execute(
+                f"UPDATE control_rules SET {', '.join(c + '=?' for c in _RULE_COLUMNS)}, updated_at=datetime('now') WHERE id=?",
+                (*values, rule_id)
+            )
+            if cur.rowcount == 0:
+                return None
+        conn.commit()
+    return rule_id
+
+
+def delete_rule(rule_id: int) -> bool:
+    conn = _connect()
+    with _db_lock:
+        cur = conn.execute('DELETE FROM control_rules WHERE id = ?', (rule_id,))
+        conn.commit()
+    return cur.rowcount > 0
+
+
 # --- Control logs range query (for overlays) ---
 
 def query_control_logs_range(device_id: int | None = None,
-                             start: str | None = None,
-                             end: str | None = None,
+                             start=None,
+                             end=None,
                              actuator: str | None = None,
                              limit: int = 100,
                              offset: int = 0):
+    """Control logs newest first (created_ms desc, id desc), across the monthly partitions the range touches."""
+    start_ms, end_ms = _bound_ms(start), _bound_ms(end, inclusive_end=True)
+    need = int(limit) + int(offset)
     conn = _connect()
-    sql = [
-        'SELECT id, device_id, actuator, action, raw_command, success, created_at',
-        'FROM control_logs WHERE 1=1'
-    ]
-    params: list = []
-    if device_id is not None:
-        sql.append('AND device_id = ?')
-        params.append(device_id)
-    if start:
-        sql.append('AND created_at >= ?')
-        params.append(start)
-    if end:
-        sql.append('AND created_at <= ?')
-        params.append(end)
-    if actuator:
-        sql.append('AND actuator = ?')
-        params.append(actuator)
-    sql.append('ORDER BY id DESC')
-    sql.append('LIMIT ? OFFSET ?')
-    params.extend([int(limit), int(offset)])
-    q = ' '.join(sql)
     with _db_lock:
-        cur = conn.execute(q, tuple(params))
-        rows = [dict(r) for r in cur.fetchall()]
-    return rows
-
-
+        rows: list = []
+        partition_rows = 0
+        for month in _sources(start_ms, end_ms):
+            legacy = month is None
+            schema = 'main' if legacy else (_attach(conn, month) if partition_rows < need else None)
+            if schema is None:
+                continue
+            sql = [
+                'SELECT id, device_id, actuator, action, raw_command, success, created_at, created_ms',
+                f'FROM {schema}.control_logs WHERE 1=1'
+            ]
+            params: list = []
+            if device_id is not None:
+                sql.append('AND device_id = ?')
+                params.append(device_id)
+            _append_range(sql, params, 'created_ms', 'created_at', start_ms, end_ms, legacy)
+            if actuator:
+                sql.append('AND actuator = ?')
+                params.append(actuator)
+            sql.append('ORDER BY created_ms DESC, id DESC LIMIT ?')
+            params.append(need)
+            found = [dict(r) for r in conn.execute(' '.join(sql), tuple(params)).fetchall()]
+            if not legacy:
+                partition_rows += len(found)
+            rows.extend(found)
+    return _merge_newest(rows, 'created_ms')[int(offset):need]
 
 
 # --- User & Role helpers ---
@@ -0,0 +1,117 @@
+"""Visual downsampling of sensor history: Largest-Triangle-Three-Buckets per channel.
+
+Classic LTTB splits n points into equal-count buckets, which needs n up front. Here the
+range [start_ms, end_ms] is split into equal *time* buckets instead, so rows can be fed
+in ascending chunks straight from the database cursor: only the bucket being filled and
+the one waiting for its right neighbour's average are buffered. Empty buckets produce no
+point, so outages stay visible as gaps. Selection inside a bucket is vectorised NumPy.
+"""
+
+import numpy as np
+
+try:
+    from . import db as db
+    from .hotwindow import COLUMNS, rows_to_arrays
+except Exception:
+    import db
+    from hotwindow import COLUMNS, rows_to_arrays
+
+CHUNK_ROWS = 5000
+
+
+class LTTBStream:
+    """Streaming time-bucket LTTB for one channel."""
+
+    def __init__(self, start_ms: int, end_ms: int, n_points: int):
+        self.start = start_ms
+        self.span = max(1, end_ms - start_ms + 1)
+        # first and last point are kept as-is; the rest come one per bucket
+        self.buckets = max(1, n_points - 2)
+        self.out = []
+        self.a = None          # last selected point (ts, value)
+        self.pending = None    # complete bucket awaiting the next bucket's average
+        self.cur_id = None
+        self.cur = []          # chunks of (ts, values) for the bucket being filled
+        self.last = None
+
+    def _select(self, bucket, c):
+        ts = np.concatenate([t for t, _ in bucket]).astype(np.float64)
+        vs = np.concatenate([v for _, v in bucket])
+        ax, ay = self.a
+        cx, cy = c
+        area = np.abs((ax - cx) * (vs - ay) - (ax - ts) * (cy - ay))
+        i = int(np.argmax(area))
+        point = (int(ts[i]), float(vs[i]))
+        if point[0] != self.out[-1][0]:
+            self.out.append(point)
+        self.a = point
+
+    @staticmethod
+    def _mean(bucket):
+        n = sum(len(t) for t, _ in bucket)
+        return (sum(float(t.sum()) for t, _ in bucket) / n, sum(float(v.sum()) for _, v in bucket) / n)
+
+    def _close(self):
+        if self.pending is not None:
+            self._select(self.pending, self._mean(self.cur))
+        self.pending = self.cur
+
+    def feed(self, ts, values):
+        """Add ascending (ts, values) arrays; NaN values (channel missing) are skipped."""
+        keep = ~np.isnan(values)
+        ts, values = ts[keep], values[keep]
+        if not len(ts):
+            return
+        if self.a is None:
+            self.a = (int(ts[0]), float(values[0]))
+            self.out.append(self.a)
+        self.last = (int(ts[-1]), float(values[-1]))
+        ids = np.clip((ts - self.start) * self.buckets // self.span, 0, self.buckets - 1)
+        cuts = np.r_[0, np.flatnonzero(np.diff(ids)) + 1, len(ids)]
+        for lo, hi in zip(cuts[:-1], cuts[1:]):
+            bucket_id = int(ids[lo])
+            if bucket_id != self.cur_id:
+                if self.cur:
+                    self._close()
+                self.cur_id, self.cur = bucket_id, []
+            self.cur.append((ts[lo:hi], values[lo:hi]))
+
+    def finish(self) -> list:
+        """[[ts_ms, value], ...] ascending."""
+        if self.a is None:
+            return []
+        if self.cur:
+            self._close()
+        if self.pending is not None:
+            self._select(self.pending, self.last)
+        if self.last[0] != self.out[-1][0]:
+            self.out.append(self.last)
+        return [list(p) for p in self.out]
+
+
+def lttb(chunks, start_ms: int, end_ms: int, n_points: int) -> dict:
+    """Downsample ascending (ts, values[channel]) chunks. Returns {'series': {channel: [[ts, v], ...]},
+    'rows': rows scanned, 'bucket_ms': bucket width}."""
+    streams = [LTTBStream(start_ms, end_ms, n_points) for _ in COLUMNS]
+    rows = 0
+    for ts, values in chunks:
+        rows += len(ts)
+        for stream, col in zip(streams, values):
+            stream.feed(ts, col)
+    return {
+        'series': {name: stream.finish() for name, stream in zip(COLUMNS, streams)},
+        'rows': rows,
+        'bucket_ms': streams[0].span / streams[0].buckets,
+    }
+
+
+def db_chunks(device_id, start_ms, end_ms, chunk_rows: int = CHUNK_ROWS):
+    """Ascending (ts, values) chunks of at most `chunk_rows` rows from db.iter_sensor_rows()."""
+    batch = []
+    for r in db.iter_sensor_rows(device_id=device_id, start=start_ms, end=end_ms, chunk_size=chunk_rows):
+        batch.append(r)
+        if len(batch) >= chunk_rows:
+            yield rows_to_arrays(batch)
+            batch = []
+    if batch:
+        yield rows_to_arrays(batch)
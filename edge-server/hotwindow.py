@@ -0,0 +1,230 @@
+"""In-memory window of recent sensor readings, one NumPy ring buffer per device.
+
+The ingestion path appends every stored row; history requests that fall inside the window
+are answered from the arrays without touching SQLite. Each ring is authoritative from its
+`floor` timestamp on: every sensor_data row of the device with ts_ms >= floor is in the ring.
+Anything older (or a device whose ring is not loaded) goes to the database.
+
+Memory is fixed at start: max_devices * max_rows * 48 bytes (id, ts_ms, four float64 channels).
+"""
+
+import threading
+
+import numpy as np
+
+try:
+    from . import db as db
+except Exception:
+    import db
+
+COLUMNS = ('temperature', 'humidity', 'lux', 'soil')
+ROW_BYTES = 8 + 8 + 8 * len(COLUMNS)
+
+
+class Ring:
+    """Fixed-capacity ring of rows kept in (ts_ms, id) order."""
+
+    def __init__(self, device_id: int, capacity: int):
+        self.device_id = device_id
+        self.capacity = capacity
+        self.ids = np.zeros(capacity, dtype=np.int64)
+        self.ts = np.zeros(capacity, dtype=np.int64)
+        self.values = np.full((len(COLUMNS), capacity), np.nan)
+        self.head = 0
+        self.count = 0
+        # None: not loaded (or invalidated), reload from the database before use
+        self.floor = None
+        self.lock = threading.Lock()
+
+    def clear(self, floor):
+        self.head = 0
+        self.count = 0
+        self.floor = floor
+
+    def push(self, row_id: int, ts_ms: int, values) -> bool:
+        """Append one row. Returns False if it is older than the newest row (caller reloads)."""
+        if self.count:
+            last = (self.head - 1) % self.capacity
+            if ts_ms < self.ts[last] or (ts_ms == self.ts[last] and row_id <= self.ids[last]):
+                # the same row seen twice (loaded from the database, then appended by ingestion)
+                return bool(np.any(self.ids[:min(self.count, self.capacity)] == row_id))
+            if self.count == self.capacity:
+                # overwriting the oldest row: the window no longer covers its timestamp
+                self.floor = max(self.floor, int(self.ts[self.head]) + 1)
+        self.ids[self.head] = row_id
+        self.ts[self.head] = ts_ms
+        self.values[:, self.head] = [np.nan if v is None else v for v in values]
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        return True
+
+    def ordered(self):
+        """(ids, ts, values) oldest first; copies when the ring has wrapped."""
+        if self.count < self.capacity:
+            return self.ids[:self.count], self.ts[:self.count], self.values[:, :self.count]
+        order = np.r_[self.head:self.capacity, 0:self.head]
+        return self.ids[order], self.ts[order], self.values[:, order]
+
+
+def _value(v):
+    return None if np.isnan(v) else float(v)
+
+
+def _rows(device_id, ids, ts, values) -> list:
+    """sensor_data-shaped dicts from array slices (converted to Python scalars in bulk)."""
+    # same text as db.ms_to_text(), formatted for the whole slice at once
+    texts = np.char.replace(np.datetime_as_string(ts.astype('datetime64[ms]'), unit='s'), 'T', ' ').tolist()
+    cols = [[v if v == v else None for v in col] for col in values.tolist()]
+    return [{'id': i, 'device_id': device_id, 'temperature': t, 'humidity': h, 'lux': lx, 'soil': so, 'timestamp': text, 'ts_ms': ms}
+            for i, t, h, lx, so, text, ms in zip(ids.tolist(), *cols, texts, ts.tolist())]
+
+
+def rows_to_arrays(rows):
+    """(ts, values) arrays, oldest first, from db.iter_sensor_rows() tuples (None -> NaN)."""
+    table = np.array(list(rows), dtype=np.float64).reshape(-1, len(db.SENSOR_ROW_FIELDS))
+    return table[:, 0].astype(np.int64), np.ascontiguousarray(table[:, 3:].T)
+
+
+def aggregate(ts, values, bucket_ms: int, device_id=None) -> list:
+    """Mean/min/max per channel over fixed time buckets aligned to the epoch, newest bucket first.
+    ts must be ascending. Empty channels in a bucket are None."""
+    if not len(ts):
+        return []
+    buckets = ts // bucket_ms
+    starts = np.r_[0, np.flatnonzero(np.diff(buckets)) + 1]
+    counts = np.diff(np.r_[starts, len(ts)])
+    present = ~np.isnan(values)
+    n = np.add.reduceat(present, starts, axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.add.reduceat(np.where(present, values, 0.0), starts, axis=1) / n
+    lo = np.fmin.reduceat(values, starts, axis=1)
+    hi = np.fmax.reduceat(values, starts, axis=1)
+    out = []
+    for i in range(len(starts) - 1, -1, -1):
+        item = {'device_id': device_id, 'ts_ms': int(buckets[starts[i]] * bucket_ms), 'n': int(counts[i])}
+        item['timestamp'] = db.ms_to_text(item['ts_ms'])
+        for c, name in enumerate(COLUMNS):
+            item[name] = _value(mean[c, i])
+            item[name + '_min'] = _value(lo[c, i])
+            item[name + '_max'] = _value(hi[c, i])
+        out.append(item)
+    return out
+
+
+
+def aggregate_chunks(chunks, bucket_ms: int, device_id=None) -> list:
+    """aggregate() over ascending (ts, values) chunks (e.g. downsample.db_chunks()) without
+    holding the range in memory: the rows of each chunk's last bucket, which the next chunk
+    may continue, are carried over and aggregated with it."""
+    parts = []
+    carry = None
+    for ts, values in chunks:
+        if carry is not None:
+            ts, values = np.concatenate([carry[0], ts]), np.concatenate([carry[1], values], axis=1)
+        if not len(ts):
+            continue
+        cut = int(np.searchsorted(ts, ts[-1] // bucket_ms * bucket_ms, 'left'))
+        if cut:
+            parts.append(aggregate(ts[:cut], values[:, :cut], bucket_ms, device_id))
+        carry = ts[cut:], values[:, cut:]
+    if carry is not None:
+        parts.append(aggregate(*carry, bucket_ms, device_id))
+    return [item for part in reversed(parts) for item in part]
+
+class HotWindow:
+    """Per-device rings of the last `hours` of readings, at most `max_rows` rows per device
+    and `max_devices` devices (further devices are always served from the database). A ring
+    is only allocated when a reading is ingested for the device, never by a query, so
+    requests for unknown device ids cannot use up the slots."""
+
+    def __init__(self, hours: float = 6, max_rows: int = 20000, max_devices: int = 4):
+        self.hours = hours
+        self.max_rows = max(1, int(max_rows))
+        self.max_devices = max(0, int(max_devices))
+        self.rings: dict = {}
+        self.lock = threading.Lock()
+
+    def _ring(self, device_id, create: bool = False):
+        with self.lock:
+            ring = self.rings.get(device_id)
+            if ring is None and create and len(self.rings) < self.max_devices:
+                ring = self.rings[device_id] = Ring(device_id, self.max_rows)
+            return ring
+
+    def _load(self, ring: Ring):
+        """Refill a ring from the database (caller holds ring.lock)."""
+        since = db.now_ms() - int(self.hours * 3600000)
+        ring.clear(since)
+        for r in db.iter_sensor_rows(device_id=ring.device_id, start=since):
+            ring.push(r[1], r[0], r[3:])
+
+    def append(self, device_id: int, row_id, ts_ms: int, temperature, humidity, lux, soil):
+        """Record a row just inserted into sensor_data."""
+        ring = self._ring(device_id, create=True)
+        if ring is None or row_id is None:
+            return
+        with ring.lock:
+            if ring.floor is not None and not ring.push(row_id, ts_ms, (temperature, humidity, lux, soil)):
+                ring.floor = None
+
+    def invalidate(self, device_id: int):
+        """Rows were written out of order (batch / backlog uploads): reload on next use."""
+        ring = self._ring(device_id)
+        if ring is not None:
+            with ring.lock:
+                ring.floor = None
+
+    def history(self, device_id: int, start_ms=None, end_ms=None, limit: int = 100, offset: int = 0, need_carry: bool = False):
+        """Rows as db.query_sensor_history() would return them (newest first) plus the carry-in
+        row before start_ms, or None if the window cannot answer the request."""
+        ring = self._ring(device_id)
+        if ring is None:
+            return None
+        need = int(limit) + int(offset)
+        with ring.lock:
+            if ring.floor is None:
+                self._load(ring)
+            ids, ts, values = ring.ordered()
+            lo = 0 if start_ms is None else int(np.searchsorted(ts, start_ms, 'left'))
+            hi = len(ts) if end_ms is None else int(np.searchsorted(ts, end_ms, 'right'))
+            covered = start_ms is not None and start_ms >= ring.floor
+            if not covered and (hi - lo < need or (hi - need >= 0 and ts[hi - need] < ring.floor)):
+                return None
+            first, last = max(lo, hi - need), hi - int(offset)
+            carry = None
+            if need_carry and start_ms is not None and max(0, last - first) < int(limit):
+                if not covered or lo == 0:
+                    return None
+                carry = _rows(device_id, ids[lo - 1:lo], ts[lo - 1:lo], values[:, lo - 1:lo])[0]
+            rows = _rows(device_id, ids[first:last][::-1], ts[first:last][::-1], values[:, first:last][:, ::-1]) if last > first else []
+        return rows, carry
+
+    def arrays(self, device_id: int, start_ms, end_ms):
+        """(ts, values) copies of the window rows in [start_ms, end_ms], or None if start_ms
+        is before the window."""
+        ring = self._ring(device_id)
+        if ring is None or start_ms is None:
+            return None
+        with ring.lock:
+            if ring.floor is None:
+                self._load(ring)
+            if start_ms < ring.floor:
+                return None
+            ids, ts, values = ring.ordered()
+            lo = int(np.searchsorted(ts, start_ms, 'left'))
+            hi = len(ts) if end_ms is None else int(np.searchsorted(ts, end_ms, 'right'))
+            return ts[lo:hi].copy(), values[:, lo:hi].copy()
+
+    def aggregate(self, device_id: int, start_ms, end_ms, bucket_ms: int):
+        """aggregate() over the window, or None if start_ms is before the window."""
+        hit = self.arrays(device_id, start_ms, end_ms)
+        return None if hit is None else aggregate(*hit, bucket_ms, device_id)
+
+    def stats(self) -> dict:
+        with self.lock:
+            rings = list(self.rings.values())
+        return {
+            'hours': self.hours, 'max_rows': self.max_rows, 'max_devices': self.max_devices,
+            'bytes_reserved': self.max_devices * self.max_rows * ROW_BYTES,
+            'devices': {r.device_id: {'rows': r.count, 'floor_ms': r.floor} for r in rings},
+        }
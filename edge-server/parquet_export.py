@@ -0,0 +1,144 @@
+"""Columnar (Parquet) export of sensor history for offline analytics.
+
+Rows are streamed from db.iter_sensor_rows() into row groups of typed columns
+(timestamp[ms, UTC], device_id int32, float32 readings), so memory use is bounded by one row group
+regardless of the range exported. Readings are dictionary + RLE encoded (sensor
+values repeat a lot at 0.1 resolution; device_id costs next to nothing), timestamps delta-encoded, pages zstd-compressed.
+
+Used by /api/v1/sensors/history.parquet and as a CLI:
+
+    python parquet_export.py -o history.parquet --device-id 1 --start 2025-01-01 --end 2025-03-31
+"""
+
+import argparse
+import os
+import sys
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    PYARROW_AVAILABLE = True
+except ImportError:
+    pa = pq = None
+    PYARROW_AVAILABLE = False
+
+try:
+    from . import db as db
+except Exception:
+    import db
+
+ROW_GROUP_SIZE = 65536
+COLUMNS = ('temperature', 'humidity', 'lux', 'soil')
+
+
+def _schema():
+    return pa.schema([('timestamp', pa.timestamp('ms', tz='UTC')), ('device_id', pa.int32())]
+                     + [(c, pa.float32()) for c in COLUMNS])
+
+
+def _writer(sink):
+    return pq.ParquetWriter(
+        sink, _schema(),
+        compression='zstd' if pa.Codec.is_available('zstd') else 'snappy',
+        use_dictionary=['device_id', *COLUMNS],
+        column_encoding={'timestamp': 'DELTA_BINARY_PACKED'},
+        write_statistics=True,
+    )
+
+
+def _row_groups(device_id, start_ms, end_ms, row_group_size: int):
+    """Yield pyarrow Tables of at most `row_group_size` rows, oldest first."""
+    schema = _schema()
+    cols = {'timestamp': [], 'device_id': [], **{c: [] for c in COLUMNS}}
+    for r in db.iter_sensor_rows(device_id=device_id, start=start_ms, end=end_ms):
+        cols['timestamp'].append(r[0])
+        cols['device_id'].append(r[2])
+        for c, v in zip(COLUMNS, r[3:]):
+            cols[c].append(v)
+        if len(cols['timestamp']) >= row_group_size:
+            yield pa.Table.from_pydict(cols, schema=schema)
+            cols = {k: [] for k in cols}
+    if cols['timestamp']:
+        yield pa.Table.from_pydict(cols, schema=schema)
+
+
+def write_parquet(path: str, device_id=None, start_ms=None, end_ms=None, row_group_size: int = ROW_GROUP_SIZE) -> int:
+    """Write the range to a Parquet file at `path`. Returns the number of rows written."""
+    rows = 0
+    with _writer(path) as writer:
+        for table in _row_groups(device_id, start_ms, end_ms, row_group_size):
+            writer.write_table(table, row_group_size=row_group_size)
+            rows += table.num_rows
+    return rows
+
+
+class _ChunkSink:
+    """Write-only file object that hands written bytes back to a generator."""
+
+    def __init__(self):
+        self.chunks = []
+        self.pos = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_parquet(device_id=None, start_ms=None, end_ms=None, row_group_size: int = ROW_GROUP_SIZE):
+    """Yield a Parquet file as byte chunks, one per row group plus the footer (for HTTP streaming)."""
+    sink = _ChunkSink()
+    writer = _writer(sink)
+    try:
+        for table in _row_groups(device_id, start_ms, end_ms, row_group_size):
+            writer.write_table(table, row_group_size=row_group_size)
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Export sensor history to a Parquet file.')
+    parser.add_argument('-o', '--output', required=True, help='output .parquet path')
+    parser.add_argument('--device-id', type=int, default=None, help='device id (default: all devices)')
+    parser.add_argument('--start', help="start bound: 'YYYY-MM-DD', 'YYYY-MM-DD HH:MM:SS', ISO-8601 or epoch s/ms")
+    parser.add_argument('--end', help='end bound, inclusive of its whole day/minute/second')
+    parser.add_argument('--row-group-size', type=int, default=ROW_GROUP_SIZE)
+    parser.add_argument('--db', help='path to data.sqlite3 (partitions are read from its partitions/ directory)')
+    args = parser.parse_args(argv)
+    if not PYARROW_AVAILABLE:
+        print('pyarrow is not installed (pip install pyarrow)', file=sys.stderr)
+        return 2
+    if args.db:
+        db._DB_PATH = os.path.abspath(args.db)
+        db._PARTITION_DIR = os.path.join(os.path.dirname(db._DB_PATH), 'partitions')
+    start_ms = db.to_epoch_ms(args.start) if args.start else None
+    end_ms = db.to_epoch_ms(args.end, inclusive_end=True) if args.end else None
+    if (args.start and start_ms is None) or (args.end and end_ms is None):
+        parser.error('invalid --start/--end')
+    db.create_tables()
+    rows = write_parquet(args.output, args.device_id, start_ms, end_ms, args.row_group_size)
+    print(f'{rows} rows -> {args.output} ({os.path.getsize(args.output)} bytes)')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
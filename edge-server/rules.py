@@ -0,0 +1,309 @@
+"""Actuator rule engine.
+
+A rule combines sensor conditions and time-of-day windows (all must hold) with an
+actuator action, stored in the control_rules table as
+
+    {"device_id": 1, "name": "evening light", "enabled": 1,
+     "conditions": [{"channel": "lux", "op": "<", "value": 200, "hysteresis": 30},
+                    {"time": "18:00-23:00"}],
+     "actuator": "led_strip", "action": "on", "duration_s": null, "cooldown_s": 60}
+
+Two modes:
+
+- level (no duration_s): the action is sent when the conditions start to hold and the
+  opposite action when they stop. Once active, a sensor condition only releases past
+  its threshold plus `hysteresis` (e.g. lux < 200 holds until lux >= 230).
+- timed (duration_s): the action is sent, then the opposite one after duration_s (a
+  watering pulse). The rule fires again only once cooldown_s has passed since the pulse
+  ended and the conditions still hold.
+
+cooldown_s is also the minimum time between the on/off switches of a level rule. A rule
+may consist of time windows only (e.g. led_strip on 18:00-22:00).
+
+Rules are compiled once, when loaded (load() after any change), into tuples and a
+(device, channel) -> rules index. on_sample() re-evaluates only the rules that read a
+channel whose value changed; tick() handles timers (pulse ends, cooldown expiry) and
+time windows. The engine never talks to the hardware: it returns the actions to send.
+The single legacy irrigation policy per device compiles into a timed rule.
+"""
+
+import operator
+import threading
+import time
+
+SENSOR_CHANNELS = ('temperature', 'humidity', 'lux', 'soil')
+OPPOSITE = {'on': 'off', 'off': 'on'}
+_OPS = {'<': operator.lt, '<=': operator.le, '>': operator.gt, '>=': operator.ge}
+# a failed command (device not connected) is retried after this long
+RETRY_MS = 10000
+
+
+def _minute_of_day(now_ms: int) -> int:
+    t = time.localtime(now_ms / 1000)
+    return t.tm_hour * 60 + t.tm_min
+
+
+def _parse_hhmm(text: str) -> int:
+    h, m = text.strip().split(':')
+    h, m = int(h), int(m)
+    if not (0 <= h <= 24 and 0 <= m < 60 and h * 60 + m <= 1440):
+        raise ValueError(f'invalid time {text!r}')
+    return h * 60 + m
+
+
+class CompiledRule:
+    """A rule reduced to what evaluation needs: (channel, op, on/off thresholds) tuples and
+    (start, end) minute windows."""
+
+    __slots__ = ('key', 'device_id', 'name', 'actuator', 'action', 'duration_ms', 'cooldown_ms',
+                 'conds', 'windows', 'channels', 'source')
+
+    def __init__(self, key, device_id, name, conds, windows, actuator, action, duration_ms, cooldown_ms, source):
+        self.key, self.device_id, self.name = key, device_id, name
+        self.conds, self.windows = conds, windows
+        self.channels = frozenset(c for c, _, _, _ in conds)
+        self.actuator, self.action = actuator, action
+        self.duration_ms, self.cooldown_ms = duration_ms, cooldown_ms
+        self.source = source
+
+    def matches(self, values: dict, active: bool, minute: int) -> bool:
+        for channel, op, on, off in self.conds:
+            v = values.get(channel)
+            if v is None or not op(v, off if active else on):
+                return False
+        for start, end in self.windows:
+            if not (start <= minute < end if start <= end else minute >= start or minute < end):
+                return False
+        return True
+
+
+def compile_rule(rule: dict, key=None) -> CompiledRule:
+    """Validate a rule dict (as stored / as posted) and compile it. Raises ValueError."""
+    actuator, action = rule.get('actuator'), rule.get('action')
+    if not actuator or not isinstance(actuator, str):
+        raise ValueError('actuator is required')
+    if action not in OPPOSITE:
+        raise ValueError("action must be 'on' or 'off'")
+    conds, windows = [], []
+    for c in rule.get('conditions') or []:
+        if not isinstance(c, dict):
+            raise ValueError('each condition must be an object')
+        if 'time' in c:
+            start, _, end = str(c['time']).partition('-')
+            windows.append((_parse_hhmm(start), _parse_hhmm(end)))
+            continue
+        channel, op = c.get('channel'), c.get('op')
+        if channel not in SENSOR_CHANNELS:
+            raise ValueError(f'channel must be one of {list(SENSOR_CHANNELS)}')
+        if op not in _OPS:
+            raise ValueError(f'op must be one of {list(_OPS)}')
+        try:
+            value, hysteresis = float(c['value']), float(c.get('hysteresis') or 0)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('condition value/hysteresis must be numbers')
+        if hysteresis < 0:
+            raise ValueError('hysteresis must not be negative')
+        # once active, '<' / '<=' hold until the value rises past threshold + hysteresis
+        release = value + hysteresis if op in ('<', '<=') else value - hysteresis
+        conds.append((channel, _OPS[op], value, release))
+    if not conds and not windows:
+        raise ValueError('at least one condition or time window is required')
+    duration = rule.get('duration_s')
+    cooldown = rule.get('cooldown_s') or 0
+    try:
+        duration_ms = int(float(duration) * 1000) if duration not in (None, '') else None
+        cooldown_ms = int(float(cooldown) * 1000)
+    except (TypeError, ValueError):
+        raise ValueError('duration_s/cooldown_s must be numbers')
+    if (duration_ms is not None and duration_ms <= 0) or cooldown_ms < 0:
+        raise ValueError('duration_s must be positive and cooldown_s not negative')
+    return CompiledRule(key if key is not None else f"rule:{rule.get('id')}", int(rule.get('device_id') or 0),
+                        rule.get('name') or '', tuple(conds), tuple(windows), actuator, action, duration_ms,
+                        cooldown_ms, rule)
+
+
+def compile_irrigation_policy(policy: dict):
+    """The legacy irrigation policy as a timed rule (pump on for watering_seconds when soil is
+    below soil_threshold_min, at most once per cooldown_seconds), or None if disabled/incomplete."""
+    if not policy or not policy.get('enabled') or policy.get('soil_threshold_min') is None \
+            or not policy.get('watering_seconds') or policy['watering_seconds'] <= 0:
+        return None
+    return compile_rule({
+        'device_id': policy['device_id'], 'name': 'irrigation policy',
+        'conditions': [{'channel': 'soil', 'op': '<', 'value': policy['soil_threshold_min']}],
+        'actuator': 'pump', 'action': 'on', 'duration_s': policy['watering_seconds'],
+        'cooldown_s': policy.get('cooldown_seconds') or 0,
+    }, key=f"irrigation:{policy['device_id']}")
+
+
+class _State:
+    __slots__ = ('active', 'since_ms', 'last_change_ms', 'ready_ms', 'revert_ms', 'fired')
+
+    def __init__(self):
+        self.active = False
+        self.since_ms = None
+        self.last_change_ms = None
+        self.ready_ms = 0
+        self.revert_ms = None
+        self.fired = 0
+
+
+class RuleEngine:
+    """Compiled rules, their runtime state and the latest value of every channel per device."""
+
+    def __init__(self, minute_of_day=_minute_of_day):
+        self.minute_of_day = minute_of_day
+        self.lock = threading.Lock()
+        self.rules: dict = {}
+        self.by_channel: dict = {}
+        self.windowed: tuple = ()
+        self.state: dict = {}
+        self.timers: dict = {}
+        self.values: dict = {}
+        self.last_minute = None
+        self.errors: dict = {}
+
+    def load(self, rules: list, policies: list = (), now_ms: int | None = None) -> list:
+        """Replace the rule set (control_rules rows plus irrigation policies). Rules whose
+        definition is unchanged keep their state; an active rule that was removed, disabled
+        or changed is released first. Invalid stored rules are skipped (see errors)."""
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        compiled, errors = {}, {}
+        for row in rules:
+            if not row.get('enabled'):
+                continue
+            try:
+                rule = compile_rule(row)
+            except ValueError as e:
+                errors[f"rule:{row.get('id')}"] = str(e)
+                continue
+            compiled[rule.key] = rule
+        for policy in policies:
+            rule = compile_irrigation_policy(policy)
+            if rule is not None:
+                compiled[rule.key] = rule
+        actions = []
+        with self.lock:
+            for key, old in self.rules.items():
+                new = compiled.get(key)
+                if new is None or new.source != old.source:
+                    st = self.state.pop(key, None)
+                    self.timers.pop(key, None)
+                    if st is not None and (st.revert_ms is not None or (st.active and old.duration_ms is None)):
+                        actions.append(self._action(old, OPPOSITE[old.action], 'rule changed or removed', False))
+            by_channel: dict = {}
+            for rule in compiled.values():
+                self.state.setdefault(rule.key, _State())
+                for channel in rule.channels:
+                    by_channel.setdefault((rule.device_id, channel), []).append(rule)
+            self.rules, self.by_channel, self.errors = compiled, by_channel, errors
+            self.windowed = tuple(r for r in compiled.values() if r.windows)
+            # new rules see the current values right away
+            for rule in compiled.values():
+                actions.extend(self._evaluate(rule, now_ms, self.minute_of_day(now_ms)))
+        return actions
+
+    @staticmethod
+    def _action(rule, action, reason, start) -> dict:
+        return {'device_id': rule.device_id, 'actuator': rule.actuator, 'action': action, 'rule': rule.key,
+                'name': rule.name, 'reason': reason, 'start': start}
+
+    def _evaluate(self, rule: CompiledRule, now_ms: int, minute: int) -> list:
+        """Caller holds self.lock."""
+        st = self.state[rule.key]
+        if st.revert_ms is not None:
+            return []
+        match = rule.matches(self.values.get(rule.device_id, {}), st.active, minute)
+        if rule.duration_ms is not None:
+            if not match:
+                return []
+            if now_ms < st.ready_ms:
+                self.timers[rule.key] = st.ready_ms
+                return []
+            st.active, st.since_ms, st.last_change_ms, st.fired = True, now_ms, now_ms, st.fired + 1
+            st.revert_ms = now_ms + rule.duration_ms
+            self.timers[rule.key] = st.revert_ms
+            return [self._action(rule, rule.action, 'conditions met', True)]
+        if match == st.active:
+            return []
+        if st.last_change_ms is not None and now_ms < st.last_change_ms + rule.cooldown_ms:
+            self.timers[rule.key] = st.last_change_ms + rule.cooldown_ms
+            return []
+        st.active, st.last_change_ms = match, now_ms
+        if match:
+            st.since_ms, st.fired = now_ms, st.fired + 1
+            return [self._action(rule, rule.action, 'conditions met', True)]
+        return [self._action(rule, OPPOSITE[rule.action], 'conditions released', False)]
+
+    def on_sample(self, device_id, now_ms: int, readings: dict) -> list:
+        """Record a frame's readings {channel: value} and re-evaluate the rules reading any
+        channel whose value changed. Returns the actions to send."""
+        with self.lock:
+            values = self.values.setdefault(device_id, {})
+            affected = []
+            for channel, v in readings.items():
+                if v is None or values.get(channel) == v:
+                    continue
+                values[channel] = v
+                affected.extend(self.by_channel.get((device_id, channel), ()))
+            if not affected:
+                return []
+            minute = self.minute_of_day(now_ms)
+            actions = []
+            seen = set()
+            for rule in affected:
+                if rule.key not in seen:
+                    seen.add(rule.key)
+                    actions.extend(self._evaluate(rule, now_ms, minute))
+            return actions
+
+    def tick(self, now_ms: int | None = None) -> list:
+        """Fire due timers (pulse ends, cooldown expiry) and re-evaluate time-windowed rules
+        when the minute changes. Call about once a second."""
+        now_ms = int(time.time() * 1000) if now_ms is None else now_ms
+        actions = []
+        with self.lock:
+            minute = self.minute_of_day(now_ms)
+            due = [k for k, t in self.timers.items() if t <= now_ms]
+            for key in due:
+                del self.timers[key]
+                rule, st = self.rules.get(key), self.state.get(key)
+                if rule is None:
+                    continue
+                if st.revert_ms is not None and st.revert_ms <= now_ms:
+                    st.active, st.revert_ms, st.last_change_ms = False, None, now_ms
+                    st.ready_ms = now_ms + rule.cooldown_ms
+                    actions.append(self._action(rule, OPPOSITE[rule.action], 'duration elapsed', False))
+                    if rule.cooldown_ms:
+                        self.timers[key] = st.ready_ms
+                        continue
+                actions.extend(self._evaluate(rule, now_ms, minute))
+            if minute != self.last_minute:
+                self.last_minute = minute
+                for rule in self.windowed:
+                    if rule.key not in due:
+                        actions.extend(self._evaluate(rule, now_ms, minute))
+        return actions
+
+    def abort(self, key, now_ms: int):
+        """The start action of `key` could not be sent: forget it and retry in RETRY_MS."""
+        with self.lock:
+            st, rule = self.state.get(key), self.rules.get(key)
+            if st is None or rule is None:
+                return
+            st.active, st.revert_ms, st.last_change_ms = False, None, None
+            st.ready_ms = now_ms + RETRY_MS
+            self.timers[key] = st.ready_ms
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                'rules': {k: {'device_id': r.device_id, 'name': r.name, 'actuator': r.actuator, 'action': r.action,
+                              'mode': 'timed' if r.duration_ms is not None else 'level', 'channels': sorted(r.channels),
+                              'active': self.state[k].active, 'since_ms': self.state[k].since_ms,
+                              'revert_ms': self.state[k].revert_ms, 'ready_ms': self.state[k].ready_ms or None,
+                              'fired': self.state[k].fired}
+                          for k, r in self.rules.items()},
+                'errors': dict(self.errors),
+                'values': {str(d): dict(v) for d, v in self.values.items()},
+            }
@@ -0,0 +1,210 @@
+"""Per-device, per-channel statistics maintained incrementally at ingest.
+
+Each reading updates, in O(1) (amortised for the window extremes):
+
+- an EWMA mean and variance with a time constant (`tau_s`), so irregular sampling
+  weighs readings by elapsed time rather than by count;
+- a slower EWMA baseline (`drift_tau_s`) for drift detection;
+- the minimum and maximum over a sliding time window (monotonic deques);
+- the stuck-value run: how long and for how many readings the value has not changed.
+
+update() returns anomaly flags (dicts ready for db.insert_anomalies()):
+
+- 'zscore': |x - mean| / std above `z_threshold` once the channel is warmed up
+  (std is floored at the channel's `min_std`, about its sensor resolution);
+- 'stuck':  the value has not changed for `stuck_s[channel]` seconds (once per run);
+- 'drift':  the fast mean has moved more than `drift_z` baseline deviations away from
+  the slow baseline (re-armed once it comes back within half of that);
+- 'simulated': a health frame reports the DHT running on its simulated driver.
+
+The same kind is not flagged again for a channel within `cooldown_s`. expect_step()
+silences a channel for a while when a step change is expected (soil after watering).
+"""
+
+import math
+import threading
+from collections import deque
+
+# about one step of each sensor's resolution (DHT11: 1 degC / 1 %RH)
+MIN_STD = {'temperature': 0.5, 'humidity': 1.0, 'lux': 5.0, 'soil': 0.5}
+
+
+class ChannelStats:
+    """Streaming statistics of one channel."""
+
+    def __init__(self, window_ms: int, min_std: float = 0.0):
+        self.window_ms = window_ms
+        self.min_std = min_std
+        self.n = 0
+        self.first_ms = None
+        self.last_ms = None
+        self.last = None
+        self.mean = self.var = 0.0
+        self.base_mean = self.base_var = 0.0
+        self.mins: deque = deque()   # (ts, value), values ascending
+        self.maxs: deque = deque()   # (ts, value), values descending
+        self.run_value = None
+        self.run_start_ms = None
+        self.run_n = 0
+        self.stuck_flagged = False
+        self.drifting = False
+        self.z = None
+        self.quiet_until = 0
+        self.rebase = False
+
+    def _window(self, ts_ms: int, x: float):
+        while self.mins and self.mins[-1][1] >= x:
+            self.mins.pop()
+        self.mins.append((ts_ms, x))
+        while self.maxs and self.maxs[-1][1] <= x:
+            self.maxs.pop()
+        self.maxs.append((ts_ms, x))
+        edge = ts_ms - self.window_ms
+        while self.mins[0][0] < edge:
+            self.mins.popleft()
+        while self.maxs[0][0] < edge:
+            self.maxs.popleft()
+
+    @staticmethod
+    def _ewma(mean, var, x, alpha):
+        diff = x - mean
+        incr = alpha * diff
+        return mean + incr, (1 - alpha) * (var + diff * incr)
+
+    def update(self, ts_ms: int, x: float, tau_ms: float, drift_tau_ms: float):
+        """Fold in one reading; returns the z-score against the state before it (or None)."""
+        if self.n == 0:
+            self.mean = self.base_mean = x
+            self.first_ms = ts_ms
+            z = None
+        else:
+            dt = max(0, ts_ms - self.last_ms)
+            z = (x - self.mean) / max(math.sqrt(self.var), self.min_std)
+            self.mean, self.var = self._ewma(self.mean, self.var, x, 1 - math.exp(-dt / tau_ms))
+            if self.rebase and ts_ms >= self.quiet_until:
+                # the expected step is over: restart the baseline from the settled level
+                self.base_mean, self.base_var, self.rebase = self.mean, self.var, False
+            else:
+                self.base_mean, self.base_var = self._ewma(self.base_mean, self.base_var, x, 1 - math.exp(-dt / drift_tau_ms))
+        self._window(ts_ms, x)
+        if x != self.run_value:
+            self.run_value, self.run_start_ms, self.run_n, self.stuck_flagged = x, ts_ms, 0, False
+        self.run_n += 1
+        self.n += 1
+        self.last, self.last_ms, self.z = x, ts_ms, z
+        return z
+
+    def snapshot(self) -> dict:
+        return {
+            'n': self.n, 'last': self.last, 'last_ms': self.last_ms,
+            'mean': round(self.mean, 4), 'std': round(math.sqrt(self.var), 4), 'z': None if self.z is None else round(self.z, 3),
+            'baseline_mean': round(self.base_mean, 4), 'baseline_std': round(math.sqrt(self.base_var), 4),
+            'window_min': self.mins[0][1] if self.mins else None, 'window_max': self.maxs[0][1] if self.maxs else None,
+            'stuck_run': self.run_n, 'stuck_ms': (self.last_ms - self.run_start_ms) if self.run_start_ms is not None else 0,
+            'drifting': self.drifting, 'quiet_until_ms': self.quiet_until or None,
+        }
+
+
+class StreamStats:
+    """ChannelStats for every (device, channel) seen, plus anomaly detection."""
+
+    def __init__(self, tau_s: float = 600, drift_tau_s: float = 21600, window_s: float = 3600, z_threshold: float = 4.0,
+                 drift_z: float = 3.0, warmup: int = 20, cooldown_s: float = 300, stuck_s: dict | None = None,
+                 drift_channels=('soil',)):
+        self.tau_ms = tau_s * 1000
+        self.drift_tau_ms = drift_tau_s * 1000
+        self.window_ms = int(window_s * 1000)
+        self.z_threshold = z_threshold
+        self.drift_z = drift_z
+        self.warmup = warmup
+        self.cooldown_ms = cooldown_s * 1000
+        # 0 / missing: never flag (lux sits at 0 all night)
+        self.stuck_ms = {c: s * 1000 for c, s in (stuck_s or {'temperature': 1800, 'humidity': 1800}).items() if s}
+        self.drift_channels = set(drift_channels)
+        self.devices: dict = {}
+        self.drivers: dict = {}
+        self.last_flag: dict = {}
+        self.lock = threading.Lock()
+
+    def _channel(self, device_id, channel) -> ChannelStats:
+        chans = self.devices.setdefault(device_id, {})
+        ch = chans.get(channel)
+        if ch is None:
+            ch = chans[channel] = ChannelStats(self.window_ms, MIN_STD.get(channel, 0.0))
+        return ch
+
+    def _flag(self, out, device_id, channel, kind, ts_ms, value, score=None, detail=None):
+        key = (device_id, channel, kind)
+        last = self.last_flag.get(key)
+        if last is not None and ts_ms - last < self.cooldown_ms:
+            return
+        self.last_flag[key] = ts_ms
+        out.append({'device_id': device_id, 'channel': channel, 'kind': kind, 'ts_ms': ts_ms, 'value': value,
+                    'score': None if score is None else round(score, 3), 'detail': detail})
+
+    def update(self, device_id, ts_ms: int, readings: dict) -> list:
+        """Fold in one frame {channel: value} (missing / None channels are skipped). Readings
+        not newer than a channel's last one are ignored. Returns anomaly flags."""
+        out = []
+        with self.lock:
+            for channel, x in readings.items():
+                if x is None:
+                    continue
+                x = float(x)
+                ch = self._channel(device_id, channel)
+                if ch.last_ms is not None and ts_ms <= ch.last_ms:
+                    continue
+                z = ch.update(ts_ms, x, self.tau_ms, self.drift_tau_ms)
+                if ts_ms < ch.quiet_until:
+                    continue
+                if z is not None and ch.n > self.warmup and abs(z) > self.z_threshold:
+                    self._flag(out, device_id, channel, 'zscore', ts_ms, x, z, f'mean {ch.mean:.2f}')
+                stuck = self.stuck_ms.get(channel)
+                if stuck and not ch.stuck_flagged and ts_ms - ch.run_start_ms >= stuck:
+                    ch.stuck_flagged = True
+                    self._flag(out, device_id, channel, 'stuck', ts_ms, x, ch.run_n,
+                               f'unchanged for {(ts_ms - ch.run_start_ms) // 1000} s ({ch.run_n} readings)')
+                if channel in self.drift_channels and ch.n > self.warmup:
+                    d = abs(ch.mean - ch.base_mean) / max(math.sqrt(ch.base_var), ch.min_std)
+                    if not ch.drifting and d > self.drift_z:
+                        ch.drifting = True
+                        self._flag(out, device_id, channel, 'drift', ts_ms, x, d, f'baseline {ch.base_mean:.2f}')
+                    elif ch.drifting and d < self.drift_z / 2:
+                        ch.drifting = False
+        return out
+
+    def expect_step(self, device_id, channel: str, until_ms: int):
+        """A step change is expected (e.g. soil moisture while watering): keep updating the
+        statistics but raise no flags until `until_ms` (replacing any earlier deadline), then
+        restart the drift baseline."""
+        with self.lock:
+            ch = self._channel(device_id, channel)
+            ch.quiet_until = until_ms
+            ch.rebase = True
+
+    def note_driver(self, device_id, sensor: str, mode, ts_ms: int) -> list:
+        """Record the driver a health frame reports for `sensor`; flags a switch to 'simulated'."""
+        out = []
+        with self.lock:
+            previous = self.drivers.get((device_id, sensor))
+            self.drivers[(device_id, sensor)] = mode
+            if mode == 'simulated' and previous != 'simulated':
+                self._flag(out, device_id, sensor, 'simulated', ts_ms, None, None, f'driver {previous or "unknown"} -> simulated')
+        return out
+
+    def snapshot(self, device_id=None) -> dict:
+        with self.lock:
+            devices = set(self.devices) | {d for d, _ in self.drivers}
+            return {
+                str(dev): {
+                    'channels': {c: ch.snapshot() for c, ch in self.devices.get(dev, {}).items()},
+                    'drivers': {s: m for (d, s), m in self.drivers.items() if d == dev},
+                }
+                for dev in sorted(devices) if device_id is None or dev == device_id
+            }
+
+    def config(self) -> dict:
+        return {'tau_s': self.tau_ms / 1000, 'drift_tau_s': self.drift_tau_ms / 1000, 'window_s': self.window_ms / 1000,
+                'z_threshold': self.z_threshold, 'drift_z': self.drift_z, 'warmup': self.warmup,
+                'cooldown_s': self.cooldown_ms / 1000, 'stuck_s': {c: v / 1000 for c, v in self.stuck_ms.items()},
+                'drift_channels': sorted(self.drift_channels)}
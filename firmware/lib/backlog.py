@@ -0,0 +1,77 @@
+# 离线样本环形缓冲区 (store-and-forward)
+# 上位机未打开串口时, 把样本压缩成定长记录存入预分配的 RAM 环形缓冲区,
+# 主机重新连接并发送 {"sync": "backlog"} 后再分批补传
+
+import struct
+import json
+
+# 记录格式: 采样时刻(秒, RTC) | 温度x10 | 湿度x10 | 光照x10 | 土壤%
+_REC_FMT = '<IhhIb'
+_REC_SIZE = struct.calcsize(_REC_FMT)  # 13 字节
+
+# 缺失值哨兵
+_NO_I16 = -32768
+_NO_U32 = 0xFFFFFFFF
+_NO_I8 = -128
+
+
+def _pack_tenths_i16(v10):
+    return _NO_I16 if v10 is None else max(-32767, min(32767, v10))
+
+
+def _unpack_tenths(v, missing):
+    if v == missing: return None
+    return v // 10 if v % 10 == 0 else v / 10
+
+
+class SampleBacklog:
+    """
+    定长记录的环形缓冲区, 满了以后覆盖最旧的记录。
+
+    参数:
+        capacity: 最多缓存的样本条数 (每条 13 字节)
+    """
+
+    def __init__(self, capacity=1200):
+        self.capacity = capacity
+        self.buf = bytearray(capacity * _REC_SIZE)
+        self.head = 0       # 下一条写入的位置
+        self.count = 0      # 当前缓存条数
+        self.dropped = 0    # 因缓冲区满被覆盖的条数
+
+    def push(self, t, temp10, humi10, lux10, soil):
+        """写入一条样本, t 为 time.time() 秒数, 温度/湿度/光照为 10 倍整数"""
+        lux_v = _NO_U32 if lux10 is None else max(0, min(0xFFFFFFFE, lux10))
+        soil_v = _NO_I8 if soil is None else max(-127, min(127, soil))
+        struct.pack_into(_REC_FMT, self.buf, self.head * _REC_SIZE,
+                         t, _pack_tenths_i16(temp10), _pack_tenths_i16(humi10), lux_v, soil_v)
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity: self.count += 1
+        else: self.dropped += 1
+
+    def _pop_oldest(self):
+        idx = (self.head - self.count) % self.capacity
+        t, temp, humi, lux, soil = struct.unpack_from(_REC_FMT, self.buf, idx * _REC_SIZE)
+        self.count -= 1
+        return (t, _unpack_tenths(temp, _NO_I16), _unpack_tenths(humi, _NO_I16),
+                _unpack_tenths(lux, _NO_U32), None if soil == _NO_I8 else soil)
+
+    def drain(self, now, emit, batch=40):
+        """
+        按时间顺序取出全部样本, 每 batch 条拼成一帧交给 emit 输出。
+
+        帧格式: {"backlog": [[age_s, temp, humi, lux, soil], ...], "left": n}
+        age_s 为样本距 now 的秒数, 由上位机还原成原始采样时间。
+
+        返回:
+            int: 补传的样本条数
+        """
+        sent = 0
+        while self.count:
+            records = []
+            while self.count and len(records) < batch:
+                t, temp, humi, lux, soil = self._pop_oldest()
+                records.append([max(0, now - t), temp, humi, lux, soil])
+            sent += len(records)
+            emit(json.dumps({"backlog": records, "left": self.count}))
+        return sent
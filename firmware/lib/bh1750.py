@@ -0,0 +1,62 @@
+# BH1750 环境光传感器驱动模块
+# 原先内嵌在 main.py 中, 现纳入 SensorBase 体系以统一状态统计和采样间隔调度
+
+import time
+from sensor_base import SensorBase
+
+class BH1750Sensor(SensorBase):
+    """
+    BH1750 光照传感器 (连续高分辨率模式)
+    
+    照度以 10 倍整数保存在 lux10 中, 读取复用同一个缓冲区, 不产生新对象。
+    """
+    
+    WARMUP_MS = 180         # 首次转换最长 180ms
+    MIN_INTERVAL_MS = 120   # 高分辨率模式单次转换约 120ms
+    
+    def __init__(self, i2c, addr=0x23, fast_boot=False):
+        super().__init__(f"I2C 0x{addr:02X}", 'BH1750')
+        self.i2c = i2c
+        self.addr = addr
+        self.buf = bytearray(2)
+        self.lux10 = None
+        try:
+            if fast_boot:
+                # 快速启动: 连续下发上电/连续高分辨率命令, 首次转换期间不阻塞
+                self.i2c.writeto(self.addr, b'\x01'); self.i2c.writeto(self.addr, b'\x10')
+                self.start_warmup(self.WARMUP_MS)
+            else:
+                self.i2c.writeto(self.addr, b'\x01'); time.sleep_ms(10)
+                self.i2c.writeto(self.addr, b'\x10'); time.sleep_ms(120)
+            self.is_initialized = True; self.is_available = True
+        except Exception as e:
+            self.last_error = e
+            self._log_error(f"初始化失败: {e}")
+    
+    def measure(self):
+        # 预热中或未就绪时返回 False, 不计入读取统计
+        if self.is_warming and not self.warmup_done(): return False
+        if not self.is_ready(): return False
+        try:
+            self.i2c.readfrom_into(self.addr, self.buf)
+            self.lux10 = (((self.buf[0] << 8) | self.buf[1]) * 100 + 6) // 12  # raw / 1.2 * 10
+            self._update_read_stats(True)
+            return True
+        except Exception as e:
+            self.lux10 = None
+            self._update_read_stats(False, e)
+            return False
+    
+    def read_lux_x10(self):
+        return self.lux10 if self.measure() else None
+    
+    def read_lux(self):
+        lux10 = self.read_lux_x10()
+        return None if lux10 is None else lux10 / 10
+    
+    def get_data(self):
+        return {
+            'lux': None if self.lux10 is None else self.lux10 / 10,
+            'sensor_type': self.sensor_type,
+            'timestamp': self.last_read_time
+        }
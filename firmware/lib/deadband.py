@@ -0,0 +1,66 @@
+# 变化上报 (report-on-change) 过滤器
+# DHT11 只有整数精度, 土壤为整数百分比, 连续样本大多与上一次完全相同;
+# 只有变化超过死区或静默超过心跳时间才上报, 减少串口流量和数据库行数
+
+import time
+
+
+class ReportFilter:
+    """
+    按通道的死区 + 最长静默心跳。
+
+    数值与上次上报的值相差超过 delta[i], 或距上次上报已超过 heartbeat_ms 时才需要上报。
+    数值使用与 readings 相同的整数单位 (温度/湿度/光照为 10 倍值), 判断过程不产生新对象。
+
+    参数:
+        names: 通道名元组
+        deltas: 各通道死区 (整数单位)
+        scales: 各通道整数单位相对自然单位的倍数, 用于配置的换算
+        heartbeat_ms: 最长静默时间
+    """
+
+    def __init__(self, names, deltas, scales, heartbeat_ms=60000):
+        n = len(names)
+        self.names = names
+        self.delta = list(deltas)
+        self.scales = scales
+        self.heartbeat_ms = heartbeat_ms
+        self.sent = [None] * n
+        self.sent_time = [0] * n
+
+    def check(self, idx, value, now):
+        """通道 idx 的新值是否需要上报 (不修改状态)"""
+        if value is None: return False
+        sent = self.sent[idx]
+        if sent is None or time.ticks_diff(now, self.sent_time[idx]) >= self.heartbeat_ms: return True
+        d = value - sent
+        return d > self.delta[idx] or -d > self.delta[idx]
+
+    def mark(self, idx, value, now):
+        """记录通道 idx 已上报 value"""
+        self.sent[idx] = value
+        self.sent_time[idx] = now
+
+    def reset(self):
+        """清除上报记录, 下一个样本无条件上报 (上位机重连后用于补齐全部通道)"""
+        for i in range(len(self.sent)): self.sent[i] = None
+
+    def configure(self, deadband=None, heartbeat_ms=None):
+        """
+        修改死区 ({通道名: 自然单位的死区}) 和心跳时间; 未知通道和非法值被忽略
+        """
+        if isinstance(deadband, dict):
+            for i, name in enumerate(self.names):
+                v = deadband.get(name)
+                if isinstance(v, (int, float)) and v >= 0:
+                    self.delta[i] = int(round(v * self.scales[i]))
+        if isinstance(heartbeat_ms, int) and heartbeat_ms >= 1000:
+            self.heartbeat_ms = heartbeat_ms
+
+    def config(self):
+        """返回 {通道名: 自然单位的死区}"""
+        result = {}
+        for i, name in enumerate(self.names):
+            scale = self.scales[i]
+            result[name] = self.delta[i] if scale == 1 else self.delta[i] / scale
+        return result
@@ -11,27 +11,34 @@ class DHT11Sensor(SensorBase):
     DHT11/DHT22 温湿度传感器智能驱动
     """
     
-    def __init__(self, pin, sensor_type='DHT11'):
+    WARMUP_MS = 1000  # DHT 上电后需要约 1 秒才能读取
+    MIN_INTERVAL_MS = 1000  # DHT11 两次读取至少间隔 1 秒, 更快的请求会被限制
+    
+    def __init__(self, pin, sensor_type='DHT11', fast_boot=False):
         super().__init__(pin, sensor_type)
         self.temperature = None
         self.humidity = None
         self.driver_mode = None
         self.driver_instance = None
-        self._initialize_driver()
+        if fast_boot:
+            # 快速启动: 不在构造函数里阻塞, 预热结束后第一次 measure() 时再选择驱动
+            self.start_warmup(self.WARMUP_MS)
+        else:
+            self._initialize_driver()
     
-    def _initialize_driver(self):
+    def _initialize_driver(self, settle_ms=WARMUP_MS):
         # 尝试硬件级驱动
-        if self._try_hardware_driver(): return
+        if self._try_hardware_driver(settle_ms): return
         # 尝试软件级驱动  
-        if self._try_software_driver(): return
+        if self._try_software_driver(settle_ms): return
         # 使用模拟驱动
         self._use_simulated_driver()
     
-    def _try_hardware_driver(self):
+    def _try_hardware_driver(self, settle_ms=WARMUP_MS):
         try:
             import machine
             if not hasattr(machine, 'dht_readinto'): return False
-            self.driver_instance = HardwareDHTDriver(self.pin, self.sensor_type)
+            self.driver_instance = HardwareDHTDriver(self.pin, self.sensor_type, settle_ms)
             self.driver_mode = "hardware"
             if self.driver_instance.test_read():
                 self._log_success(f"硬件级{self.sensor_type}驱动初始化成功")
@@ -41,9 +48,9 @@ class DHT11Sensor(SensorBase):
         except Exception as e:
             return False
     
-    def _try_software_driver(self):
+    def _try_software_driver(self, settle_ms=WARMUP_MS):
         try:
-            self.driver_instance = SoftwareDHTDriver(self.pin, self.sensor_type)
+            self.driver_instance = SoftwareDHTDriver(self.pin, self.sensor_type, settle_ms)
             self.driver_mode = "software"
             if self.driver_instance.test_read():
                 self._log_success(f"软件级{self.sensor_type}驱动初始化成功")
@@ -60,6 +67,9 @@ class DHT11Sensor(SensorBase):
         self.is_initialized = True; self.is_available = True
     
     def measure(self):
+        if self.is_warming:
+            if not self.warmup_done(): return False
+            self._initialize_driver(0)
         if not self.is_ready(): raise SensorError("传感器未就绪", self.sensor_type, "NOT_READY")
         try:
             success = self.driver_instance.measure()
@@ -93,10 +103,10 @@ class DHT11Sensor(SensorBase):
 # 具体驱动实现类
 
 class HardwareDHTDriver:
-    def __init__(self, pin, sensor_type):
+    def __init__(self, pin, sensor_type, settle_ms=1000):
         self.pin = pin; self.sensor_type = sensor_type; self.buf = bytearray(5)
         import machine; self.dht_readinto = machine.dht_readinto
-        time.sleep_ms(1000)
+        if settle_ms: time.sleep_ms(settle_ms)
     
     def measure(self):
         try:
@@ -123,12 +133,12 @@ class HardwareDHTDriver:
         except: return False
 
 class SoftwareDHTDriver:
-    def __init__(self, pin, sensor_type):
+    def __init__(self, pin, sensor_type, settle_ms=1000):
         self.pin = pin; self.sensor_type = sensor_type
         import dht
         if sensor_type == 'DHT22': self.dht = dht.DHT22(pin)
         else: self.dht = dht.DHT11(pin)
-        time.sleep_ms(1000)
+        if settle_ms: time.sleep_ms(settle_ms)
     
     def measure(self):
         try:
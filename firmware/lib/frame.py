@@ -0,0 +1,102 @@
+# 预分配缓冲区上的 JSON 帧拼装
+# 主循环每秒输出一帧遥测数据; 用 json.dumps/f-string 会不断产生临时对象,
+# 在 STM32F411 上周期性触发 GC 停顿。这里把数字直接写进同一个 bytearray。
+
+import sys
+from micropython import const
+
+_QUOTE = const(0x22)
+_COMMA = const(0x2C)
+
+
+class FrameWriter:
+    """
+    在预分配的 bytearray 中拼装一行 JSON 对象。
+
+    用法:
+        w.begin(); w.key_int(b'cycle', 1); w.key_tenths(b'lux', 1234); w.end()
+        w.write()  # 输出 {"cycle": 1, "lux": 123.4}
+    """
+
+    def __init__(self, size=256):
+        self.buf = bytearray(size)
+        self.mv = memoryview(self.buf)
+        self.pos = 0
+        try: self.out = sys.stdout.buffer
+        except AttributeError: self.out = sys.stdout
+
+    def begin(self):
+        self.buf[0] = 0x7B  # '{'
+        self.pos = 1
+
+    def _raw(self, data):
+        n = len(data)
+        self.mv[self.pos:self.pos + n] = data
+        self.pos += n
+
+    def _key(self, key):
+        buf = self.buf
+        if self.pos > 1:
+            buf[self.pos] = _COMMA; buf[self.pos + 1] = 0x20
+            self.pos += 2
+        buf[self.pos] = _QUOTE
+        self.pos += 1
+        self._raw(key)
+        buf[self.pos] = _QUOTE; buf[self.pos + 1] = 0x3A; buf[self.pos + 2] = 0x20  # '": '
+        self.pos += 3
+
+    def _digits(self, v):
+        # 写入非负整数的十进制表示, 原地反转避免分配
+        buf = self.buf
+        start = self.pos
+        while True:
+            buf[self.pos] = 0x30 + v % 10
+            self.pos += 1
+            v //= 10
+            if not v: break
+        end = self.pos - 1
+        while start < end:
+            buf[start], buf[end] = buf[end], buf[start]
+            start += 1; end -= 1
+
+    def put_int(self, v):
+        if v < 0:
+            self.buf[self.pos] = 0x2D  # '-'
+            self.pos += 1
+            v = -v
+        self._digits(v)
+
+    def put_tenths(self, v10):
+        """按一位小数输出十倍值, 小数为 0 时输出整数 (与原 json.dumps 的输出保持一致)"""
+        if v10 < 0:
+            self.buf[self.pos] = 0x2D
+            self.pos += 1
+            v10 = -v10
+        self._digits(v10 // 10)
+        if v10 % 10:
+            self.buf[self.pos] = 0x2E  # '.'
+            self.buf[self.pos + 1] = 0x30 + v10 % 10
+            self.pos += 2
+
+    def key_int(self, key, v):
+        self._key(key)
+        if v is None: self._raw(b'null')
+        else: self.put_int(v)
+
+    def key_tenths(self, key, v10):
+        self._key(key)
+        if v10 is None: self._raw(b'null')
+        else: self.put_tenths(v10)
+
+    def key_raw(self, key, data):
+        """data 为已经编码好的 JSON 片段 (bytes)"""
+        self._key(key)
+        self._raw(b'null' if data is None else data)
+
+    def end(self):
+        self.buf[self.pos] = 0x7D      # '}'
+        self.buf[self.pos + 1] = 0x0A  # '\n'
+        self.pos += 2
+
+    def write(self):
+        self.out.write(self.mv[:self.pos])
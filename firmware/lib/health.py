@@ -0,0 +1,43 @@
+# 主循环分阶段耗时统计
+# 各任务用 time.ticks_us 记录每个阶段的耗时, 健康帧按低频率把统计结果发给上位机
+
+import time
+
+
+class PhaseStats:
+    """
+    按阶段累计 次数 / 总耗时 / 最大耗时 (微秒)。
+
+    计数器用预分配的整数列表保存, 记录时不产生新对象;
+    snapshot() 生成汇总后清零, 下一个统计周期重新累计。
+    """
+
+    def __init__(self, names):
+        self.names = names
+        n = len(names)
+        self.count = [0] * n
+        self.total = [0] * n
+        self.max = [0] * n
+
+    def add(self, idx, start_us):
+        """记录阶段 idx 的一次耗时, start_us 为该阶段开始时的 time.ticks_us()"""
+        us = time.ticks_diff(time.ticks_us(), start_us)
+        self.count[idx] += 1
+        self.total[idx] += us
+        if us > self.max[idx]:
+            self.max[idx] = us
+
+    def snapshot(self):
+        """
+        返回:
+            dict: {阶段名: [次数, 平均耗时us, 最大耗时us]}, 本周期没有执行过的阶段不出现
+        """
+        result = {}
+        for i, name in enumerate(self.names):
+            n = self.count[i]
+            if n:
+                result[name] = [n, self.total[i] // n, self.max[i]]
+            self.count[i] = 0
+            self.total[i] = 0
+            self.max[i] = 0
+        return result
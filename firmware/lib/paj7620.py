@@ -26,6 +26,8 @@ GES_CLOCKWISE = const(1 << 6) # 64
 GES_COUNTER_CLOCKWISE = const(1 << 7) # 128
 GES_WAVE = const(1 << 0)    # 1 (来自寄存器 0x44)
 
+_EVENT_QUEUE_LEN = const(8)
+
 # 手势代码到中文名称的映射
 GESTURE_MAP = {
     GES_RIGHT: "向右",
@@ -47,6 +49,17 @@ class PAJ7620:
     def __init__(self, i2c):
         self.i2c = i2c
         self.address = PAJ7620_I2C_ADDRESS
+        self._t_created = time.ticks_ms() # 上电等待从构造时开始计时, 可与其它初始化重叠
+        self._flag_buf = bytearray(2) # 0x43/0x44 一次 burst 读取的缓冲区
+
+        # INT 引脚模式: IRQ 只置标志位, 事件进入定长环形队列, 快速连续滑动不丢失
+        self.int_pin = None
+        self.irq_count = 0
+        self._irq_pending = False
+        self._queue = [0] * _EVENT_QUEUE_LEN
+        self._q_head = 0
+        self._q_len = 0
+        self.dropped_events = 0
         
         # 核心修复：移植了paj7620.cpp中完整的263个寄存器初始化序列
         self._INIT_REG_ARRAY = (
@@ -115,9 +128,37 @@ class PAJ7620:
         """选择寄存器 Bank (0 或 1)"""
         return self._write_reg(_REG_BANK_SEL, bank)
 
-    def init(self):
-        """初始化传感器"""
-        time.sleep_ms(200) # 增加启动延时，确保传感器稳定
+    def _burst_runs(self):
+        """
+        把 _INIT_REG_ARRAY 中地址连续的寄存器合并成 (起始地址, 数据) 段,
+        每段用一次 writeto_mem 写入。Bank 选择寄存器 0xEF 总是单独成段。
+        """
+        runs = []
+        start, data, prev = None, None, None
+        for reg, val in self._INIT_REG_ARRAY:
+            if data is not None and reg == prev + 1 and reg != _REG_BANK_SEL and start != _REG_BANK_SEL:
+                data.append(val)
+            else:
+                if data is not None:
+                    runs.append((start, data))
+                start, data = reg, bytearray((val,))
+            prev = reg
+        if data is not None:
+            runs.append((start, data))
+        return runs
+
+    def init(self, burst=True):
+        """
+        初始化传感器
+
+        参数:
+            burst: True 时把连续寄存器合并成 burst 写入 (约 220 次写入合并为几十次),
+                   某段写入失败时退回逐个寄存器写入
+        """
+        # 启动延时 200ms 从构造时算起, 期间可以初始化其它设备
+        wait = 200 - time.ticks_diff(time.ticks_ms(), self._t_created)
+        if wait > 0:
+            time.sleep_ms(wait)
 
         # 1. 检查设备ID
         self._select_bank(0)
@@ -126,9 +167,18 @@ class PAJ7620:
             raise OSError("PAJ7620 传感器未找到或ID错误!")
 
         # 2. 载入完整的初始化寄存器配置
-        for reg, data in self._INIT_REG_ARRAY:
-            if not self._write_reg(reg, data):
-                return False
+        if burst:
+            for start, data in self._burst_runs():
+                try:
+                    self.i2c.writeto_mem(self.address, start, data)
+                except OSError:
+                    for i in range(len(data)):
+                        if not self._write_reg(start + i, data[i]):
+                            return False
+        else:
+            for reg, data in self._INIT_REG_ARRAY:
+                if not self._write_reg(reg, data):
+                    return False
         
         # 3. 切换回 Bank 0，准备读取手势
         self._select_bank(0)
@@ -142,27 +192,88 @@ class PAJ7620:
         print("✅ PAJ7620 传感器初始化成功! (v2固件)")
         return True
 
-    def get_gesture_code(self):
-        """
-        读取并返回原始手势码。
-        """
-        # 读取手势标志寄存器
-        flag0 = self._read_reg(_REG_GESTURE_FLAG_0)
-        flag1 = self._read_reg(_REG_GESTURE_FLAG_1)
-
-        if flag0 is None or flag1 is None:
+    def _read_flags(self):
+        """一次 burst 读取 0x43/0x44 两个手势标志寄存器 (读取后芯片清除标志并释放 INT)"""
+        try:
+            self.i2c.readfrom_mem_into(self.address, _REG_GESTURE_FLAG_0, self._flag_buf)
+        except OSError:
             return 0 # I2C 读取错误
-            
-        code0 = flag0[0]
-        code1 = flag1[0]
-        
+
+        code0 = self._flag_buf[0]
+        code1 = self._flag_buf[1]
+
         if code0 > 0:
             return code0 # 返回Bank0的手势码
         elif code1 > 0:
             return (code1 << 8) # 返回Bank1的手势码，左移8位以区分
-            
+
         return 0
 
+    def get_gesture_code(self):
+        """
+        读取并返回原始手势码 (轮询模式)。
+        """
+        return self._read_flags()
+
+    # --- INT 引脚模式 ---
+
+    def enable_interrupt(self, pin):
+        """
+        启用 INT 引脚模式。INT 为低电平有效的开漏输出, 这里打开内部上拉。
+        IRQ 中只置标志位, I2C 读取放到主循环的 poll_events() 中进行。
+        """
+        import machine
+        pin.init(machine.Pin.IN, machine.Pin.PULL_UP)
+        self.int_pin = pin
+        self._irq_pending = not pin.value() # 已经拉低则先处理一次
+        pin.irq(trigger=machine.Pin.IRQ_FALLING, handler=self._on_irq)
+
+    def disable_interrupt(self):
+        """关闭 INT 引脚模式, 回到轮询模式"""
+        if self.int_pin is not None:
+            self.int_pin.irq(handler=None)
+            self.int_pin = None
+        self._irq_pending = False
+
+    def _on_irq(self, pin):
+        # 硬中断上下文: 不做 I2C、不分配内存
+        self._irq_pending = True
+        self.irq_count += 1
+
+    def irq_pending(self):
+        """中断模式下是否有待读取的手势 (不访问 I2C)"""
+        return self.int_pin is not None and (self._irq_pending or not self.int_pin.value())
+
+    def poll_events(self):
+        """
+        中断模式下由主循环调用: 只有 INT 触发(或仍保持低电平)时才读取标志寄存器。
+
+        返回:
+            int: 本次新入队的手势事件数 (0 或 1)
+        """
+        if not self.irq_pending():
+            return 0
+        self._irq_pending = False
+        code = self._read_flags()
+        if not code:
+            return 0
+        if self._q_len == _EVENT_QUEUE_LEN: # 队列满: 丢弃最旧的事件
+            self._q_head = (self._q_head + 1) % _EVENT_QUEUE_LEN
+            self._q_len -= 1
+            self.dropped_events += 1
+        self._queue[(self._q_head + self._q_len) % _EVENT_QUEUE_LEN] = code
+        self._q_len += 1
+        return 1
+
+    def get_event(self):
+        """取出最早的手势码, 队列为空时返回 0"""
+        if not self._q_len:
+            return 0
+        code = self._queue[self._q_head]
+        self._q_head = (self._q_head + 1) % _EVENT_QUEUE_LEN
+        self._q_len -= 1
+        return code
+
     def get_gesture_name(self, code):
         """
         将手势码转换为可读的名称。
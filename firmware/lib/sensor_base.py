@@ -15,9 +15,13 @@ class SensorBase:
     传感器驱动基类
     
     所有传感器驱动都应该继承此类，实现统一的接口。
-    提供通用的错误处理、状态管理等功能。
+    提供通用的错误处理、状态管理、采样间隔调度等功能。
     """
     
+    DEFAULT_INTERVAL_MS = 1000  # 默认采样间隔
+    MIN_INTERVAL_MS = 100       # 子类可按器件物理限制提高下限 (如 DHT11 约 1Hz)
+    MAX_INTERVAL_MS = 3600000
+    
     def __init__(self, pin, sensor_type="Unknown"):
         """
         初始化传感器
@@ -37,6 +41,14 @@ class SensorBase:
         self.is_initialized = False
         self.is_available = False
         
+        # 预热状态: 快速启动时传感器上电后还不能读取, 由主循环非阻塞地等待
+        self.is_warming = False
+        self.warmup_until = 0
+        
+        # 采样调度: 每个传感器有自己的采样间隔和下一次到期时刻
+        self.interval_ms = self.DEFAULT_INTERVAL_MS
+        self.next_due = time.ticks_ms()
+        
         print(f"初始化{sensor_type}传感器，引脚: {pin}")
     
     def measure(self):
@@ -66,6 +78,62 @@ class SensorBase:
         """
         return self.is_initialized and self.is_available
     
+    def start_warmup(self, warmup_ms):
+        """
+        进入预热状态, 代替在 __init__ 中 sleep 阻塞等待
+        
+        参数:
+            warmup_ms: 上电后需要等待的毫秒数
+        """
+        self.is_warming = True
+        self.warmup_until = time.ticks_add(time.ticks_ms(), warmup_ms)
+    
+    def warmup_done(self):
+        """
+        检查预热是否结束 (结束时自动清除预热状态)
+        
+        返回:
+            bool: 传感器是否已经度过预热期
+        """
+        if self.is_warming and time.ticks_diff(time.ticks_ms(), self.warmup_until) >= 0:
+            self.is_warming = False
+        return not self.is_warming
+    
+    def set_interval(self, interval_ms):
+        """
+        设置采样间隔 (自动限制在 [MIN_INTERVAL_MS, MAX_INTERVAL_MS] 内)
+        
+        返回:
+            int: 实际生效的间隔
+        """
+        interval_ms = max(self.MIN_INTERVAL_MS, min(self.MAX_INTERVAL_MS, int(interval_ms)))
+        self.interval_ms = interval_ms
+        # 间隔变短时不必等完旧的周期
+        now = time.ticks_ms()
+        if time.ticks_diff(self.next_due, now) > interval_ms:
+            self.next_due = time.ticks_add(now, interval_ms)
+        return interval_ms
+    
+    def is_due(self, now=None):
+        """是否到了下一次采样时刻"""
+        if now is None: now = time.ticks_ms()
+        return time.ticks_diff(now, self.next_due) >= 0
+    
+    def time_until_due(self, now=None):
+        """距下一次采样还有多少毫秒 (已到期时为 0)"""
+        if now is None: now = time.ticks_ms()
+        return max(0, time.ticks_diff(self.next_due, now))
+    
+    def schedule_next(self, now=None):
+        """
+        采样完成后安排下一次到期时刻。按固定节拍推进, 
+        落后超过一个周期时从当前时刻重新计时, 不做补采。
+        """
+        if now is None: now = time.ticks_ms()
+        self.next_due = time.ticks_add(self.next_due, self.interval_ms)
+        if time.ticks_diff(now, self.next_due) >= 0:
+            self.next_due = time.ticks_add(now, self.interval_ms)
+    
     def get_status(self):
         """
         获取传感器状态信息
@@ -84,6 +152,8 @@ class SensorBase:
             'is_initialized': self.is_initialized,
             'is_available': self.is_available,
             'is_ready': self.is_ready(),
+            'is_warming': self.is_warming,
+            'interval_ms': self.interval_ms,
             'read_count': self.read_count,
             'error_count': self.error_count,
             'success_rate': f"{success_rate:.1f}%",
@@ -133,3 +203,55 @@ class SensorBase:
         """详细字符串表示"""
         status = self.get_status()
         return f"{self.sensor_type}(pin={self.pin}, success_rate={status['success_rate']})"
+
+
+class SensorScheduler:
+    """
+    按名称管理一组传感器的采样间隔
+    
+    各传感器的到期时间保存在自身 (SensorBase.next_due) 中;
+    调度器负责按名称批量修改间隔, 以及算出最近的到期时刻。
+    """
+    
+    def __init__(self):
+        self.sensors = {}
+    
+    def add(self, name, sensor, interval_ms=None):
+        """注册传感器, 可同时指定初始采样间隔"""
+        if sensor is None: return
+        if interval_ms is not None: sensor.set_interval(interval_ms)
+        self.sensors[name] = sensor
+    
+    def configure(self, intervals):
+        """
+        批量修改采样间隔
+        
+        参数:
+            intervals: {名称: 间隔毫秒}, 未注册的名称被忽略
+        返回:
+            dict: 当前全部传感器的采样间隔
+        """
+        for name, interval_ms in intervals.items():
+            sensor = self.sensors.get(name)
+            if sensor is not None: sensor.set_interval(interval_ms)
+        return self.intervals()
+    
+    def intervals(self):
+        """返回 {名称: 采样间隔毫秒}"""
+        return {name: sensor.interval_ms for name, sensor in self.sensors.items()}
+    
+    def min_interval(self, default=1000):
+        """所有传感器中最短的采样间隔"""
+        result = default
+        for sensor in self.sensors.values():
+            if sensor.interval_ms < result: result = sensor.interval_ms
+        return result
+    
+    def next_wait_ms(self, now=None, cap=1000):
+        """距最近一个传感器到期的毫秒数, 最多 cap 毫秒 (便于及时响应间隔修改)"""
+        if now is None: now = time.ticks_ms()
+        wait = cap
+        for sensor in self.sensors.values():
+            w = sensor.time_until_due(now)
+            if w < wait: wait = w
+        return wait
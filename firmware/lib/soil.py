@@ -0,0 +1,54 @@
+# 电容式土壤湿度传感器驱动模块 (ADC)
+# 原先在 main.py 中直接读 ADC, 现纳入 SensorBase 体系以统一状态统计和采样间隔调度
+
+from sensor_base import SensorBase
+
+class SoilSensor(SensorBase):
+    """
+    电容式土壤湿度传感器
+    
+    按干/湿两点标定把 ADC 原始值换算成 0~100 的整数百分比;
+    原始值超出标定范围 (探头脱落或短路) 时记为一次读取失败。
+    """
+    
+    DEFAULT_INTERVAL_MS = 1000
+    MIN_INTERVAL_MS = 100
+    
+    def __init__(self, pin, dry=59000, wet=26000):
+        super().__init__(pin, 'Soil')
+        self.dry = dry
+        self.wet = wet
+        self.raw = None
+        self.percent = None
+        try:
+            import machine
+            self.adc = machine.ADC(pin)
+            self.is_initialized = True; self.is_available = True
+        except Exception as e:
+            self.adc = None
+            self.last_error = e
+            self._log_error(f"初始化失败: {e}")
+    
+    def measure(self):
+        if not self.is_ready(): return False
+        try:
+            raw = self.adc.read_u16()
+            self.raw = raw
+            if not (self.wet <= raw <= self.dry + 2000):
+                self._update_read_stats(False, "ADC 读数超出标定范围")
+                return False
+            span = self.dry - self.wet
+            self.percent = max(0, min(100, (100 * (self.dry - raw) + span // 2) // span))
+            self._update_read_stats(True)
+            return True
+        except Exception as e:
+            self._update_read_stats(False, e)
+            return False
+    
+    def get_data(self):
+        return {
+            'soil': self.percent,
+            'raw': self.raw,
+            'sensor_type': self.sensor_type,
+            'timestamp': self.last_read_time
+        }
@@ -32,6 +32,9 @@ class SSD1306(framebuf.FrameBuffer):
         self.external_vcc = external_vcc
         self.pages = self.height // 8
         self.buffer = bytearray(self.pages * self.width)
+        # per-page dirty column range [x0, x1]; x0 > x1 means the page is clean
+        self.dirty_x0 = bytearray(self.pages)
+        self.dirty_x1 = bytearray(self.pages)
         super().__init__(self.buffer, self.width, self.height, framebuf.MONO_VLSB)
         self.init_display()
 
@@ -75,9 +78,62 @@ class SSD1306(framebuf.FrameBuffer):
     def invert(self, invert):
         self.write_cmd(SET_NORM_INV | (invert & 1))
 
-    def show(self):
-        x0 = 0
-        x1 = self.width - 1
+    # Drawing primitives are wrapped so that every change marks the
+    # touched pages/columns dirty for show(full=False)
+    def mark_dirty(self, x, y, w, h):
+        x0 = max(0, x)
+        x1 = min(self.width, x + w) - 1
+        p0 = max(0, y) >> 3
+        p1 = (min(self.height, y + h) - 1) >> 3
+        if x0 > x1 or p0 > p1:
+            return
+        for page in range(p0, p1 + 1):
+            if x0 < self.dirty_x0[page]:
+                self.dirty_x0[page] = x0
+            if x1 > self.dirty_x1[page] or self.dirty_x0[page] > self.dirty_x1[page]:
+                self.dirty_x1[page] = x1
+
+    def clear_dirty(self):
+        for page in range(self.pages):
+            self.dirty_x0[page] = 0xff
+            self.dirty_x1[page] = 0
+
+    def fill(self, c):
+        super().fill(c)
+        self.mark_dirty(0, 0, self.width, self.height)
+
+    def fill_rect(self, x, y, w, h, c):
+        super().fill_rect(x, y, w, h, c)
+        self.mark_dirty(x, y, w, h)
+
+    def rect(self, x, y, w, h, c, *f):
+        super().rect(x, y, w, h, c, *f)
+        self.mark_dirty(x, y, w, h)
+
+    def hline(self, x, y, w, c):
+        super().hline(x, y, w, c)
+        self.mark_dirty(x, y, w, 1)
+
+    def vline(self, x, y, h, c):
+        super().vline(x, y, h, c)
+        self.mark_dirty(x, y, 1, h)
+
+    def pixel(self, x, y, *c):
+        if not c:
+            return super().pixel(x, y)
+        super().pixel(x, y, *c)
+        self.mark_dirty(x, y, 1, 1)
+
+    def text(self, s, x, y, *c):
+        super().text(s, x, y, *c)
+        self.mark_dirty(x, y, len(s) * 8, 8)
+
+    def blit(self, fbuf, x, y, *args):
+        super().blit(fbuf, x, y, *args)
+        # the source size is not exposed by FrameBuffer, assume it may reach the edge
+        self.mark_dirty(x, y, self.width, self.height)
+
+    def set_window(self, x0, x1, p0, p1):
         if self.width == 64:
             # displays with width of 64 pixels are shifted by 32
             x0 += 32
@@ -86,9 +142,30 @@ class SSD1306(framebuf.FrameBuffer):
         self.write_cmd(x0)
         self.write_cmd(x1)
         self.write_cmd(SET_PAGE_ADDR)
-        self.write_cmd(0)
-        self.write_cmd(self.pages - 1)
-        self.write_data(self.buffer)
+        self.write_cmd(p0)
+        self.write_cmd(p1)
+
+    def show(self, full=True):
+        """Send the framebuffer to the panel.
+
+        full=True pushes the whole buffer; full=False only sends the dirty
+        column range of each dirty page, which keeps the shared I2C bus free
+        when just a few fields changed.
+        """
+        if full:
+            self.set_window(0, self.width - 1, 0, self.pages - 1)
+            self.write_data(self.buffer)
+        else:
+            mv = memoryview(self.buffer)
+            for page in range(self.pages):
+                x0 = self.dirty_x0[page]
+                x1 = self.dirty_x1[page]
+                if x0 > x1:
+                    continue
+                base = page * self.width
+                self.set_window(x0, x1, page, page)
+                self.write_data(mv[base + x0:base + x1 + 1])
+        self.clear_dirty()
 
 
 class SSD1306_I2C(SSD1306):
@@ -97,6 +174,7 @@ class SSD1306_I2C(SSD1306):
         self.addr = addr
         self.temp = bytearray(2)
         self.write_list = [b'\x40', None] # Co=0, D/C#=1
+        self.window_cmd = bytearray(7)      # Co=0, D/C#=0 + 6 command bytes
         super().__init__(width, height, external_vcc)
 
     def write_cmd(self, cmd):
@@ -104,6 +182,21 @@ class SSD1306_I2C(SSD1306):
         self.temp[1] = cmd
         self.i2c.writeto(self.addr, self.temp)
 
+    def set_window(self, x0, x1, p0, p1):
+        # same as the generic version but in a single I2C transaction
+        if self.width == 64:
+            x0 += 32
+            x1 += 32
+        cmd = self.window_cmd
+        cmd[0] = 0x00
+        cmd[1] = SET_COL_ADDR
+        cmd[2] = x0
+        cmd[3] = x1
+        cmd[4] = SET_PAGE_ADDR
+        cmd[5] = p0
+        cmd[6] = p1
+        self.i2c.writeto(self.addr, cmd)
+
     def write_data(self, buf):
         self.write_list[1] = buf
         self.i2c.writevto(self.addr, self.write_list)
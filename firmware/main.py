@@ -1,11 +1,14 @@
-# 藏红花培育系统主程序 - v10.0 (结构重构版)
+# 藏红花培育系统主程序 - v11.2 (asyncio 协作式调度 + 按传感器采样间隔 + 变化上报)
 # 适配 /lib 扁平化目录结构
 
-import machine
 import time
+BOOT_T0 = time.ticks_ms()  # 用于统计启动到第一帧数据的耗时
+import machine
 import json
 import sys
-import select
+import gc
+try: import asyncio
+except ImportError: import uasyncio as asyncio
 
 # --- 导入驱动模块 (直接从 /lib 导入) ---
 try:
@@ -13,22 +16,13 @@ try:
     import ssd1306
     from paj7620 import PAJ7620
     from dht11 import DHT11Sensor 
-    
-    # BH1750 类直接内嵌，保持简单
-    class BH1750:
-        def __init__(self, i2c, addr=0x23):
-            self.i2c = i2c; self.addr = addr; self.is_initialized = False
-            try:
-                self.i2c.writeto(self.addr, b'\x01'); time.sleep_ms(10)
-                self.i2c.writeto(self.addr, b'\x10'); time.sleep_ms(120)
-                self.is_initialized = True
-            except Exception as e: print(f"❌ BH1750 初始化失败: {e}")
-        def read_lux(self):
-            if not self.is_initialized: return None
-            try:
-                data = self.i2c.readfrom(self.addr, 2)
-                return ((data[0] << 8) | data[1]) / 1.2
-            except: return None
+    from backlog import SampleBacklog
+    from frame import FrameWriter
+    from health import PhaseStats
+    from sensor_base import SensorScheduler
+    from bh1750 import BH1750Sensor
+    from soil import SoilSensor
+    from deadband import ReportFilter
 
     print("✅ 所有驱动模块加载成功")
 except ImportError as e:
@@ -36,7 +30,7 @@ except ImportError as e:
     # 为了防止死循环重启，这里可以闪灯报错，或者sys.exit
     sys.exit()
 
-print("\n=== 藏红花培育系统 v10.0 ===")
+print("\n=== 藏红花培育系统 v11.2 ===")
 
 # --- 全局状态管理 ---
 SCREEN_WIDTH = 128
@@ -46,17 +40,23 @@ current_display_page = 0
 NUM_PAGES = 3
 control_page_selection = 0
 NUM_CONTROL_ITEMS = 3 
+FAST_BOOT = True            # 快速启动: burst 初始化 PAJ7620, 各传感器预热并行, 主循环立即开始
+PAJ_INT_PIN = 'B5'          # PAJ7620 INT 引脚; 未接线时设为 None, 或由运行时自检退回轮询
+PAJ_PROBE_INTERVAL = 2000   # 中断模式下尚未收到过中断时, 每 2 秒慢速轮询一次做自检
+BACKLOG_INTERVAL_MS = 5000  # 离线时每 5 秒缓存一条样本 (1200 条约 100 分钟)
+# 各传感器默认采样间隔; 运行时可用 {"config": {"lux_ms": 200, "soil_ms": 30000}} 修改
+SAMPLING_DEFAULTS = {'dht': 2000, 'lux': 1000, 'soil': 5000}
 
 # --- 硬件初始化 ---
 status_led = machine.Pin('C13', machine.Pin.OUT, value=1)
-dht11, light_sensor, soil_adc, paj_sensor = None, None, None, None
+dht11, light_sensor, soil_sensor, paj_sensor = None, None, None, None
 pump_relay, led_strip_relay = None, None
 display = None
 
 # 初始化 DHT11
 try: 
     # 直接实例化，不再使用工厂函数
-    dht11 = DHT11Sensor(machine.Pin('A1', machine.Pin.IN, machine.Pin.PULL_UP), 'DHT11')
+    dht11 = DHT11Sensor(machine.Pin('A1', machine.Pin.IN, machine.Pin.PULL_UP), 'DHT11', fast_boot=FAST_BOOT)
 except Exception as e: print(f"❌ DHT11 初始化失败: {e}")
 
 # 初始化 I2C 设备
@@ -64,27 +64,38 @@ try:
     i2c = machine.I2C(1, freq=200000)
     print("✅ I2C 总线初始化成功")
     
-    light_sensor = BH1750(i2c)
+    # PAJ7620 先构造以开始上电计时, BH1750/OLED 的初始化与其等待时间重叠
+    paj_sensor = PAJ7620(i2c)
+    light_sensor = BH1750Sensor(i2c, fast_boot=FAST_BOOT)
     
     display = ssd1306.SSD1306_I2C(SCREEN_WIDTH, SCREEN_HEIGHT, i2c, I2C_ADDRESS)
     print("✅ OLED 显示屏初始化成功")
     
-    paj_sensor = PAJ7620(i2c)
-    paj_sensor.init()
+    paj_sensor.init(burst=FAST_BOOT)
     print("✅ PAJ7620 手势传感器初始化成功")
+    if PAJ_INT_PIN:
+        try:
+            paj_sensor.enable_interrupt(machine.Pin(PAJ_INT_PIN))
+            print(f"✅ PAJ7620 中断模式已启用 (INT={PAJ_INT_PIN})")
+        except Exception as e: print(f"⚠️ PAJ7620 中断模式启用失败, 使用轮询: {e}")
     
     display.fill(0)
     display.text('Saffron System', 8, 16)
     display.text('Init OK!', 30, 32)
     display.show()
-    time.sleep(1)
+    if not FAST_BOOT: time.sleep(1)
 except Exception as e:
     print(f"❌ I2C设备(光照/OLED/手势)初始化失败: {e}")
 
 # 初始化模拟传感器和执行器
-try: soil_adc = machine.ADC(machine.Pin('A2'))
+try: soil_sensor = SoilSensor(machine.Pin('A2'))
 except Exception as e: print(f"❌ 土壤湿度传感器初始化失败: {e}")
 
+# 采样调度: 到期时间保存在各传感器里, 调度器负责按名称修改间隔
+scheduler = SensorScheduler()
+for name, sensor in (('dht', dht11), ('lux', light_sensor), ('soil', soil_sensor)):
+    scheduler.add(name, sensor, SAMPLING_DEFAULTS[name])
+
 try:
     pump_relay = machine.Pin('B10', machine.Pin.OUT, value=0)
     print("✅ 水泵继电器(B10)初始化成功")
@@ -95,11 +106,44 @@ try:
     print("✅ LED灯带继电器(B12)初始化成功")
 except Exception as e: print(f"❌ LED灯带继电器初始化失败: {e}")
 
+# --- 离线缓存 (store-and-forward) ---
+backlog = SampleBacklog(1200)
+try:
+    import pyb
+    usb_vcp = pyb.USB_VCP()
+except Exception: usb_vcp = None
+
+def host_connected():
+    # 上位机打开串口时 DTR 置位; 无法检测时视为在线
+    return usb_vcp.isconnected() if usb_vcp else True
+
+def drain_backlog():
+    sent = backlog.drain(time.time(), print)
+    print(json.dumps({"backlog_done": sent, "dropped": backlog.dropped}))
+    backlog.dropped = 0
+
 # --- OLED 显示逻辑 ---
-def update_display(data, page_num):
-    if not display: return
+# 静态框架(标题/分隔线/页码/提示)只在切页时绘制; 数值字段缓存上次绘制时的原始值,
+# 值没变就不格式化字符串也不重绘, 再用 show(full=False) 只发送脏页的脏列范围
+drawn_page = None
+drawn_values = {}
+display_full_pending = False
+display_event = asyncio.Event()
+_UNSET = object()
+
+def fmt_tenths(v10):
+    if v10 is None: return '--'
+    return str(v10 // 10) if v10 % 10 == 0 else '{}.{}'.format(v10 // 10, v10 % 10)
+
+def draw_field(key, value, fmt, x, y, width=128):
+    # 只有值变化时才生成显示字符串
+    if drawn_values.get(key, _UNSET) == value: return
+    display.fill_rect(x, y, width, 8, 0)
+    display.text(fmt(value), x, y)
+    drawn_values[key] = value
+
+def draw_chrome(page_num):
     display.fill(0)
-    
     page_indicator = f"[{page_num + 1}/{NUM_PAGES}]"
     indicator_x = 128 - len(page_indicator) * 8 - 2
     
@@ -110,42 +154,77 @@ def update_display(data, page_num):
     display.text(title, 4, 0)
     display.text(page_indicator, indicator_x, 0)
     display.text("----------------", 0, 9)
+    if page_num == 1: display.text("U/D:Sel L/R:Pg", 0, 55)
+    elif page_num == 2: display.text(f"uPy: v{sys.version_info[0]}.{sys.version_info[1]}", 0, 48)
+
+# 字段格式化函数放在模块级, 避免每次刷新都创建 lambda 对象
+def fmt_temp(v): return f"T:{fmt_tenths(v)}C"
+def fmt_humi(v): return f"H:{fmt_tenths(v)}%"
+def fmt_lux(v): return f"L:{fmt_tenths(v)}"
+def fmt_soil(v): return f"S:{'--' if v is None else v}%"
+def fmt_gesture(v): return f"Ges: {v}"
+def fmt_dht(v): return f"DHT: {v}"
+def fmt_cycle(v): return f"Loop: {v}"
+
+CONTROL_LABELS = ("Pump  ", "Strip ", "LED   ")
+def fmt_control(v):
+    # v = 序号*4 + 选中*2 + 开关
+    return f"{'>' if v & 2 else ' '} {CONTROL_LABELS[v >> 2]}: {'ON' if v & 1 else 'OFF'}"
+
+def update_display(page_num):
+    # 只在帧缓冲里绘制, 真正的 I2C 刷新由 display_task 持有总线锁后完成
+    global drawn_page, display_full_pending
+    if not display: return
+    full = page_num != drawn_page
+    if full:
+        draw_chrome(page_num)
+        drawn_values.clear(); drawn_page = page_num
 
     if page_num == 0:
-        temp_str = f"T:{data.get('temp', '--')}C"; humi_str = f"H:{data.get('humi', '--')}%"
-        lux_str  = f"L:{data.get('lux', '--')}"; soil_str = f"S:{data.get('soil', '--')}%"
-        display.text(temp_str, 0, 19); display.text(humi_str, 64, 19)
-        display.text(lux_str, 0, 35);  display.text(soil_str, 64, 35)
-        display.text(f"Ges: {data.get('gesture', '--')}", 0, 55)
+        draw_field('temp', readings['temp'], fmt_temp, 0, 19, 64)
+        draw_field('humi', readings['humi'], fmt_humi, 64, 19, 64)
+        draw_field('lux', readings['lux'], fmt_lux, 0, 35, 64)
+        draw_field('soil', readings['soil'], fmt_soil, 64, 35, 64)
+        draw_field('gesture', current_gesture, fmt_gesture, 0, 55)
 
     elif page_num == 1:
-        pump_state = "ON" if pump_relay and pump_relay.value() else "OFF"
-        led_strip_state = "ON" if led_strip_relay and led_strip_relay.value() else "OFF"
-        status_led_state = "ON" if status_led and not status_led.value() else "OFF"
-        
-        pump_line = f"{'>' if control_page_selection == 0 else ' '} Pump  : {pump_state}"
-        led_strip_line = f"{'>' if control_page_selection == 1 else ' '} Strip : {led_strip_state}"
-        status_led_line = f"{'>' if control_page_selection == 2 else ' '} LED   : {status_led_state}"
+        pump_on = 1 if pump_relay and pump_relay.value() else 0
+        led_strip_on = 1 if led_strip_relay and led_strip_relay.value() else 0
+        status_led_on = 1 if status_led and not status_led.value() else 0
         
-        display.text(pump_line, 0, 18)
-        display.text(led_strip_line, 0, 31)
-        display.text(status_led_line, 0, 44)
-        display.text("U/D:Sel L/R:Pg", 0, 55)
+        draw_field('pump', 0 | (2 if control_page_selection == 0 else 0) | pump_on, fmt_control, 0, 18)
+        draw_field('strip', 4 | (2 if control_page_selection == 1 else 0) | led_strip_on, fmt_control, 0, 31)
+        draw_field('led', 8 | (2 if control_page_selection == 2 else 0) | status_led_on, fmt_control, 0, 44)
 
     elif page_num == 2:
-        driver_mode = dht11.driver_mode if dht11 else "N/A"
-        display.text(f"DHT: {driver_mode}", 0, 20)
-        display.text(f"Loop: {data.get('cycle', 0)}", 0, 34)
-        py_ver = f"{sys.version_info[0]}.{sys.version_info[1]}"
-        display.text(f"uPy: v{py_ver}", 0, 48)
+        draw_field('dht', dht11.driver_mode if dht11 else "N/A", fmt_dht, 0, 20)
+        draw_field('cycle', cycle_count, fmt_cycle, 0, 34)
 
-    display.show()
+    if full: display_full_pending = True
+    display_event.set()
 
 # --- 命令处理 ---
 def process_command(cmd):
+    global gc_report
     cmd = cmd.strip()
     try:
         data = json.loads(cmd)
+        if data.get('sync') == 'backlog': drain_backlog(); return
+        if 'config' in data:
+            # xxx_ms 为采样间隔 (超出器件限制的值会被限制), deadband/heartbeat_ms 为变化上报参数; 回复实际生效的配置
+            cfg = data.get('config')
+            if isinstance(cfg, dict):
+                scheduler.configure({k[:-3]: v for k, v in cfg.items() if k.endswith('_ms') and k != 'heartbeat_ms' and isinstance(v, int)})
+                reporter.configure(cfg.get('deadband'), cfg.get('heartbeat_ms'))
+            # 上位机下发配置通常意味着刚连接: 下一帧带上全部通道的当前值
+            reporter.reset()
+            print(json.dumps({"config": sampling_config()}))
+            return
+        if 'gc' in data:
+            gc_report = data.get('gc') in ('on', 1, True)
+            print(json.dumps({"gc": {"report": gc_report, "mem_free": gc.mem_free(), "mem_alloc": gc.mem_alloc(),
+                                     "gc_n": gc_count, "gc_auto": gc_auto_count, "gc_us": gc_last_us}}))
+            return
         actuator, action = data.get('actuator'), data.get('action')
         response = None
         if actuator == 'pump' and pump_relay:
@@ -161,77 +240,285 @@ def process_command(cmd):
         elif cmd == "led_off": status_led.high(); print('{"response": "Status LED is OFF"}')
         else: print(f'{{"error": "Unknown command: {cmd}"}}')
 
-# --- 主循环 ---
-print("\n🚀 开始主循环 (Root版)...")
-print("-" * 50)
-cycle_count = 0; last_sensor_read_time = time.ticks_ms();
-poll_obj = select.poll(); poll_obj.register(sys.stdin, select.POLLIN)
+def sampling_config():
+    cfg = {name + '_ms': ms for name, ms in scheduler.intervals().items()}
+    cfg['deadband'] = reporter.config(); cfg['heartbeat_ms'] = reporter.heartbeat_ms
+    return cfg
+
+# --- 手势处理 ---
+def handle_gesture(gesture_name, current_time):
+    global last_valid_gesture, gesture_display_timer, last_gesture_process_time
+    global current_display_page, control_page_selection, current_gesture
+    if not gesture_name: return
+    current_gesture = last_valid_gesture = gesture_name; gesture_display_timer = current_time; last_gesture_process_time = current_time
+    needs_display_update = False
+    
+    if gesture_name == "向右": 
+        current_display_page = (current_display_page + 1) % NUM_PAGES
+        needs_display_update = True
+    elif gesture_name == "向左": 
+        current_display_page = (current_display_page - 1 + NUM_PAGES) % NUM_PAGES
+        needs_display_update = True
+    elif current_display_page == 1: # 在控制页
+        if gesture_name == "向前": control_page_selection = (control_page_selection + 1) % NUM_CONTROL_ITEMS
+        elif gesture_name == "向后": control_page_selection = (control_page_selection - 1 + NUM_CONTROL_ITEMS) % NUM_CONTROL_ITEMS
+        elif gesture_name in ("向上", "向下"): # 触发动作
+            if control_page_selection == 0 and pump_relay: pump_relay.value(not pump_relay.value())
+            elif control_page_selection == 1 and led_strip_relay: led_strip_relay.value(not led_strip_relay.value())
+            elif control_page_selection == 2 and status_led: status_led.value(not status_led.value())
+        needs_display_update = True
+    
+    if needs_display_update: update_display(current_display_page)
+
+# --- 协作式任务 ---
+# 每个外设一个任务; 共享 I2C 总线的访问统一经过 i2c_lock。
+# 单个任务里阻塞的读取(如 DHT 时序)只会推迟其它任务一次调度, 命令处理延迟因此有上界。
+i2c_lock = asyncio.Lock()
+# 温度/湿度/光照以 10 倍整数保存, 土壤为整数百分比; 全程不产生浮点对象
+readings = {'temp': None, 'humi': None, 'lux': None, 'soil': None}
+cycle_count = 0; current_gesture = None
+boot_ttff_ms = None; boot_ready_ms = None; boot_reported = False; ready_reported = False
 last_valid_gesture = None; gesture_display_timer = 0; GESTURE_TIMEOUT = 3000
 last_gesture_process_time = 0; GESTURE_COOLDOWN = 500
-current_data_packet = {"cycle": 0, "gesture": None}
+host_was_online = True; last_backlog_time = time.ticks_ms()
+# 遥测帧只携带自上一帧以来新采到、且变化超过死区 (或心跳到期) 的通道 (位掩码);
+# 没有要上报的通道时, 手势变化立即发帧, 否则每 5 秒发一帧保活
+FRESH_DHT, FRESH_LUX, FRESH_SOIL = 1, 2, 4
+fresh = 0
+TELEMETRY_PERIOD_MS = 1000
+KEEPALIVE_MS = 5000
+last_frame_time = time.ticks_ms(); last_frame_gesture = None
+CH_TEMP, CH_HUMI, CH_LUX, CH_SOIL = range(4)
+# 默认死区: 温湿度/土壤任何变化都上报 (本身是整数), 光照 5 lux; 最长 60 秒静默
+reporter = ReportFilter(('temp', 'humi', 'lux', 'soil'), (0, 0, 50, 0), (10, 10, 10, 1), 60000)
 
-while True:
-    current_time = time.ticks_ms()
-    
-    # 手势处理
-    if paj_sensor and time.ticks_diff(current_time, last_gesture_process_time) > GESTURE_COOLDOWN:
+# --- 内存与 GC ---
+# 自动 GC 只作为兜底(分配 16KB 才触发); 正常情况下在遥测帧发完后的空闲窗口里主动回收,
+# 这样 GC 停顿不会落在手势处理或命令处理的中间。
+GC_IDLE_BYTES = 4096        # 距上次回收新分配超过 4KB 就在空闲窗口回收
+GC_MAX_INTERVAL_MS = 10000  # 或者距上次回收超过 10 秒
+gc.threshold(16 * 1024)
+gc.collect()
+gc_report = False           # {"gc": "on"} 开启后遥测帧附带内存统计
+gc_count = 0; gc_auto_count = 0; gc_last_us = 0
+gc_baseline = gc.mem_alloc(); gc_last_alloc = gc_baseline; gc_last_time = time.ticks_ms()
+
+def gc_idle():
+    global gc_count, gc_auto_count, gc_last_us, gc_baseline, gc_last_alloc, gc_last_time
+    alloc = gc.mem_alloc()
+    if alloc < gc_last_alloc: gc_auto_count += 1  # 分配量下降但不是我们回收的: 兜底 GC 发生过
+    now = time.ticks_ms()
+    if alloc - gc_baseline > GC_IDLE_BYTES or time.ticks_diff(now, gc_last_time) > GC_MAX_INTERVAL_MS:
+        t0 = time.ticks_us()
+        gc.collect()
+        gc_last_us = time.ticks_diff(time.ticks_us(), t0)
+        gc_count += 1; gc_last_time = now
+        alloc = gc_baseline = gc.mem_alloc()
+    gc_last_alloc = alloc
+
+# --- 分阶段耗时与健康帧 ---
+# 每个阶段用 ticks_us 计时 (I2C 阶段在持有总线锁之后才开始计时, 只统计真正的总线占用);
+# 健康帧每 30 秒发一次, 附带各传感器 get_status() 计数器, 上位机据此发现慢传感器和 I2C 故障
+PH_GESTURE, PH_COMMAND, PH_DHT, PH_LUX, PH_SOIL, PH_DISPLAY, PH_SERIAL = range(7)
+phases = PhaseStats(('gesture', 'command', 'dht', 'lux', 'soil', 'display', 'serial'))
+HEALTH_PERIOD_MS = 30000
+
+# --- 遥测帧 ---
+frame = FrameWriter(256)
+GESTURE_JSON = {}           # 手势名 -> 编码好的 JSON 字符串, 首次出现时生成
+WARMING_JSON = (None, b'["dht"]', b'["lux"]', b'["dht", "lux"]')
+
+async def gesture_task():
+    # 中断模式只在 INT 触发后读取, 否则按冷却时间轮询
+    last_probe_time = time.ticks_ms()
+    while True:
+        await asyncio.sleep_ms(20)
+        if not paj_sensor: return
+        current_time = time.ticks_ms()
         try:
-            gesture_name = paj_sensor.get_gesture_name(paj_sensor.get_gesture_code())
-            if gesture_name:
-                last_valid_gesture = gesture_name; gesture_display_timer = current_time; last_gesture_process_time = current_time
-                needs_display_update = False
-                
-                if gesture_name == "向右": 
-                    current_display_page = (current_display_page + 1) % NUM_PAGES
-                    needs_display_update = True
-                elif gesture_name == "向左": 
-                    current_display_page = (current_display_page - 1 + NUM_PAGES) % NUM_PAGES
-                    needs_display_update = True
-                elif current_display_page == 1: # 在控制页
-                    if gesture_name == "向前": control_page_selection = (control_page_selection + 1) % NUM_CONTROL_ITEMS
-                    elif gesture_name == "向后": control_page_selection = (control_page_selection - 1 + NUM_CONTROL_ITEMS) % NUM_CONTROL_ITEMS
-                    elif gesture_name in ("向上", "向下"): # 触发动作
-                        if control_page_selection == 0 and pump_relay: pump_relay.value(not pump_relay.value())
-                        elif control_page_selection == 1 and led_strip_relay: led_strip_relay.value(not led_strip_relay.value())
-                        elif control_page_selection == 2 and status_led: status_led.value(not status_led.value())
-                    needs_display_update = True
-                
-                if needs_display_update: update_display(current_data_packet, current_display_page)
+            code = 0
+            if paj_sensor.int_pin is not None:
+                if paj_sensor.irq_pending():
+                    async with i2c_lock:
+                        t0 = time.ticks_us(); paj_sensor.poll_events(); phases.add(PH_GESTURE, t0)
+                code = paj_sensor.get_event()
+                if not code and paj_sensor.irq_count == 0 and time.ticks_diff(current_time, last_probe_time) > PAJ_PROBE_INTERVAL:
+                    # 自检: 从未收到中断却轮询到了手势, 说明 INT 没有接线, 退回轮询模式
+                    last_probe_time = current_time
+                    async with i2c_lock: code = paj_sensor.get_gesture_code()
+                    if code:
+                        paj_sensor.disable_interrupt()
+                        print('{"info": "PAJ7620 INT not wired, fallback to polling"}')
+            elif time.ticks_diff(current_time, last_gesture_process_time) > GESTURE_COOLDOWN:
+                async with i2c_lock:
+                    t0 = time.ticks_us(); code = paj_sensor.get_gesture_code(); phases.add(PH_GESTURE, t0)
+            if code: handle_gesture(paj_sensor.get_gesture_name(code), current_time)
         except Exception: pass
 
-    # 串口命令处理
-    if poll_obj.poll(0):
-        command = sys.stdin.readline()
-        if command: 
-            process_command(command)
-            if current_display_page == 1: update_display(current_data_packet, current_display_page)
+async def command_task():
+    reader = asyncio.StreamReader(sys.stdin)
+    while True:
+        command = await reader.readline()
+        if not command: continue
+        if isinstance(command, bytes): command = command.decode()
+        t0 = time.ticks_us()
+        process_command(command)
+        phases.add(PH_COMMAND, t0)
+        if current_display_page == 1: update_display(current_display_page)
 
-    # 传感器读取循环 (1秒一次)
-    if time.ticks_diff(current_time, last_sensor_read_time) >= 1000:
-        last_sensor_read_time = current_time; cycle_count += 1
-        
-        current_gesture_for_pi = last_valid_gesture if (last_valid_gesture and time.ticks_diff(current_time, gesture_display_timer) < GESTURE_TIMEOUT) else None
-        if not current_gesture_for_pi: last_valid_gesture = None
-        
-        current_data_packet = {"cycle": cycle_count, "timestamp": time.ticks_ms(), "gesture": current_gesture_for_pi} 
-                       
-        if dht11 and dht11.measure():
-            sensor_data = dht11.get_data()
-            if sensor_data.get('is_valid'): 
-                current_data_packet.update({'temp': sensor_data.get('temperature'), 'humi': sensor_data.get('humidity')})
-        
-        if light_sensor: 
-            lux = light_sensor.read_lux()
-            current_data_packet['lux'] = round(lux, 1) if lux is not None else None
+def to_tenths(v):
+    # DHT11 返回整数, 直接乘 10; DHT22 的浮点值才需要取整
+    return v * 10 if isinstance(v, int) else int(round(v * 10))
+
+async def wait_due(sensor):
+    # 分段睡眠 (最长 1 秒), 运行时缩短的采样间隔能及时生效
+    while not sensor.is_due():
+        await asyncio.sleep_ms(min(sensor.time_until_due(), 1000))
+
+async def dht_task():
+    global fresh
+    while dht11:
+        await wait_due(dht11)
+        # 直接读属性, 不调用 get_data() 以免每次生成新字典
+        t0 = time.ticks_us(); ok = dht11.measure(); phases.add(PH_DHT, t0)
+        dht11.schedule_next()
+        if ok and dht11.temperature is not None and dht11.humidity is not None:
+            readings['temp'] = to_tenths(dht11.temperature); readings['humi'] = to_tenths(dht11.humidity)
+            fresh |= FRESH_DHT
+
+async def lux_task():
+    global fresh
+    while light_sensor:
+        await wait_due(light_sensor)
+        async with i2c_lock:
+            t0 = time.ticks_us(); ok = light_sensor.measure(); phases.add(PH_LUX, t0)
+        light_sensor.schedule_next()
+        if ok: readings['lux'] = light_sensor.lux10; fresh |= FRESH_LUX
+
+async def soil_task():
+    global fresh
+    while soil_sensor:
+        await wait_due(soil_sensor)
+        t0 = time.ticks_us(); ok = soil_sensor.measure(); phases.add(PH_SOIL, t0)
+        soil_sensor.schedule_next()
+        if ok: readings['soil'] = soil_sensor.percent; fresh |= FRESH_SOIL
+
+async def display_task():
+    global display_full_pending
+    while display:
+        await display_event.wait()
+        display_event.clear()
+        full = display_full_pending; display_full_pending = False
+        try:
+            async with i2c_lock:
+                t0 = time.ticks_us(); display.show(full); phases.add(PH_DISPLAY, t0)
+        except Exception: pass
+
+def write_telemetry_frame(gesture, warming, channels):
+    frame.begin()
+    frame.key_int(b'cycle', cycle_count)
+    frame.key_int(b'timestamp', time.ticks_ms())
+    if gesture is not None and gesture not in GESTURE_JSON: GESTURE_JSON[gesture] = json.dumps(gesture).encode()
+    frame.key_raw(b'gesture', GESTURE_JSON.get(gesture))
+    if channels & FRESH_DHT:
+        frame.key_tenths(b'temp', readings['temp']); frame.key_tenths(b'humi', readings['humi'])
+    if channels & FRESH_LUX: frame.key_tenths(b'lux', readings['lux'])
+    if channels & FRESH_SOIL: frame.key_int(b'soil', readings['soil'])
+    if warming: frame.key_raw(b'warming', WARMING_JSON[warming])
+    if gc_report:
+        frame.key_int(b'mem_free', gc.mem_free()); frame.key_int(b'gc_n', gc_count)
+        frame.key_int(b'gc_auto', gc_auto_count); frame.key_int(b'gc_us', gc_last_us)
+    frame.end()
+    t0 = time.ticks_us(); frame.write(); phases.add(PH_SERIAL, t0)
+
+def report_channels(mask, now):
+    # 从新采到的通道中挑出需要上报的; 温湿度同属一次 DHT 读取, 任一变化就一起上报
+    out = 0
+    if mask & FRESH_DHT:
+        t, h = readings['temp'], readings['humi']
+        if reporter.check(CH_TEMP, t, now) or reporter.check(CH_HUMI, h, now):
+            reporter.mark(CH_TEMP, t, now); reporter.mark(CH_HUMI, h, now); out |= FRESH_DHT
+    if mask & FRESH_LUX and reporter.check(CH_LUX, readings['lux'], now):
+        reporter.mark(CH_LUX, readings['lux'], now); out |= FRESH_LUX
+    if mask & FRESH_SOIL and reporter.check(CH_SOIL, readings['soil'], now):
+        reporter.mark(CH_SOIL, readings['soil'], now); out |= FRESH_SOIL
+    return out
+
+def telemetry_tick(current_time):
+    global cycle_count, current_gesture, last_valid_gesture
+    global boot_ttff_ms, boot_ready_ms, boot_reported, ready_reported, host_was_online, last_backlog_time
+    global fresh, last_frame_time, last_frame_gesture
+    cycle_count += 1
+    current_gesture = last_valid_gesture if (last_valid_gesture and time.ticks_diff(current_time, gesture_display_timer) < GESTURE_TIMEOUT) else None
+    if not current_gesture: last_valid_gesture = None
+    
+    # 预热中的传感器用位掩码表示: 1=dht, 2=lux
+    warming = (1 if dht11 and dht11.is_warming else 0) | (2 if light_sensor and light_sensor.is_warming else 0)
+    if boot_ttff_ms is None: boot_ttff_ms = time.ticks_diff(time.ticks_ms(), BOOT_T0)
+    if boot_ready_ms is None and not warming: boot_ready_ms = time.ticks_diff(time.ticks_ms(), BOOT_T0)
             
-        if soil_adc:
-            try:
-                raw, DRY, WET = soil_adc.read_u16(), 59000, 26000
-                if WET <= raw <= DRY + 2000: 
-                    current_data_packet['soil'] = round(max(0, min(100, 100 * (DRY - raw) / (DRY - WET))))
-            except: pass
-                
-        print(json.dumps(current_data_packet))
-        update_display(current_data_packet, current_display_page)
-        
-    time.sleep_ms(20)
+    online = host_connected()
+    if online:
+        if not host_was_online:
+            reporter.reset()
+            if backlog.count: print(json.dumps({"backlog_pending": backlog.count}))
+        channels = report_channels(fresh, current_time) if fresh else 0
+        fresh = 0
+        if (channels or not boot_reported or current_gesture != last_frame_gesture
+                or time.ticks_diff(current_time, last_frame_time) >= KEEPALIVE_MS):
+            write_telemetry_frame(current_gesture, warming, channels)
+            last_frame_time = current_time; last_frame_gesture = current_gesture
+        # 启动耗时上报: ttff_ms 为第一帧数据, ready_ms 为全部传感器预热完成
+        if not boot_reported:
+            boot_reported = True
+            print(json.dumps({"boot": {"ttff_ms": boot_ttff_ms, "fast": FAST_BOOT, "warming": json.loads(WARMING_JSON[warming] or b'[]')}}))
+        if not ready_reported and boot_ready_ms is not None:
+            ready_reported = True
+            print(json.dumps({"boot": {"ready_ms": boot_ready_ms}}))
+    elif time.ticks_diff(current_time, last_backlog_time) >= BACKLOG_INTERVAL_MS:
+        # 上位机没有在读串口: 样本进入离线缓存, 等主机请求时补传
+        last_backlog_time = current_time
+        backlog.push(time.time(), readings['temp'], readings['humi'], readings['lux'], readings['soil'])
+    host_was_online = online
+    update_display(current_display_page)
+
+async def telemetry_task():
+    # 让各传感器任务先完成第一次采集, 第一帧立即发出
+    await asyncio.sleep_ms(0)
+    next_tick = time.ticks_ms()
+    while True:
+        telemetry_tick(time.ticks_ms())
+        gc_idle()
+        # 节拍跟随最快的传感器, 高速通道的新样本不会在本地积压
+        next_tick = time.ticks_add(next_tick, scheduler.min_interval(TELEMETRY_PERIOD_MS))
+        await asyncio.sleep_ms(max(0, time.ticks_diff(next_tick, time.ticks_ms())))
+
+def health_frame():
+    sensors = {}
+    if dht11:
+        status = dht11.get_status(); status['driver_mode'] = dht11.driver_mode
+        sensors['dht'] = status
+    if light_sensor: sensors['lux'] = light_sensor.get_status()
+    if soil_sensor: sensors['soil'] = soil_sensor.get_status()
+    if paj_sensor:
+        sensors['gesture'] = {'sensor_type': 'PAJ7620', 'mode': 'irq' if paj_sensor.int_pin is not None else 'poll',
+                              'irq_count': paj_sensor.irq_count, 'dropped_events': paj_sensor.dropped_events}
+    return {"health": {"uptime_ms": time.ticks_diff(time.ticks_ms(), BOOT_T0), "period_ms": HEALTH_PERIOD_MS,
+                       "phases": phases.snapshot(), "sensors": sensors, "sampling": sampling_config(), "backlog": backlog.count,
+                       "mem_free": gc.mem_free(), "gc_n": gc_count, "gc_auto": gc_auto_count, "gc_us": gc_last_us}}
+
+async def health_task():
+    while True:
+        await asyncio.sleep_ms(HEALTH_PERIOD_MS)
+        if host_connected():
+            try: print(json.dumps(health_frame()))
+            except Exception: pass
+        else: phases.snapshot()  # 离线期间不上报, 丢弃本周期统计
+
+async def main():
+    tasks = [asyncio.create_task(t()) for t in (gesture_task, command_task, dht_task, lux_task, soil_task, display_task, telemetry_task, health_task)]
+    await asyncio.gather(*tasks)
+
+print("\n🚀 开始主循环 (asyncio)...")
+print("-" * 50)
+asyncio.run(main())